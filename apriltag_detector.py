@@ -1,74 +1,449 @@
+import time
 import cv2
 import apriltag
 import numpy as np
+from undistortion import Undistorter
+from frame_sources import luma, is_bgr
+from buffer_pool import BufferPool
+
+PNP_METHODS = ('iterative', 'warm_start', 'ippe_square')
+
+# Tag corners in the order the detector reports them, and the same corners
+# in the order SOLVEPNP_IPPE_SQUARE requires (the reverse)
+TAG_OBJECT_POINTS = np.array([[-0.5, -0.5, 0], [0.5, -0.5, 0], [0.5, 0.5, 0], [-0.5, 0.5, 0]])
+IPPE_OBJECT_POINTS = TAG_OBJECT_POINTS[::-1].copy()
+
+def summarize_scans(scan_counts, flow_dropped):
+    # Also used by DetectionPool to sum the counters of its workers' detectors
+    total = sum(scan_counts.values())
+    return {
+        'roi': scan_counts['roi'],
+        'full': scan_counts['full'],
+        'flow': scan_counts['flow'],
+        'roi_fraction': scan_counts['roi'] / total if total else 0.0,
+        'flow_fraction': scan_counts['flow'] / total if total else 0.0,
+        'flow_dropped': flow_dropped,
+    }
 
 class AprilTagDetector:
-    def __init__(self, camera_matrix=None, dist_coeffs=None, tag_size=0.080, zoom=3.0):
+    def __init__(self, camera_matrix=None, dist_coeffs=None, tag_size=0.080, zoom=3.0, native_crop=False,
+                 tracking=False, full_scan_interval=30, roi_padding=0.5,
+                 quad_decimate=1.0, corner_refinement='edges', undistort_points=False,
+                 box_model=None, box_pose_ransac=False, pnp_method='iterative',
+                 flow_tracking=False, flow_interval=5, flow_max_error=1.0, flow_max_reprojection=2.0):
+        if pnp_method not in PNP_METHODS:
+            raise ValueError(f"Unknown PnP method {pnp_method!r}, expected one of {PNP_METHODS}")
         self.camera_matrix = camera_matrix
         self.dist_coeffs = dist_coeffs
         self.tag_size = tag_size
         self.zoom = zoom
-        self.detector = apriltag.Detector()
-        
+        self.native_crop = native_crop
+
+        # Multi-scale mode: quads are found on a decimated image and refined
+        # on the full-resolution one. 'edges' uses apriltag's own edge
+        # refinement, 'subpix' additionally runs cornerSubPix on the corners.
+        self.quad_decimate = quad_decimate
+        self.corner_refinement = corner_refinement
+        options = apriltag.DetectorOptions(quad_decimate=quad_decimate, refine_edges=corner_refinement != 'none')
+        self.detector = apriltag.Detector(options)
+        self.subpix_criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.01)
+
+        # Tracking searches padded windows around the previous detections and
+        # falls back to a full-frame scan every full_scan_interval frames or
+        # as soon as a tracked tag is lost
+        self.tracking = tracking
+        self.full_scan_interval = full_scan_interval
+        self.roi_padding = roi_padding
+        self.tracked_detections = []
+        self.frames_since_full_scan = 0
+        self.scan_counts = {'roi': 0, 'full': 0, 'flow': 0}
+
+        # Optical-flow tracking moves the last detections' corners with
+        # pyramidal Lucas-Kanade for up to flow_interval frames before the
+        # next apriltag pass. A tag is dropped when its corners fail the
+        # forward-backward check by more than flow_max_error pixels, or when
+        # its pose reprojects worse than flow_max_reprojection pixels.
+        self.flow_tracking = flow_tracking
+        self.flow_interval = flow_interval
+        self.flow_max_error = flow_max_error
+        self.flow_max_reprojection = flow_max_reprojection
+        self.flow_params = dict(winSize=(21, 21), maxLevel=3,
+                                criteria=(cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_COUNT, 20, 0.03))
+        self.flow_gray = None
+        self.flow_buffer_index = 0
+        self.flow_detections = []
+        self.flow_tag_ids = set()  # Tags of the last detect call that came from flow
+        self.frames_since_detection = 0
+        self.flow_dropped = 0
+
+        # 'warm_start' starts each tag's solvePnP from its pose in the
+        # previous frame (the first solve uses IPPE_SQUARE), 'ippe_square'
+        # uses the closed-form square solver every time
+        self.pnp_method = pnp_method
+        self.tag_pose_cache = {}  # tag_id -> (rvec, tvec) of the last solved frame
+
+        # Distortion is handled on the tag corners only: either inside
+        # solvePnP, or by undistorting the corners up front and solving in
+        # normalized coordinates. Full frames are only undistorted for display.
+        self.undistort_points = undistort_points
+        self.undistorter = Undistorter(camera_matrix, dist_coeffs) if camera_matrix is not None and dist_coeffs is not None else None
+
+        # With a box model every known tag feeds one rigid-body PnP; per-tag
+        # poses are then read off the box pose. box_pose holds the last
+        # (rvec, tvec, used_tag_ids, rms_error), or None.
+        self.box_model = box_model
+        self.box_pose_ransac = box_pose_ransac
+        self.box_pose = None
+
+        # Durations of the stages of the last detect / pose call, in seconds
+        self.stage_times = {}
+
+        # Zoom and grayscale targets are reused from frame to frame
+        self.buffers = BufferPool(name='detector_buffers')
+
+        # Camera matrix for the zoomed frame, derived from the crop geometry
+        # once the frame size is known
+        self.zoomed_camera_matrix = None
+        self.frame_shape = None
+        self.crop_box = None
+        self.zoom_scale = (1.0, 1.0)
+
+    def update_zoom_geometry(self, frame):
+        if frame.shape[:2] == self.frame_shape:
+            return
+        height, width = frame.shape[:2]
+        new_width = int(width / self.zoom)
+        new_height = int(height / self.zoom)
+
+        # Calculate cropping box
+        x1 = (width - new_width) // 2
+        y1 = (height - new_height) // 2
+        x2 = x1 + new_width
+        y2 = y1 + new_height
+
+        self.frame_shape = frame.shape[:2]
+        self.crop_box = (x1, y1, x2, y2)
+        self.zoom_scale = (width / new_width, height / new_height)
+
         if self.camera_matrix is not None:
-            # Adjust camera matrix for zoom
-            self.camera_matrix = self.camera_matrix.copy()
-            self.camera_matrix[0, 0] *= zoom
-            self.camera_matrix[1, 1] *= zoom
+            # Crop shifts the principal point, the resize scales everything.
+            # Uses the same pixel-centre convention as cv2.resize.
+            sx, sy = self.zoom_scale
+            camera_matrix = self.camera_matrix.astype(np.float64)
+            self.zoomed_camera_matrix = np.array([
+                [camera_matrix[0, 0] * sx, camera_matrix[0, 1] * sx, (camera_matrix[0, 2] - x1 + 0.5) * sx - 0.5],
+                [0, camera_matrix[1, 1] * sy, (camera_matrix[1, 2] - y1 + 0.5) * sy - 0.5],
+                [0, 0, 1]
+            ])
 
-    def apply_digital_zoom(self, frame):
+    def crop_to_zoom(self, frame):
+        self.update_zoom_geometry(frame)
+        x1, y1, x2, y2 = self.crop_box
+        return frame[y1:y2, x1:x2]
+
+    def apply_digital_zoom(self, frame, dst=None):
+        # With dst the zoomed frame is always written there, even at zoom 1
         if self.zoom != 1.0:
             height, width = frame.shape[:2]
-            new_width = int(width / self.zoom)
-            new_height = int(height / self.zoom)
-            
-            # Calculate cropping box
-            x1 = (width - new_width) // 2
-            y1 = (height - new_height) // 2
-            x2 = x1 + new_width
-            y2 = y1 + new_height
-            
+
             # Crop and resize the frame
-            cropped_frame = frame[y1:y2, x1:x2]
-            zoomed_frame = cv2.resize(cropped_frame, (width, height), interpolation=cv2.INTER_LINEAR)
+            cropped_frame = self.crop_to_zoom(frame)
+            zoomed_frame = cv2.resize(cropped_frame, (width, height), dst=dst, interpolation=cv2.INTER_LINEAR)
             return zoomed_frame
+        self.update_zoom_geometry(frame)
+        if dst is not None:
+            np.copyto(dst, frame)
+            return dst
         return frame
 
+    def scratch(self, key, frame):
+        # Reused target shaped like frame (or its luma plane for 'gray*' keys)
+        shape = frame.shape[:2] if key.startswith('gray') else frame.shape
+        return self.buffers.scratch(key, shape, frame.dtype)
+
+    def crop_to_zoomed_points(self, points):
+        # Map apriltag coordinates in the native crop onto the zoomed frame.
+        # apriltag puts the top-left corner of the first pixel at (0, 0), so
+        # this is a plain scale.
+        sx, sy = self.zoom_scale
+        return np.asarray(points, dtype=np.float64) * np.array([sx, sy])
+
     def detect(self, frame):
-        frame = self.apply_digital_zoom(frame)
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        detections = self.detector.detect(gray)
+        # Returns (detections, zoomed_frame). zoomed_frame is None when no
+        # colour zoomed frame was made, and otherwise either frame itself or
+        # a buffer reused by the next call: copy it before drawing on it.
+        start_time = time.perf_counter()
+        if self.native_crop and self.zoom != 1.0:
+            # Detect on the raw crop; the upscaled frame holds no extra
+            # information. Callers that want to display it can run
+            # apply_digital_zoom themselves.
+            cropped_frame = self.crop_to_zoom(frame)
+            zoom_time = time.perf_counter()
+            # A view for gray and YUYV frames, BGR ones go into a reused buffer
+            gray = luma(cropped_frame, self.scratch('gray', cropped_frame) if is_bgr(cropped_frame) else None)
+            gray_time = time.perf_counter()
+            detections = [
+                detection._replace(
+                    corners=self.crop_to_zoomed_points(detection.corners),
+                    center=self.crop_to_zoomed_points(detection.center),
+                )
+                for detection in self.detect_gray(gray)
+            ]
+            frame = None
+        elif is_bgr(frame):
+            frame = self.apply_digital_zoom(frame, self.scratch('zoom', frame) if self.zoom != 1.0 else None)
+            zoom_time = time.perf_counter()
+            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=self.scratch('gray', frame))
+            gray_time = time.perf_counter()
+            detections = self.detect_gray(gray)
+        else:
+            # Gray and YUYV frames: zoom only the luma plane. There is no
+            # colour frame to hand back for display.
+            zoom_time = time.perf_counter()
+            gray = luma(frame)
+            gray = self.apply_digital_zoom(gray, self.scratch('gray_zoom', frame) if self.zoom != 1.0 else None)
+            gray_time = time.perf_counter()
+            detections = self.detect_gray(gray)
+            frame = None
+
+        self.stage_times = {
+            'zoom': zoom_time - start_time,
+            'cvtColor': gray_time - zoom_time,
+            'detect': time.perf_counter() - gray_time,
+        }
         return detections, frame
 
+    def detect_gray(self, gray):
+        self.flow_tag_ids = set()
+        if self.flow_tracking and self.flow_detections and self.frames_since_detection < self.flow_interval:
+            detections = self.track_flow(gray)
+            if detections:
+                self.frames_since_detection += 1
+                self.scan_counts['flow'] += 1
+                self.flow_tag_ids = {detection.tag_id for detection in detections}
+                return self.remember_flow(gray, detections)
+
+        if self.tracking and self.tracked_detections and self.frames_since_full_scan < self.full_scan_interval:
+            detections = self.detect_in_windows(gray)
+            if detections is not None:
+                self.frames_since_full_scan += 1
+                self.scan_counts['roi'] += 1
+                self.tracked_detections = detections
+                return self.remember_flow(gray, self.refine_corners(gray, detections))
+
+        detections = self.detector.detect(gray)
+        self.frames_since_full_scan = 0
+        self.scan_counts['full'] += 1
+        self.tracked_detections = detections
+        return self.remember_flow(gray, self.refine_corners(gray, detections))
+
+    def remember_flow(self, gray, detections):
+        # Keep a copy of this frame for the next flow step, alternating
+        # between two pooled buffers so the previous one stays intact
+        if not self.flow_tracking:
+            return detections
+        if not self.flow_tag_ids:
+            self.frames_since_detection = 0
+        self.flow_buffer_index ^= 1
+        self.flow_gray = self.buffers.scratch(f'flow_{self.flow_buffer_index}', gray.shape)
+        np.copyto(self.flow_gray, gray)
+        self.flow_detections = detections
+        return detections
+
+    def track_flow(self, gray):
+        # Returns the tracked detections in the coordinates of gray, without
+        # the tags that failed the forward-backward check
+        if self.flow_gray is None or self.flow_gray.shape != gray.shape:
+            return None
+        # LK puts pixel centres on integers, apriltag puts them on .5
+        previous = np.concatenate([detection.corners for detection in self.flow_detections]).astype(np.float32).reshape(-1, 1, 2) - 0.5
+        tracked, status, _ = cv2.calcOpticalFlowPyrLK(self.flow_gray, gray, previous, None, **self.flow_params)
+        back, back_status, _ = cv2.calcOpticalFlowPyrLK(gray, self.flow_gray, tracked, None, **self.flow_params)
+        error = np.linalg.norm((back - previous).reshape(-1, 4, 2), axis=2).max(axis=1)
+        good = (status & back_status).reshape(-1, 4).all(axis=1) & (error <= self.flow_max_error)
+        self.flow_dropped += int((~good).sum())
+
+        tracked = tracked.reshape(-1, 4, 2).astype(np.float64) + 0.5
+        return [
+            detection._replace(corners=corners, center=detection.center + (corners - detection.corners).mean(axis=0))
+            for detection, corners, keep in zip(self.flow_detections, tracked, good) if keep
+        ]
+
+    def drop_flow_track(self, tag_id):
+        self.flow_detections = [detection for detection in self.flow_detections if detection.tag_id != tag_id]
+        self.flow_dropped += 1
+
+    def refine_corners(self, gray, detections):
+        if self.corner_refinement != 'subpix' or not detections:
+            return detections
+
+        refined = []
+        for detection in detections:
+            # Keep the search window inside the tag's black border, which is
+            # one of the eight cells across the tag
+            side = np.linalg.norm(detection.corners - np.roll(detection.corners, 1, axis=0), axis=1).min()
+            half_window = int(np.clip(side / 16, 2, 8))
+            # cornerSubPix puts pixel centres on integers, apriltag puts them on .5
+            corners = (detection.corners - 0.5).astype(np.float32).reshape(-1, 1, 2)
+            corners = cv2.cornerSubPix(gray, corners, (half_window, half_window), (-1, -1), self.subpix_criteria)
+            refined.append(detection._replace(corners=corners.reshape(-1, 2).astype(np.float64) + 0.5))
+        return refined
+
+    def detect_in_windows(self, gray):
+        height, width = gray.shape[:2]
+        windows = []
+        for detection in self.tracked_detections:
+            x1, y1 = detection.corners.min(axis=0)
+            x2, y2 = detection.corners.max(axis=0)
+            pad = self.roi_padding * max(x2 - x1, y2 - y1)
+            windows.append([
+                max(0, int(x1 - pad)),
+                max(0, int(y1 - pad)),
+                min(width, int(x2 + pad) + 1),
+                min(height, int(y2 + pad) + 1)
+            ])
+
+        detections = {}
+        for x1, y1, x2, y2 in self.merge_windows(windows):
+            offset = np.array([x1, y1], dtype=np.float64)
+            for detection in self.detector.detect(gray[y1:y2, x1:x2]):
+                detections[detection.tag_id] = detection._replace(
+                    corners=detection.corners + offset,
+                    center=detection.center + offset,
+                )
+
+        # A lost tag means the box moved more than the padding allows
+        if any(detection.tag_id not in detections for detection in self.tracked_detections):
+            return None
+        return list(detections.values())
+
+    @staticmethod
+    def merge_windows(windows):
+        # Union overlapping windows so a tag is never split between two searches
+        merged = []
+        for window in sorted(windows):
+            for other in merged:
+                if window[0] < other[2] and other[0] < window[2] and window[1] < other[3] and other[1] < window[3]:
+                    other[0] = min(other[0], window[0])
+                    other[1] = min(other[1], window[1])
+                    other[2] = max(other[2], window[2])
+                    other[3] = max(other[3], window[3])
+                    break
+            else:
+                merged.append(list(window))
+        if len(merged) < len(windows):
+            return AprilTagDetector.merge_windows(merged)
+        return merged
+
+    def scan_stats(self):
+        return summarize_scans(self.scan_counts, self.flow_dropped)
+
     def get_position_and_orientation(self, detections):
+        start_time = time.perf_counter()
         positions_orientations = []
-        for detection in detections:
-            corners = detection.corners
-            tag_id = detection.tag_id
+        if self.zoomed_camera_matrix is None or self.dist_coeffs is None:
+            self.box_pose = None
+            self.stage_times['pose'] = time.perf_counter() - start_time
+            return [(detection.tag_id, None, None, None) for detection in detections]
+
+        if self.undistort_points and detections:
+            # One undistortPoints call for every corner in the frame, then
+            # PnP on an ideal pinhole camera
+            all_corners = np.concatenate([detection.corners for detection in detections])
+            image_points = self.undistorter.undistort_points(all_corners, self.zoomed_camera_matrix).reshape(-1, 4, 2)
+            camera_matrix, dist_coeffs = np.eye(3), None
+            pixel_scale = 1.0 / self.zoomed_camera_matrix[0, 0]  # Pixel thresholds in normalized units
+        else:
+            image_points = np.array([detection.corners for detection in detections], dtype=np.float64).reshape(-1, 4, 2)
+            camera_matrix, dist_coeffs = self.zoomed_camera_matrix, self.dist_coeffs
+            pixel_scale = 1.0
 
-            if self.camera_matrix is not None and self.dist_coeffs is not None:
-                object_points = np.array([
-                    [-0.5, -0.5, 0],
-                    [0.5, -0.5, 0],
-                    [0.5, 0.5, 0],
-                    [-0.5, 0.5, 0]
-                ]) * self.tag_size
-
-                image_points = np.array(corners, dtype=np.float32)
-
-                success, rvec, tvec = cv2.solvePnP(object_points, image_points, self.camera_matrix, self.dist_coeffs)
-                if success:
-                    position = tvec.flatten()
-                    rotation_matrix, _ = cv2.Rodrigues(rvec)
-                    orientation = cv2.RQDecomp3x3(rotation_matrix)[0]
-                    positions_orientations.append((tag_id, position, tvec, orientation))
-                else:
-                    positions_orientations.append((tag_id, None, None, None))
+        tag_poses = self.solve_box_pose(detections, image_points, camera_matrix, dist_coeffs, pixel_scale)
+        solved = {}
+        for index, detection in enumerate(detections):
+            tag_id = detection.tag_id
+            if tag_id in tag_poses:
+                rvec, tvec = tag_poses[tag_id]
             else:
+                rvec, tvec = self.solve_tag_pose(tag_id, image_points[index], camera_matrix, dist_coeffs)
+
+            if rvec is not None and tag_id in self.flow_tag_ids:
+                # Corners that drifted off the tag no longer fit a square
+                projected, _ = cv2.projectPoints(TAG_OBJECT_POINTS * self.tag_size, rvec, tvec, camera_matrix, dist_coeffs)
+                error = np.sqrt(np.mean(np.sum((projected.reshape(4, 2) - image_points[index]) ** 2, axis=1)))
+                if error > self.flow_max_reprojection * pixel_scale:
+                    self.drop_flow_track(tag_id)
+                    rvec = None
+
+            if rvec is None:
                 positions_orientations.append((tag_id, None, None, None))
+                continue
+            solved[tag_id] = (rvec, tvec)
+            rotation_matrix, _ = cv2.Rodrigues(rvec)
+            orientation = cv2.RQDecomp3x3(rotation_matrix)[0]
+            positions_orientations.append((tag_id, tvec.flatten(), tvec, orientation))
 
+        # Only tags seen in this frame keep a warm start
+        self.tag_pose_cache = solved
+        self.stage_times['pose'] = time.perf_counter() - start_time
         return positions_orientations
 
+    def solve_tag_pose(self, tag_id, image_points, camera_matrix, dist_coeffs):
+        # Returns (rvec, tvec), or (None, None) if the solver fails
+        object_points = TAG_OBJECT_POINTS * self.tag_size
+        guess = self.tag_pose_cache.get(tag_id) if self.pnp_method == 'warm_start' else None
+        if guess is not None:
+            success, rvec, tvec = cv2.solvePnP(object_points, image_points, camera_matrix, dist_coeffs,
+                                               guess[0].copy(), guess[1].copy(), useExtrinsicGuess=True)
+        elif self.pnp_method != 'iterative':
+            success, rvec, tvec = cv2.solvePnP(IPPE_OBJECT_POINTS * self.tag_size, image_points[::-1].copy(), camera_matrix,
+                                               dist_coeffs, flags=cv2.SOLVEPNP_IPPE_SQUARE)
+        else:
+            success, rvec, tvec = cv2.solvePnP(object_points, image_points, camera_matrix, dist_coeffs)
+        return (rvec, tvec) if success else (None, None)
+
+    def solve_box_pose(self, detections, image_points, camera_matrix, dist_coeffs, pixel_scale):
+        # Returns {tag_id: (rvec, tvec)} for the tags explained by the box
+        # pose; the rest fall back to per-tag solves
+        self.box_pose = None
+        if self.box_model is None or not detections:
+            return {}
+        tag_ids = [detection.tag_id for detection in detections]
+        # The RANSAC threshold is in pixels, scale it for normalized points
+        self.box_pose = self.box_model.solve_pose(tag_ids, image_points, camera_matrix, dist_coeffs, self.box_pose_ransac,
+                                                  3.0 * pixel_scale)
+        if self.box_pose is None:
+            return {}
+        rvec, tvec, used_tag_ids, error = self.box_pose
+        # Report the error in pixels whether or not the points were normalized
+        self.box_pose = (rvec, tvec, used_tag_ids, error / pixel_scale)
+        centres, rotations = self.box_model.tag_poses(rvec, tvec, used_tag_ids)
+        return {
+            tag_id: (cv2.Rodrigues(rotation)[0], centre.reshape(3, 1))
+            for tag_id, centre, rotation in zip(used_tag_ids, centres, rotations)
+        }
+
+    def undistorted_zoom(self, frame, dst=None):
+        # Zoom and undistortion in a single remap of the raw frame. Without
+        # calibration this is the plain digital zoom. Always returns a new
+        # array (or dst), so it is safe to draw on.
+        self.update_zoom_geometry(frame)
+        if self.undistorter is None or self.zoomed_camera_matrix is None:
+            zoomed_frame = self.apply_digital_zoom(frame, dst)
+            return zoomed_frame.copy() if zoomed_frame is frame else zoomed_frame
+        return self.undistorter.remap(frame, self.zoomed_camera_matrix, dst)
+
+    def undistort_detections(self, detections):
+        # Move detections into the undistorted zoomed frame for drawing
+        if self.undistorter is None or self.zoomed_camera_matrix is None or not detections:
+            return detections
+        points = np.concatenate([np.vstack([detection.corners, detection.center]) for detection in detections])
+        points = self.undistorter.undistort_points(points, self.zoomed_camera_matrix, self.zoomed_camera_matrix).reshape(-1, 5, 2)
+        return [
+            detection._replace(corners=tag_points[:4], center=tag_points[4])
+            for detection, tag_points in zip(detections, points)
+        ]
+
     def draw_detections(self, frame, detections):
         for detection in detections:
             corners = detection.corners
@@ -0,0 +1,100 @@
+import os
+import time
+import glob
+import json
+import argparse
+import cv2
+import numpy as np
+from apriltag_detector import AprilTagDetector
+
+def load_config(config_path='config.json'):
+    if os.path.exists(config_path):
+        with open(config_path, 'r') as file:
+            config = json.load(file)
+        print(f"Loaded configuration from {config_path}.")
+    else:
+        config = {}
+        print(f"Configuration file {config_path} not found. Using default settings.")
+    return config
+
+def load_images(input_dir):
+    files = glob.glob(os.path.join(input_dir, '*.png')) + glob.glob(os.path.join(input_dir, '*.jpg'))
+    files.sort(key=lambda f: int(''.join(filter(str.isdigit, os.path.basename(f))) or 0))
+    images = [cv2.imread(f) for f in files]
+    return [img for img in images if img is not None]
+
+def run_detector(detector, images):
+    results = []
+    start_time = time.perf_counter()
+    for img in images:
+        detections, _ = detector.detect(img)
+        positions_orientations = detector.get_position_and_orientation(detections)
+        results.append((detections, positions_orientations))
+    elapsed = time.perf_counter() - start_time
+    return results, elapsed
+
+def compare_results(reference, candidate):
+    corner_errors = []
+    translation_errors = []
+    missed = 0
+    for (ref_detections, ref_poses), (detections, poses) in zip(reference, candidate):
+        candidate_corners = {d.tag_id: d.corners for d in detections}
+        candidate_positions = {tag_id: position for tag_id, position, _, _ in poses}
+        for detection in ref_detections:
+            if detection.tag_id not in candidate_corners:
+                missed += 1
+                continue
+            corner_errors.append(np.linalg.norm(candidate_corners[detection.tag_id] - detection.corners, axis=1).mean())
+        for tag_id, position, _, _ in ref_poses:
+            if position is not None and candidate_positions.get(tag_id) is not None:
+                translation_errors.append(np.linalg.norm(candidate_positions[tag_id] - position))
+    return corner_errors, translation_errors, missed
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare single-scale and multi-scale AprilTag detection.")
+    parser.add_argument('input_dir', type=str, help='Directory containing captured images.')
+    parser.add_argument('-con', '--config', type=str, default='config.json', help='Path to configuration file')
+    parser.add_argument('-d', '--decimate', type=float, default=None, help='Quad decimation for the multi-scale run.')
+    parser.add_argument('-r', '--refinement', type=str, default=None, choices=['none', 'edges', 'subpix'], help='Corner refinement for the multi-scale run.')
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    calibration_path = config.get("calibration", "camera_calibration_data.npz")
+    if os.path.exists(calibration_path):
+        calibration_data = np.load(calibration_path)
+        camera_matrix = calibration_data['camera_matrix']
+        dist_coeffs = calibration_data['dist_coeffs']
+    else:
+        camera_matrix = None
+        dist_coeffs = None
+    tag_size = config.get("tag_size", 0.080)
+    zoom = config.get("zoom", 1.0)
+    native_crop = config.get("native_crop", False)
+    decimate = args.decimate if args.decimate is not None else config.get("quad_decimate", 2.0)
+    refinement = args.refinement or config.get("corner_refinement", "subpix")
+
+    images = load_images(args.input_dir)
+    if not images:
+        print("No images found in the directory.")
+        return
+    print(f"Loaded {len(images)} images.")
+
+    single_scale = AprilTagDetector(camera_matrix, dist_coeffs, tag_size, zoom, native_crop)
+    multi_scale = AprilTagDetector(camera_matrix, dist_coeffs, tag_size, zoom, native_crop,
+                                   quad_decimate=decimate, corner_refinement=refinement)
+
+    reference, reference_time = run_detector(single_scale, images)
+    candidate, candidate_time = run_detector(multi_scale, images)
+    corner_errors, translation_errors, missed = compare_results(reference, candidate)
+
+    print(f"Single-scale: {1000 * reference_time / len(images):.1f} ms/frame")
+    print(f"Multi-scale (decimate {decimate}, {refinement}): {1000 * candidate_time / len(images):.1f} ms/frame, "
+          f"speedup {reference_time / candidate_time:.2f}x")
+    if corner_errors:
+        print(f"Corner offset vs single-scale: mean {np.mean(corner_errors):.3f} px, max {np.max(corner_errors):.3f} px")
+    if translation_errors:
+        print(f"Translation offset vs single-scale: mean {1000 * np.mean(translation_errors):.2f} mm, max {1000 * np.max(translation_errors):.2f} mm")
+    print(f"Tags missed by multi-scale: {missed}")
+
+if __name__ == "__main__":
+    main()
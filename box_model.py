@@ -0,0 +1,137 @@
+import cv2
+import numpy as np
+
+# Faces of the box around its rotation axis (the box frame's y axis), in the
+# order they come into view. The face at angle 0 points at the camera (-z)
+# when the box is unrotated, with its top towards -y.
+FACE_ANGLES = {'right': 0, 'bottom': 90, 'left': 180}
+
+DEFAULT_FACE_TAGS = {
+    'right': {'top_left': 0, 'top_right': 1, 'bottom_left': 2, 'bottom_right': 3},
+    'bottom': {'top_left': 25, 'top_right': 24, 'bottom_left': 23, 'bottom_right': 22},
+    'left': {'top_left': 4, 'top_right': 5, 'bottom_left': 6, 'bottom_right': 7},
+}
+
+# Tag corners in the detector's tag frame (x towards the printed left, y
+# towards the printed top), in the order the detector reports them. Matches
+# the object points of AprilTagDetector.get_position_and_orientation.
+TAG_CORNERS = np.array([[-0.5, -0.5], [0.5, -0.5], [0.5, 0.5], [-0.5, 0.5]])
+
+def rotation_y(angle):
+    c, s = np.cos(angle), np.sin(angle)
+    return np.array([[c, 0, s], [0, 1, 0], [-s, 0, c]])
+
+class BoxModel:
+    def __init__(self, face_tags=None, box_size=0.3, tag_size=0.080, tag_offset=None, face_angles=None):
+        face_tags = face_tags or DEFAULT_FACE_TAGS
+        face_angles = face_angles or FACE_ANGLES
+        # Tags sit in the middle of the four quadrants of their face by default
+        tag_offset = box_size / 4 if tag_offset is None else tag_offset
+        self.face_tags = {face: {position: int(tag_id) for position, tag_id in tags.items()} for face, tags in face_tags.items()}
+        self.face_angles = dict(face_angles)
+        self.box_size = box_size
+        self.tag_size = tag_size
+
+        self.face_normals = {}
+        self.tag_faces = {}
+        corners = {}
+        rotations = {}
+        half = box_size / 2
+        up = np.array([0, -1.0, 0])
+        for face, tags in self.face_tags.items():
+            rotation = rotation_y(np.radians(self.face_angles[face]))
+            right = rotation @ np.array([1.0, 0, 0])
+            normal = rotation @ np.array([0, 0, -1.0])
+            self.face_normals[face] = normal
+            for position, tag_id in tags.items():
+                sy = 1 if position.startswith('top') else -1
+                sx = -1 if position.endswith('left') else 1
+                tag_centre = normal * half + sx * tag_offset * right + sy * tag_offset * up
+                x_axis, y_axis = -right, up
+                corners[tag_id] = tag_centre + tag_size * (TAG_CORNERS[:, :1] * x_axis + TAG_CORNERS[:, 1:] * y_axis)
+                rotations[tag_id] = np.column_stack([x_axis, y_axis, np.cross(x_axis, y_axis)])
+                self.tag_faces[tag_id] = face
+
+        # Dense per-tag arrays, row index[tag_id] belongs to that tag
+        self.tag_ids = np.array(sorted(corners))
+        self.index = {int(tag_id): row for row, tag_id in enumerate(self.tag_ids)}
+        self.object_points = np.array([corners[tag_id] for tag_id in self.tag_ids])  # (N, 4, 3)
+        self.tag_centres = self.object_points.mean(axis=1)
+        self.tag_rotations = np.array([rotations[tag_id] for tag_id in self.tag_ids])  # Tag frame -> box frame
+        self.tag_relationships = self.build_relationships()
+
+    def build_relationships(self):
+        # Every tag on another face, nearest first, with the angle between the
+        # two faces. Replaces the hand-written table, where tags with two
+        # neighbours could only keep one.
+        relationships = {}
+        for row, tag_id in enumerate(self.tag_ids):
+            face = self.tag_faces[tag_id]
+            others = [other for other in range(len(self.tag_ids)) if self.tag_faces[self.tag_ids[other]] != face]
+            others.sort(key=lambda other: np.linalg.norm(self.tag_centres[other] - self.tag_centres[row]))
+            relationships[int(tag_id)] = [
+                (int(self.tag_ids[other]), float(np.round(np.degrees(np.arccos(np.clip(
+                    np.dot(self.face_normals[face], self.face_normals[self.tag_faces[self.tag_ids[other]]]), -1, 1))))))
+                for other in others
+            ]
+        return relationships
+
+    def solve_pose(self, tag_ids, image_points, camera_matrix, dist_coeffs, ransac=False, reprojection_threshold=3.0):
+        # One PnP over the corners of every known tag. image_points is
+        # (len(tag_ids), 4, 2). Returns (rvec, tvec, used_tag_ids, rms_error)
+        # or None.
+        rows = [self.index.get(int(tag_id)) for tag_id in tag_ids]
+        known = [i for i, row in enumerate(rows) if row is not None]
+        if not known:
+            return None
+        object_points = self.object_points[[rows[i] for i in known]].reshape(-1, 3)
+        image_points = np.asarray(image_points, dtype=np.float64)[known].reshape(-1, 2)
+        used_tag_ids = [int(tag_ids[i]) for i in known]
+
+        success, rvec, tvec = cv2.solvePnP(object_points, image_points, camera_matrix, dist_coeffs)
+        if not success:
+            return None
+        tag_errors = self.tag_errors(object_points, image_points, rvec, tvec, camera_matrix, dist_coeffs)
+
+        if ransac and len(known) > 1 and tag_errors.max() > reprojection_threshold:
+            # Only pay for RANSAC when some tag disagrees with the rest. Keep
+            # the tags with at least three inlier corners and refine on them
+            # from the RANSAC estimate.
+            success, ransac_rvec, ransac_tvec, inliers = cv2.solvePnPRansac(object_points, image_points, camera_matrix, dist_coeffs,
+                                                                           reprojectionError=reprojection_threshold)
+            if success and inliers is not None:
+                keep = [i for i, count in enumerate(np.bincount(inliers.ravel() // 4, minlength=len(known))) if count >= 3]
+                if keep:
+                    used_tag_ids = [used_tag_ids[i] for i in keep]
+                    object_points = object_points.reshape(-1, 4, 3)[keep].reshape(-1, 3)
+                    image_points = image_points.reshape(-1, 4, 2)[keep].reshape(-1, 2)
+                    success, rvec, tvec = cv2.solvePnP(object_points, image_points, camera_matrix, dist_coeffs,
+                                                       ransac_rvec, ransac_tvec, useExtrinsicGuess=True)
+                    if not success:
+                        return None
+                    tag_errors = self.tag_errors(object_points, image_points, rvec, tvec, camera_matrix, dist_coeffs)
+
+        error = float(np.sqrt(np.mean(tag_errors ** 2)))
+        return rvec, tvec, used_tag_ids, error
+
+    @staticmethod
+    def tag_errors(object_points, image_points, rvec, tvec, camera_matrix, dist_coeffs):
+        # RMS reprojection error of each tag's four corners
+        projected, _ = cv2.projectPoints(object_points, rvec, tvec, camera_matrix, dist_coeffs)
+        squared = np.sum((projected.reshape(-1, 2) - image_points) ** 2, axis=1).reshape(-1, 4)
+        return np.sqrt(squared.mean(axis=1))
+
+    def tag_poses(self, rvec, tvec, tag_ids):
+        # Camera-frame centres and rotations of the given tags for a box pose
+        rotation, _ = cv2.Rodrigues(rvec)
+        rows = [self.index[int(tag_id)] for tag_id in tag_ids]
+        centres = self.tag_centres[rows] @ rotation.T + tvec.reshape(1, 3)
+        rotations = rotation @ self.tag_rotations[rows]
+        return centres, rotations
+
+    def facing_angle(self, rvec, tvec):
+        # Angle, in degrees, of the box face pointing at the camera: 0 when
+        # the 'right' face looks straight at it, FACE_ANGLES[face] for the others
+        rotation, _ = cv2.Rodrigues(rvec)
+        to_camera = rotation.T @ -np.asarray(tvec, dtype=np.float64).reshape(3)
+        return float(np.degrees(np.arctan2(-to_camera[0], -to_camera[2])) % 360)
@@ -1,124 +1,188 @@
 import numpy as np
+from box_model import BoxModel
+
+# One row per tag observation, for any number of frames. Tags detected
+# without a pose have a NaN position.
+OBSERVATION_DTYPE = np.dtype([('frame', np.int64), ('tag_id', np.int64), ('position', np.float64, 3)])
+
+# One row per frame, NaN where the frame has no estimate
+POSE_DTYPE = np.dtype([('position', np.float64, 3), ('orientation', np.float64),
+                       ('relative_orientation', np.float64), ('rotation_count', np.int64)])
+
+def make_observations(positions_orientations, frame=0):
+    # One frame's (tag_id, position, tvec, orientation) tuples as observation rows
+    observations = np.empty(len(positions_orientations), dtype=OBSERVATION_DTYPE)
+    observations['frame'] = frame
+    for row, (tag_id, position, _, _) in enumerate(positions_orientations):
+        observations['tag_id'][row] = tag_id
+        observations['position'][row] = position if position is not None else np.nan
+    return observations
+
+def observations_from_records(records):
+    # Observation rows from run-data records (see run_data_writer.read_run_data),
+    # numbered by record. Returns (observations, capture_times).
+    frames, tag_ids, positions, capture_times = [], [], [], []
+    for frame, record in enumerate(records):
+        capture_times.append(record.get('capture_time', np.nan))
+        for tag in record.get('tags') or []:
+            frames.append(frame)
+            tag_ids.append(tag['tag_id'])
+            positions.append(tag['position'] if tag['position'] is not None else (np.nan, np.nan, np.nan))
+    observations = np.empty(len(frames), dtype=OBSERVATION_DTYPE)
+    observations['frame'] = frames
+    observations['tag_id'] = tag_ids
+    observations['position'] = np.array(positions, dtype=np.float64).reshape(-1, 3)
+    return observations, np.array(capture_times, dtype=np.float64)
 
 class BoxPosition:
-    def __init__(self, initial_positions=None):
-        self.face_tags = {
-            'right': {'top_left': 0, 'top_right': 1, 'bottom_left': 2, 'bottom_right': 3},
-            'bottom': {'top_left': 25, 'top_right': 24, 'bottom_left': 23, 'bottom_right': 22},
-            'left': {'top_left': 4, 'top_right': 5, 'bottom_left': 6, 'bottom_right': 7},
-        }
-        self.tag_relationships = {
-            2: (25, 90),  # Bottom left of the right face borders the top left of the bottom face
-            25: (2, 90),  # Top left of the bottom face borders the bottom left of the right face
-            3: (24, 90),  # Bottom right of the right face borders the top right of the bottom face
-            24: (3, 90),  # Top right of the bottom face borders the bottom right of the right face
-            23: (4, 90),  # Bottom left of the bottom face borders the top left of the left face
-            4: (23, 90),  # Top left of the left face borders the bottom left of the bottom face
-            22: (5, 90),  # Bottom right of the bottom face borders the top right of the left face
-            5: (22, 90),  # Top right of the left face borders the bottom right of the bottom face
-            0: (6, 180),  # Top left of the right face is directly across from tag 6 on the left face
-            6: (0, 180),  # Top left of the left face is directly across from tag 0 on the right face
-            1: (7, 180),  # Top right of the right face is directly across from tag 7 on the left face
-            7: (1, 180),  # Top right of the left face is directly across from tag 1 on the right face
-            2: (4, 180),  # Bottom left of the right face is directly across from tag 4 on the left face
-            4: (2, 180),  # Top left of the left face is directly across from tag 2 on the right face
-            3: (5, 180),  # Bottom right of the right face is directly across from tag 5 on the left face
-            5: (3, 180),  # Top right of the left face is directly across from tag 3 on the right face
-        }
-        self.initial_positions = initial_positions if initial_positions else {}
+    def __init__(self, initial_positions=None, box_model=None):
+        # Tag layout and tag relationships both come from the compiled box model
+        self.box_model = box_model if box_model is not None else BoxModel()
+        self.face_tags = self.box_model.face_tags
+        self.tag_relationships = self.box_model.tag_relationships
+        # Keys are strings when loaded from JSON
+        self.initial_positions = {int(tag_id): value for tag_id, value in (initial_positions or {}).items()}
+        self.build_reference_table()
         self.rotation_order = []
         self.rotation_count = 0
+        # Relative orientation unwrapped since the first estimate, in degrees
+        self.last_relative_orientation = None
+        self.turned_degrees = 0.0
+
+    def build_reference_table(self):
+        # Every tag is compared with its own initial observation, or else the
+        # nearest related tag that has one. Resolved once into arrays indexed
+        # by tag ID, so frames are looked up without a Python loop.
+        references = {}
+        for tag_id in set(self.tag_relationships) | set(self.initial_positions):
+            for related_tag, angle in [(tag_id, 0)] + self.tag_relationships.get(tag_id, []):
+                initial = self.initial_positions.get(related_tag)
+                if initial is not None and initial.get('position') is not None:
+                    references[tag_id] = (initial['orientation'] + angle, initial['position'])
+                    break
+        size = max(references, default=-1) + 1
+        self.reference_valid = np.zeros(size, dtype=bool)
+        self.reference_offsets = np.zeros(size)
+        self.reference_vectors = np.ones((size, 3))
+        for tag_id, (offset, position) in references.items():
+            self.reference_valid[tag_id] = True
+            self.reference_offsets[tag_id] = offset
+            self.reference_vectors[tag_id] = position
+        self.reference_norms = np.linalg.norm(self.reference_vectors, axis=1)
+
+    def estimate_poses(self, observations, num_frames=None, guess_untagged=True):
+        # Average position, bearing and relative orientation of every frame
+        # in a few vectorized passes. rotation_count is left at 0, see
+        # calculate_orientations. Frames without any tag get the 0 degree
+        # guess unless guess_untagged is False, then they stay NaN.
+        num_frames = int(observations['frame'].max()) + 1 if num_frames is None and len(observations) else (num_frames or 0)
+        if len(observations) and (observations['frame'].min() < 0 or observations['frame'].max() >= num_frames):
+            raise ValueError(f"Observation frames must be in 0..{num_frames - 1}, got "
+                             f"{observations['frame'].min()}..{observations['frame'].max()}")
+        poses = np.zeros(num_frames, dtype=POSE_DTYPE)
+        poses['position'] = np.nan
+        poses['orientation'] = np.nan
+        poses['relative_orientation'] = np.nan
+        if not self.initial_positions:
+            return poses
+
+        frames = observations['frame']
+        positions = observations['position']
+        located = ~np.isnan(positions).any(axis=1)
+        counts = np.bincount(frames[located], minlength=num_frames)
+        seen = counts > 0
+        for axis in range(3):
+            poses['position'][seen, axis] = np.bincount(frames[located], positions[located, axis], num_frames)[seen] / counts[seen]
+        poses['orientation'][seen] = np.degrees(np.arctan2(poses['position'][seen, 1], poses['position'][seen, 0])) % 360
+
+        # Angle between the reference and current position of every
+        # observation with a reference, combined per frame as a circular mean
+        # so estimates either side of 0 degrees don't cancel out
+        tag_ids = observations['tag_id']
+        known = np.zeros(len(observations), dtype=bool)
+        in_table = located & (tag_ids >= 0) & (tag_ids < len(self.reference_valid))
+        known[in_table] = self.reference_valid[tag_ids[in_table]]
+        tag_ids = tag_ids[known]
+        current = positions[known]
+        cosines = np.einsum('ij,ij->i', self.reference_vectors[tag_ids], current) / (
+            self.reference_norms[tag_ids] * np.linalg.norm(current, axis=1))
+        estimates = np.radians(self.reference_offsets[tag_ids] + np.degrees(np.arccos(np.clip(cosines, -1, 1))))
+        estimated = np.bincount(frames[known], minlength=num_frames) > 0
+        sines = np.bincount(frames[known], np.sin(estimates), num_frames)
+        cosines = np.bincount(frames[known], np.cos(estimates), num_frames)
+        poses['relative_orientation'][estimated] = np.degrees(np.arctan2(sines[estimated], cosines[estimated])) % 360
+        if guess_untagged:
+            self.guess_untagged(poses, observations)
+        return poses
+
+    @staticmethod
+    def guess_untagged(poses, observations):
+        # If no tags are detected at all, guess that we are facing the top face
+        poses['relative_orientation'][np.bincount(observations['frame'], minlength=len(poses)) == 0] = 0
+
+    def count_rotations(self, relative_orientations):
+        # Full turns of the relative orientation since the first estimate,
+        # signed and truncated towards zero, after each of the given frames.
+        # Carries over between calls, so the live path and batches of logged
+        # frames count the same way. Frames without an estimate keep the count.
+        relative_orientations = np.asarray(relative_orientations, dtype=np.float64)
+        counts = np.full(len(relative_orientations), self.rotation_count, dtype=np.int64)
+        estimated = np.flatnonzero(~np.isnan(relative_orientations))
+        if len(estimated) == 0:
+            return counts
+        angles = relative_orientations[estimated]
+        previous = self.last_relative_orientation if self.last_relative_orientation is not None else angles[0]
+        steps = (np.diff(angles, prepend=previous) + 180) % 360 - 180
+        turned = self.turned_degrees + np.cumsum(steps)
+        rotations = np.trunc(turned / 360).astype(np.int64)
+        # Frames without an estimate repeat the count of the last one that had one
+        counts[estimated[0]:] = rotations[np.searchsorted(estimated, np.arange(estimated[0], len(counts)), side='right') - 1]
+        self.last_relative_orientation = angles[-1]
+        self.turned_degrees = turned[-1]
+        self.rotation_count = int(rotations[-1])
+        return counts
+
+    def calculate_orientations(self, observations, num_frames=None):
+        # Batch version of calculate_orientation over observation rows of
+        # many frames, in frame order. Returns a POSE_DTYPE array.
+        # The guess for frames without tags is no measurement, keep it out of the count
+        poses = self.estimate_poses(observations, num_frames, guess_untagged=False)
+        poses['rotation_count'] = self.count_rotations(poses['relative_orientation'])
+        if self.initial_positions:
+            self.guess_untagged(poses, observations)
+        return poses
+
+    def calculate_orientation(self, positions_orientations, box_pose=None):
+        if box_pose is not None:
+            # Rigid-body pose of the whole box: its centre, the bearing of the
+            # centre and the angle of the face pointing at the camera
+            rvec, tvec, _, _ = box_pose
+            position = tvec.flatten()
+            relative_orientation = self.box_model.facing_angle(rvec, tvec)
+            self.count_rotations([relative_orientation if relative_orientation is not None else np.nan])
+            return position, self.bearing_degrees(position), relative_orientation
 
-    def determine_orientation(self, positions_orientations):
-        if len(positions_orientations) == 0:
-            return None, None
-
-        tag_positions = []
-        for _, pos, _, _ in positions_orientations:
-            if pos is not None:
-                tag_positions.append(pos)
-
-        tag_positions = np.array(tag_positions)
-
-        if tag_positions.size == 0:
-            return None, None
-
-        avg_position = np.mean(tag_positions, axis=0)
-        orientation = np.arctan2(avg_position[1], avg_position[0])
-        return avg_position, orientation
-    
-    def calculate_orientation(self, positions_orientations):
         if not self.initial_positions:
             return None, None, None
 
-        avg_position, orientation = self.determine_orientation(positions_orientations)
-        orientation_degrees = None
-        relative_orientation = None
-        if orientation is not None:
-            orientation_degrees = np.degrees(orientation)
-            if orientation_degrees < 0:
-                orientation_degrees += 360
-        # Calculate relative orientation based on detected tags
-        relative_orientation = self.calculate_relative_orientation(positions_orientations)
-
-        return avg_position, orientation_degrees, relative_orientation  
+        # The live path is a batch of one frame
+        pose = self.calculate_orientations(make_observations(positions_orientations), 1)[0]
+        avg_position = pose['position'].copy() if not np.isnan(pose['orientation']) else None
+        orientation_degrees = float(pose['orientation']) if avg_position is not None else None
+        relative_orientation = float(pose['relative_orientation']) if not np.isnan(pose['relative_orientation']) else None
+        return avg_position, orientation_degrees, relative_orientation
 
     def calculate_relative_orientation(self, positions_orientations):
         if not self.initial_positions:
             return None
+        relative_orientation = self.estimate_poses(make_observations(positions_orientations), 1)['relative_orientation'][0]
+        return float(relative_orientation) if not np.isnan(relative_orientation) else None
 
-        initial_tags = set(self.initial_positions.keys())
-
-        # If no tags are detected, guess that we are facing the top face
-        if not positions_orientations:
-            return 0  # Assuming 0 degrees for top face
-
-        relative_orientation = None
-
-        # Determine relative orientation based on tag relationships
-        for tag_id, current_position, current_tvec, current_orientation in positions_orientations:
-            if current_position is None:
-                continue
-
-            for initial_tag, (related_tag, angle) in self.tag_relationships.items():
-                if tag_id == initial_tag and related_tag in initial_tags:
-                    initial_position = np.array(self.initial_positions[related_tag]['position'])
-                    current_position = np.array(current_position)
-
-                    # Calculate the angle between the initial and current position
-                    vector_initial = initial_position - np.array([0, 0, 0])
-                    vector_current = current_position - np.array([0, 0, 0])
-                    dot_product = np.dot(vector_initial, vector_current)
-                    magnitude_initial = np.linalg.norm(vector_initial)
-                    magnitude_current = np.linalg.norm(vector_current)
-                    angle_between = np.arccos(dot_product / (magnitude_initial * magnitude_current))
-                    angle_between_degrees = np.degrees(angle_between)
-
-                    # Calculate the relative orientation
-                    relative_orientation = (self.initial_positions[related_tag]['orientation'] + angle + angle_between_degrees) % 360
-                    break
-
-        # Handle tags on the same face
-        for face, tags in self.face_tags.items():
-            for tag1, tag2 in zip(tags.values(), tags.values()):
-                if tag1 in initial_tags and tag2 == tag_id:
-                    initial_position = np.array(self.initial_positions[tag1]['position'])
-                    current_position = np.array(current_position)
-
-                    # Calculate the angle between the initial and current position
-                    vector_initial = initial_position - np.array([0, 0, 0])
-                    vector_current = current_position - np.array([0, 0, 0])
-                    dot_product = np.dot(vector_initial, vector_current)
-                    magnitude_initial = np.linalg.norm(vector_initial)
-                    magnitude_current = np.linalg.norm(vector_current)
-                    angle_between = np.arccos(dot_product / (magnitude_initial * magnitude_current))
-                    angle_between_degrees = np.degrees(angle_between)
-
-                    # Calculate the relative orientation
-                    relative_orientation = (self.initial_positions[tag1]['orientation'] + angle_between_degrees) % 360
-                    break
-
-        return relative_orientation
+    @staticmethod
+    def bearing_degrees(position):
+        if position is None:
+            return None
+        return float(np.degrees(np.arctan2(position[1], position[0])) % 360)
 
     def get_orientation_from_tags(self, detections):
         orientations = [d.orientation for d in detections if d.orientation is not None]
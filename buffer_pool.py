@@ -0,0 +1,91 @@
+import threading
+import numpy as np
+
+class BufferPool:
+    # Reusable frame-sized arrays, so a long run stops allocating once every
+    # shape it needs has been seen.
+    #
+    # scratch(key, ...) returns the same array on every call for that key;
+    # it belongs to the caller and is only valid until the next call with
+    # the same key. acquire(...) leases an array that can be handed to other
+    # threads: every holder calls release once it is done, retain adds a
+    # holder, and the array goes back to the pool when the last one lets go.
+    def __init__(self, max_free=4, metrics=None, name='buffer_pool'):
+        self.max_free = max_free  # Spare arrays kept per shape
+        self.name = name
+        self.lock = threading.Lock()
+        self.scratch_buffers = {}
+        self.free = {}  # (shape, dtype) -> spare arrays
+        self.leases = {}  # id(array) -> [array, holders]
+        self.allocations = 0
+        self.reuses = 0
+        self.discarded = 0
+        if metrics is not None:
+            metrics.add_collector(self.collect_metrics)
+
+    def collect_metrics(self):
+        stats = self.stats()
+        return {f'{self.name}_{key}': value for key, value in stats.items()}
+
+    def allocate(self, shape, dtype):
+        self.allocations += 1
+        return np.empty(shape, dtype=dtype)
+
+    def scratch(self, key, shape, dtype=np.uint8):
+        shape = tuple(shape)
+        dtype = np.dtype(dtype)
+        with self.lock:
+            array = self.scratch_buffers.get(key)
+            if array is None or array.shape != shape or array.dtype != dtype:
+                array = self.allocate(shape, dtype)
+                self.scratch_buffers[key] = array
+            else:
+                self.reuses += 1
+            return array
+
+    def acquire(self, shape, dtype=np.uint8, holders=1):
+        key = (tuple(shape), np.dtype(dtype))
+        with self.lock:
+            spare = self.free.get(key)
+            if spare:
+                array = spare.pop()
+                self.reuses += 1
+            else:
+                array = self.allocate(*key)
+            self.leases[id(array)] = [array, holders]
+            return array
+
+    def retain(self, array):
+        with self.lock:
+            lease = self.leases.get(id(array))
+            if lease is not None:
+                lease[1] += 1
+
+    def release(self, array):
+        # Arrays that did not come from acquire are ignored, so consumers can
+        # release whatever they were handed
+        if array is None:
+            return
+        with self.lock:
+            lease = self.leases.get(id(array))
+            if lease is None or lease[0] is not array:
+                return
+            lease[1] -= 1
+            if lease[1] > 0:
+                return
+            del self.leases[id(array)]
+            spare = self.free.setdefault((array.shape, array.dtype), [])
+            if len(spare) < self.max_free:
+                spare.append(array)
+            else:
+                self.discarded += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'allocations': self.allocations,
+                'reuses': self.reuses,
+                'leased': len(self.leases),
+                'free': sum(len(spare) for spare in self.free.values()),
+                'discarded': self.discarded,
+            }
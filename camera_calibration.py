@@ -4,6 +4,8 @@ import glob
 import json
 import os
 import argparse
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
 from camera_thread import CameraThread
 
 def load_config(config_path='config.json'):
@@ -22,7 +24,81 @@ def load_config(config_path='config.json'):
         print(f"Configuration file {config_path} not found. Using default settings.")
     return config
 
-def capture_images(save_dir, num_images=30, chessboard_size=(9, 6), zoom=1.0, live=False):
+class CaptureCoverage:
+    # Tracks the board poses accepted so far, which parts of the image they
+    # cover and the reprojection error of a calibration from them
+    def __init__(self, chessboard_size, image_size, grid=(8, 6), min_pose_change=0.05, min_images=10,
+                 target_coverage=0.8, max_error=1.0):
+        self.chessboard_size = chessboard_size
+        self.image_size = np.array(image_size, dtype=np.float32)
+        self.grid = np.zeros((grid[1], grid[0]), dtype=bool)
+        self.min_pose_change = min_pose_change
+        self.min_images = min_images
+        self.target_coverage = target_coverage
+        self.max_error = max_error
+        self.objp = np.zeros((chessboard_size[0] * chessboard_size[1], 3), np.float32)
+        self.objp[:, :2] = np.mgrid[0:chessboard_size[0], 0:chessboard_size[1]].T.reshape(-1, 2)
+        self.poses = []
+        self.imgpoints = []
+        self.error = None
+
+    def pose_descriptor(self, corners):
+        # The four outer corners in normalized image coordinates capture the
+        # board's position, size, tilt and rotation
+        cols = self.chessboard_size[0]
+        outer = corners.reshape(-1, 2)[[0, cols - 1, -cols, -1]]
+        return (outer / self.image_size).ravel()
+
+    def cells(self, corners):
+        grid_height, grid_width = self.grid.shape
+        points = corners.reshape(-1, 2) / self.image_size * (grid_width, grid_height)
+        cells = np.zeros_like(self.grid)
+        cells[np.clip(points[:, 1].astype(int), 0, grid_height - 1), np.clip(points[:, 0].astype(int), 0, grid_width - 1)] = True
+        return cells
+
+    def rejection_reason(self, corners):
+        if not self.poses:
+            return None
+        pose_change = np.abs(np.array(self.poses) - self.pose_descriptor(corners)).max(axis=1).min()
+        if pose_change < self.min_pose_change:
+            return f"too similar to an accepted pose (change {pose_change:.3f})"
+        return None
+
+    def add(self, corners):
+        self.poses.append(self.pose_descriptor(corners))
+        self.grid |= self.cells(corners)
+        self.imgpoints.append(corners)
+        if len(self.imgpoints) >= 3:
+            # The RMS error in pixels does not depend on the square size
+            self.error, *_ = cv.calibrateCamera([self.objp] * len(self.imgpoints), self.imgpoints,
+                                                tuple(int(v) for v in self.image_size), None, None)
+
+    @property
+    def coverage(self):
+        return float(self.grid.mean())
+
+    def complete(self):
+        return (len(self.imgpoints) >= self.min_images and self.coverage >= self.target_coverage
+                and self.error is not None and self.error <= self.max_error)
+
+    def status(self):
+        error = f"{self.error:.3f}" if self.error is not None else "n/a"
+        return f"coverage {self.coverage:.0%}, reprojection error {error}"
+
+def screen_chessboard(gray, chessboard_size, max_width=640):
+    # Cheap pre-screen: FAST_CHECK on a downscaled frame rejects frames
+    # without a board almost immediately. Returns the coarse corners in
+    # full-resolution coordinates, or None.
+    scale = min(1.0, max_width / gray.shape[1])
+    small = cv.resize(gray, None, fx=scale, fy=scale, interpolation=cv.INTER_AREA) if scale < 1.0 else gray
+    flags = cv.CALIB_CB_ADAPTIVE_THRESH | cv.CALIB_CB_NORMALIZE_IMAGE | cv.CALIB_CB_FAST_CHECK
+    found, corners = cv.findChessboardCorners(small, chessboard_size, flags=flags)
+    if not found:
+        return None
+    return ((corners + 0.5) / scale - 0.5).astype(np.float32)
+
+def capture_images(save_dir, num_images=30, chessboard_size=(9, 6), zoom=1.0, live=False, smart=False, coverage_options=None,
+                   screen_width=640):
     camera_thread = CameraThread()
     camera_thread.start()
 
@@ -32,12 +108,16 @@ def capture_images(save_dir, num_images=30, chessboard_size=(9, 6), zoom=1.0, li
     os.makedirs(debug_dir, exist_ok=True)
 
     image_count = 0
+    last_sequence = -1
     criteria = (cv.TERM_CRITERIA_EPS + cv.TERM_CRITERIA_MAX_ITER, 30, 0.001)
+    coverage = None
 
     try:
         while image_count < num_images:
-            if camera_thread.frame_ready.wait(1):
-                frame = camera_thread.frame
+            result = camera_thread.get_frame(last_sequence, latest=True, timeout=1)
+            if result is not None:
+                last_sequence, _, raw_frame = result
+                frame = raw_frame
 
                 # Apply zoom factor
                 if zoom != 1.0:
@@ -48,25 +128,46 @@ def capture_images(save_dir, num_images=30, chessboard_size=(9, 6), zoom=1.0, li
                                   (new_size[0] - width) // 2:(new_size[0] + width) // 2]
 
                 gray = cv.cvtColor(frame, cv.COLOR_BGR2GRAY)
-                ret, corners = cv.findChessboardCorners(gray, chessboard_size, None)
+                if smart:
+                    # Refine the coarse corners directly instead of searching the full frame again
+                    corners = screen_chessboard(gray, chessboard_size, screen_width)
+                    ret = corners is not None
+                else:
+                    ret, corners = cv.findChessboardCorners(gray, chessboard_size, None)
 
+                reason = None
                 if ret:
                     corners2 = cv.cornerSubPix(gray, corners, (11, 11), (-1, -1), criteria)
+                    if smart:
+                        if coverage is None:
+                            coverage = CaptureCoverage(chessboard_size, gray.shape[::-1], **(coverage_options or {}))
+                        reason = coverage.rejection_reason(corners2)
                     cv.drawChessboardCorners(frame, chessboard_size, corners2, ret)
 
+                if ret and reason is None:
                     if live:
                         cv.imshow('Chessboard', frame)
                         cv.waitKey(1)
 
                     raw_image_path = os.path.join(raw_dir, f'chessboard_{image_count}.png')
                     debug_image_path = os.path.join(debug_dir, f'chessboard_{image_count}.png')
-                    cv.imwrite(raw_image_path, camera_thread.frame)  # Save the raw image
+                    cv.imwrite(raw_image_path, raw_frame)  # Save the raw image
                     cv.imwrite(debug_image_path, frame)  # Save the image with drawn lines
                     print(f"Saved raw image {image_count + 1}/{num_images}: {raw_image_path}")
                     print(f"Saved debug image {image_count + 1}/{num_images}: {debug_image_path}")
                     image_count += 1
+
+                    if coverage is not None:
+                        coverage.add(corners2)
+                        print(f"Accepted pose {image_count}: {coverage.status()}")
+                        if coverage.complete():
+                            print("Coverage target reached, stopping capture.")
+                            break
                 else:
-                    print(f"Chessboard not detected in image {image_count + 1}")
+                    if ret:
+                        print(f"Skipping frame: {reason}")
+                    else:
+                        print(f"Chessboard not detected in image {image_count + 1}")
                     if live:
                         cv.imshow('Chessboard', frame)
                         if cv.waitKey(1) & 0xFF == ord('q'):
@@ -76,12 +177,71 @@ def capture_images(save_dir, num_images=30, chessboard_size=(9, 6), zoom=1.0, li
         print("Interrupted by user")
     finally:
         camera_thread.stop()
-        cv.destroyAllWindows()
-
-def calibrate_camera(image_dir, chessboard_size=(9, 6), square_size=20, zoom=1.0):
+        if live:
+            cv.destroyAllWindows()
+
+def file_hash(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def detect_chessboard(fname, chessboard_size):
+    # Runs in a worker process. Returns (found, corners, image_size).
     # termination criteria
     criteria = (cv.TERM_CRITERIA_EPS + cv.TERM_CRITERIA_MAX_ITER, 30, 0.001)
 
+    img = cv.imread(fname)
+    if img is None:
+        return None, None, None
+
+    gray = cv.cvtColor(img, cv.COLOR_BGR2GRAY)
+
+    # Apply adaptive thresholding
+    gray = cv.adaptiveThreshold(gray, 255, cv.ADAPTIVE_THRESH_GAUSSIAN_C, cv.THRESH_BINARY, 11, 2)
+
+    # Find the chess board corners
+    ret, corners = cv.findChessboardCorners(gray, chessboard_size, None)
+    if not ret:
+        return False, None, gray.shape[::-1]
+
+    corners2 = cv.cornerSubPix(gray, corners, (11, 11), (-1, -1), criteria)
+    return True, corners2.reshape(-1, 2).tolist(), gray.shape[::-1]
+
+def load_corner_cache(cache_path):
+    if os.path.exists(cache_path):
+        with open(cache_path, 'r') as file:
+            return json.load(file)
+    return {}
+
+def save_corner_cache(cache, cache_path):
+    temp_path = cache_path + '.tmp'
+    with open(temp_path, 'w') as file:
+        json.dump(cache, file)
+    os.replace(temp_path, cache_path)
+
+def find_corners(images, chessboard_size, cache_path=None, workers=None):
+    # Corner results are cached per image content and board size, so only
+    # new or changed images are searched again
+    cache = load_corner_cache(cache_path) if cache_path else {}
+    keys = {fname: f"{file_hash(fname)}-{chessboard_size[0]}x{chessboard_size[1]}" for fname in images}
+    missing = [fname for fname in images if keys[fname] not in cache]
+    print(f"{len(images) - len(missing)} images cached, detecting corners in {len(missing)}.")
+
+    if missing:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for fname, (found, corners, image_size) in zip(missing, executor.map(detect_chessboard, missing, [chessboard_size] * len(missing))):
+                if found is None:
+                    print(f"Failed to load image {fname}")
+                    continue
+                cache[keys[fname]] = {'found': found, 'corners': corners, 'image_size': image_size}
+        if cache_path:
+            save_corner_cache(cache, cache_path)
+
+    return {fname: cache[keys[fname]] for fname in images if keys[fname] in cache}
+
+def calibrate_camera(image_dir, chessboard_size=(9, 6), square_size=20, zoom=1.0, flags=0, images=None, workers=None, show=False):
     # prepare object points
     objp = np.zeros((chessboard_size[0] * chessboard_size[1], 3), np.float32)
     objp[:, :2] = np.mgrid[0:chessboard_size[0], 0:chessboard_size[1]].T.reshape(-1, 2) * square_size * zoom
@@ -90,40 +250,34 @@ def calibrate_camera(image_dir, chessboard_size=(9, 6), square_size=20, zoom=1.0
     objpoints = []  # 3d point in real world space
     imgpoints = []  # 2d points in image plane.
 
-    images = glob.glob(os.path.join(image_dir, 'raw', '*.png'))
+    if images is None:
+        images = sorted(glob.glob(os.path.join(image_dir, 'raw', '*.png')))
     print(f"Found {len(images)} images for calibration.")
 
-    for fname in images:
-        img = cv.imread(fname)
-        if img is None:
-            print(f"Failed to load image {fname}")
-            continue
-
-        gray = cv.cvtColor(img, cv.COLOR_BGR2GRAY)
-
-        # Apply adaptive thresholding
-        gray = cv.adaptiveThreshold(gray, 255, cv.ADAPTIVE_THRESH_GAUSSIAN_C, cv.THRESH_BINARY, 11, 2)
-
-        # Find the chess board corners
-        ret, corners = cv.findChessboardCorners(gray, chessboard_size, None)
-
-        if ret:
+    results = find_corners(images, chessboard_size, os.path.join(image_dir, 'corner_cache.json'), workers)
+    image_size = None
+    for fname, result in results.items():
+        if result['found']:
+            corners2 = np.array(result['corners'], dtype=np.float32).reshape(-1, 1, 2)
             objpoints.append(objp)
-            corners2 = cv.cornerSubPix(gray, corners, (11, 11), (-1, -1), criteria)
             imgpoints.append(corners2)
-
-            # Draw and display the corners for debugging purposes
-            cv.drawChessboardCorners(img, chessboard_size, corners2, ret)
-            cv.imshow('img', img)
-            cv.waitKey(500)
+            image_size = tuple(result['image_size'])
+
+            if show:
+                # Draw and display the corners for debugging purposes
+                img = cv.imread(fname)
+                cv.drawChessboardCorners(img, chessboard_size, corners2, True)
+                cv.imshow('img', img)
+                cv.waitKey(500)
         else:
             print(f"Failed to detect chessboard in {fname}")
 
-    cv.destroyAllWindows()
+    if show:
+        cv.destroyAllWindows()
 
     if len(objpoints) > 0 and len(imgpoints) > 0:
         print(f"Number of valid images: {len(objpoints)}")
-        ret, camera_matrix, dist_coeffs, rvecs, tvecs = cv.calibrateCamera(objpoints, imgpoints, gray.shape[::-1], None, None)
+        ret, camera_matrix, dist_coeffs, rvecs, tvecs = cv.calibrateCamera(objpoints, imgpoints, image_size, None, None, flags=flags)
         print(f"Calibration reprojection error: {ret}")
 
         return camera_matrix, dist_coeffs, rvecs, tvecs, ret
@@ -131,9 +285,22 @@ def calibrate_camera(image_dir, chessboard_size=(9, 6), square_size=20, zoom=1.0
         print("Calibration failed: No valid chessboard corners were found.")
         return None, None, None, None, None
 
+def parse_calibration_flags(names):
+    # e.g. "CALIB_FIX_K3,CALIB_ZERO_TANGENT_DIST"
+    flags = 0
+    for name in filter(None, (name.strip() for name in names.split(','))):
+        flags |= getattr(cv, name)
+    return flags
+
 def main():
     parser = argparse.ArgumentParser(description="Camera Calibration")
     parser.add_argument("-l", "--live", action="store_true", help="Show live video feed")
+    parser.add_argument("--capture-all", action="store_true", help="Save every frame with a board instead of only new poses")
+    parser.add_argument("--skip-capture", action="store_true", help="Calibrate from the images already in calibration_images/raw")
+    parser.add_argument("--show", action="store_true", help="Show the detected corners of every image")
+    parser.add_argument("-w", "--workers", type=int, default=None, help="Corner detection worker processes (default: CPU count)")
+    parser.add_argument("--flags", type=str, default="", help="Comma-separated cv2 calibration flags, e.g. CALIB_FIX_K3")
+    parser.add_argument("--max-images", type=int, default=None, help="Only calibrate from the first N images")
     args = parser.parse_args()
 
     config = load_config()
@@ -145,10 +312,25 @@ def main():
 
     live = args.live if args.live is not None else False
 
-    capture_images(save_dir, num_images, chessboard_size, zoom=zoom, live=live)
+    if not args.skip_capture:
+        coverage_options = {
+            "grid": tuple(config.get("capture_coverage_grid", [8, 6])),
+            "min_pose_change": config.get("capture_min_pose_change", 0.05),
+            "min_images": config.get("capture_min_images", 10),
+            "target_coverage": config.get("capture_target_coverage", 0.8),
+            "max_error": config.get("capture_max_error", 1.0),
+        }
+        capture_images(save_dir, num_images, chessboard_size, zoom=zoom, live=live, smart=not args.capture_all,
+                       coverage_options=coverage_options, screen_width=config.get("capture_screen_width", 640))
+
+    images = sorted(glob.glob(os.path.join(save_dir, 'raw', '*.png')), key=lambda f: int(''.join(filter(str.isdigit, os.path.basename(f))) or 0))
+    if args.max_images is not None:
+        images = images[:args.max_images]
 
     print("Calibrating camera...")
-    camera_matrix, dist_coeffs, rvecs, tvecs, error = calibrate_camera(save_dir, chessboard_size, square_size, zoom=zoom)
+    camera_matrix, dist_coeffs, rvecs, tvecs, error = calibrate_camera(save_dir, chessboard_size, square_size, zoom=zoom,
+                                                                       flags=parse_calibration_flags(args.flags), images=images,
+                                                                       workers=args.workers, show=args.show)
 
     if camera_matrix is not None and dist_coeffs is not None:
         print("Camera calibration complete.")
@@ -4,131 +4,644 @@ import cv2
 import queue
 import os
 import logging
-import json
 import numpy as np
+from multiprocessing import shared_memory
+from frame_sources import CameraSource, to_bgr, is_bgr
+from buffer_pool import BufferPool
+from run_data_writer import RunDataWriter
+from image_writer import ImageWriterPool
+from multi_camera import CameraExtrinsics
+
+class FrameRingBuffer:
+    def __init__(self, size=4, shared=False):
+        self.size = size
+        self.shared = shared  # Back the slots with shared memory for detection worker processes
+        self.shared_memory = None
+        self.frames = None  # Preallocated on the first frame, once the shape is known
+        self.sequences = [-1] * size  # -1 marks an empty slot or one being written
+        self.timestamps = [0.0] * size
+        self.pins = [0] * size  # Pinned slots are never overwritten
+        self.write_slot = None
+        self.latest_sequence = -1
+        self.dropped_frames = 0
+        # Set when a consumer has asked for a frame newer than the latest one,
+        # lets an on-demand producer skip decoding frames nobody will read
+        self.demand = True
+        self.condition = threading.Condition()
+
+    def allocate(self, shape, dtype):
+        shape = (self.size,) + shape
+        if self.shared:
+            nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+            self.shared_memory = shared_memory.SharedMemory(create=True, size=nbytes)
+            self.frames = np.ndarray(shape, dtype=dtype, buffer=self.shared_memory.buf)
+        else:
+            self.frames = np.empty(shape, dtype=dtype)
+
+    def claim_slot(self):
+        # Reuse the oldest unpinned slot, invalidating it first so no
+        # consumer reads it mid-write
+        free = [slot for slot in range(self.size) if self.pins[slot] == 0]
+        if not free:
+            return None
+        slot = min(free, key=lambda slot: self.sequences[slot])
+        self.sequences[slot] = -1
+        return slot
+
+    def begin_write(self):
+        with self.condition:
+            if self.frames is None:
+                return None
+            self.write_slot = self.claim_slot()
+            return self.frames[self.write_slot] if self.write_slot is not None else None
+
+    def commit_write(self, frame, timestamp):
+        with self.condition:
+            if self.frames is None:
+                self.allocate(frame.shape, frame.dtype)
+            slot = self.write_slot if self.write_slot is not None else self.claim_slot()
+            self.write_slot = None
+            if slot is None:
+                # Every slot is held by a consumer
+                self.dropped_frames += 1
+                return
+            if not np.may_share_memory(frame, self.frames[slot]):
+                np.copyto(self.frames[slot], frame)
+            self.latest_sequence += 1
+            self.sequences[slot] = self.latest_sequence
+            self.timestamps[slot] = timestamp
+            self.demand = False
+            self.condition.notify_all()
+
+    def find_slot(self, last_sequence, latest, timeout):
+        # Block until a frame newer than last_sequence is available. With
+        # latest=True intermediate frames are skipped, otherwise the oldest
+        # frame still held after last_sequence is returned.
+        newer = lambda: [slot for slot in range(self.size) if self.sequences[slot] > last_sequence]
+        if last_sequence >= self.latest_sequence:
+            self.demand = True
+        if not self.condition.wait_for(newer, timeout):
+            return None
+        key = lambda slot: self.sequences[slot]
+        return max(newer(), key=key) if latest else min(newer(), key=key)
+
+    def get(self, last_sequence=-1, latest=True, timeout=None, out=None):
+        with self.condition:
+            slot = self.find_slot(last_sequence, latest, timeout)
+            if slot is None:
+                return None
+            if out is None:
+                out = self.frames[slot].copy()
+            else:
+                np.copyto(out, self.frames[slot])
+            return self.sequences[slot], self.timestamps[slot], out
+
+    def acquire(self, last_sequence=-1, latest=True, timeout=None):
+        # Like get, but pins the slot instead of copying it. The frame stays
+        # valid in self.frames[slot] until release(slot) is called.
+        with self.condition:
+            slot = self.find_slot(last_sequence, latest, timeout)
+            if slot is None:
+                return None
+            self.pins[slot] += 1
+            return self.sequences[slot], self.timestamps[slot], slot
+
+    def release(self, slot):
+        with self.condition:
+            self.pins[slot] -= 1
+
+    def close(self):
+        if self.shared_memory is not None:
+            self.frames = None
+            self.shared_memory.close()
+            self.shared_memory.unlink()
+            self.shared_memory = None
 
 class CameraThread(threading.Thread):
-    def __init__(self, camera_index=0):
+    def __init__(self, camera_index=0, buffer_size=4, shared=False, source=None, metrics=None, on_demand=False, camera_label=None):
         threading.Thread.__init__(self)
-        self.cap = cv2.VideoCapture(camera_index)
-        self.ret = False
-        self.frame = None
-        self.frame_ready = threading.Event()
+        self.metric_prefix = f'{camera_label}_' if camera_label else ''  # Keeps several cameras' gauges apart
+        self.source = source if source is not None else CameraSource(camera_index)
+        self.buffer = FrameRingBuffer(buffer_size, shared)
+        self.frame_ready = threading.Event()  # Set once the first frame is captured
+        self.metrics = metrics
+        # Grab every frame to keep the driver queue empty, but only decode
+        # one once a consumer has caught up and is waiting for it
+        self.on_demand = on_demand
+        self.flush_requested = True  # Drop whatever queued up while the camera was opening
+        fps = getattr(self.source, 'fps', None)  # Live cameras only, replays never skip frames
+        self.frame_period = 1.0 / fps if fps else None
+        self.frames_grabbed = 0
+        self.frames_decoded = 0
         self.running = True
+        if metrics is not None:
+            metrics.add_collector(self.collect_metrics)
+
+    def collect_metrics(self):
+        gauges = {
+            'frames_captured': self.buffer.latest_sequence + 1,
+            'frames_grabbed': self.frames_grabbed,
+            'frames_decoded': self.frames_decoded,
+            'frames_flushed': self.source.flushed_frames,
+            'frame_buffer_dropped_frames': self.buffer.dropped_frames,
+            'frame_buffer_pinned_slots': sum(1 for pins in self.buffer.pins if pins > 0),
+        }
+        return {f'{self.metric_prefix}{key}': value for key, value in gauges.items()}
+
+    def request_flush(self):
+        # Consumers call this after a stall, so the next frame is a fresh one
+        # rather than whatever the driver kept queued
+        self.flush_requested = True
 
     def run(self):
-        while self.running:
-            self.ret, self.frame = self.cap.read()
-            if self.ret:
-                self.frame_ready.set()
-            time.sleep(0.01)
+        try:
+            while self.running:
+                grab_start = time.perf_counter()
+                if self.flush_requested:
+                    self.flush_requested = False
+                    ret = self.source.flush()
+                else:
+                    ret = self.source.grab()
+                capture_time = time.time()
+                if self.metrics is not None:
+                    self.metrics.observe('capture', time.perf_counter() - grab_start)
+                if not ret:
+                    if self.source.finished:
+                        logging.info("Frame source finished.")
+                        break
+                    continue
+                self.frames_grabbed += 1
+                if self.on_demand and not self.buffer.demand:
+                    continue
+
+                slot = self.buffer.begin_write()
+                decode_start = time.perf_counter()
+                ret, frame = self.source.retrieve(slot)
+                decode_time = time.perf_counter() - decode_start
+                if self.metrics is not None:
+                    self.metrics.observe('decode', decode_time)
+                if self.frame_period is not None and decode_time > self.frame_period:
+                    # The driver kept queueing while we decoded, skip ahead
+                    self.flush_requested = True
+                if ret:
+                    self.frames_decoded += 1
+                    self.buffer.commit_write(frame, capture_time)
+                    self.frame_ready.set()
+        finally:
+            self.source.release()
+            self.frame_ready.set()  # Don't leave anyone waiting on an empty source
+
+    def get_frame(self, last_sequence=-1, latest=True, timeout=None, out=None):
+        return self.buffer.get(last_sequence, latest, timeout, out)
 
     def stop(self):
         self.running = False
-        self.cap.release()
 
 class DisplayThread(threading.Thread):
-    def __init__(self, camera_thread, detector, live, display_queue):
+    def __init__(self, camera_thread, detector, live, display_queue, undistort=False, preview_server=None, buffer_pool=None):
         threading.Thread.__init__(self)
         self.camera_thread = camera_thread
         self.detector = detector
         self.live = live
+        self.undistort = undistort  # Show undistorted frames, zoom and undistortion in one remap
+        self.preview_server = preview_server  # Headless alternative to the window
+        # Annotated frames on the display queue are leased from this pool, it
+        # must be the detection thread's
+        self.buffer_pool = buffer_pool if buffer_pool is not None else BufferPool()
         self.running = True
         self.display_queue = display_queue
 
     def run(self):
+        frame_buffer = self.camera_thread.buffer
+        last_sequence = -1
         while self.running:
-            if self.camera_thread.frame_ready.wait(1):
-                frame = self.camera_thread.frame
-                if self.live:
-                    zoomed_frame = self.detector.apply_digital_zoom(frame)  # Apply zoom to the frame
-                    cv2.imshow('AprilTag Detection', zoomed_frame)
-                    if cv2.waitKey(1) & 0xFF == ord('q'):
-                        self.running = False
-                        break
+            if not self.live and (self.preview_server is None or not self.preview_server.wants_frame()):
+                # Nobody is looking, don't ask the camera for frames (an
+                # on-demand camera would decode them) and just wait for
+                # annotated frames
+                try:
+                    self.show_annotated(self.display_queue.get(timeout=0.1))
+                except queue.Empty:
+                    pass
+                continue
+            # Show straight out of the pinned ring buffer slot, no copy
+            result = frame_buffer.acquire(last_sequence, latest=True, timeout=1)
+            if result is not None:
+                last_sequence, _, slot = result
+                try:
+                    self.show_frame(frame_buffer.frames[slot])
+                finally:
+                    frame_buffer.release(slot)
 
                 if not self.display_queue.empty():
-                    frame_with_detections = self.display_queue.get()
-                    if self.live:
-                        cv2.imshow('AprilTag Detection', frame_with_detections)
-                        if cv2.waitKey(1) & 0xFF == ord('q'):
-                            self.running = False
-                            break
+                    self.show_annotated(self.display_queue.get())
+
+    def show_frame(self, frame):
+        if not is_bgr(frame):
+            # Gray captures are only converted for viewing
+            frame = to_bgr(frame, self.buffer_pool.scratch('display_bgr', frame.shape[:2] + (3,)))
+        if self.live:
+            zoom_buffer = self.buffer_pool.scratch('display_zoom', frame.shape, frame.dtype)
+            if self.undistort:
+                zoomed_frame = self.detector.undistorted_zoom(frame, zoom_buffer)
+            else:
+                # Apply zoom to the frame, at zoom 1 imshow can read the slot itself
+                zoomed_frame = self.detector.apply_digital_zoom(frame, zoom_buffer if self.detector.zoom != 1.0 else None)
+            self.show(zoomed_frame)
+        elif self.preview_server is not None and self.preview_server.wants_frame():
+            if self.undistort:
+                self.preview_server.publish(self.detector.undistorted_zoom(frame, self.buffer_pool.scratch('display_zoom', frame.shape, frame.dtype)))
+            else:
+                # Scale the crop straight to the size the preview shrinks the
+                # full-size annotated frames to, so the stream doesn't change
+                # size between raw and annotated frames
+                height, width = frame.shape[:2]
+                preview_width = min(width, self.preview_server.max_width)
+                size = (preview_width, round(height * preview_width / width))
+                preview_frame = self.buffer_pool.scratch('preview_zoom', (size[1], size[0]) + frame.shape[2:], frame.dtype)
+                cv2.resize(self.detector.crop_to_zoom(frame), size, dst=preview_frame, interpolation=cv2.INTER_LINEAR)
+                self.preview_server.publish(preview_frame)
+
+    def show_annotated(self, frame):
+        try:
+            self.show(frame)
+        finally:
+            self.buffer_pool.release(frame)
+
+    def show(self, frame):
+        if self.preview_server is not None:
+            self.preview_server.publish(frame)
+        if self.live:
+            cv2.imshow('AprilTag Detection', frame)
+            if cv2.waitKey(1) & 0xFF == ord('q'):
+                self.running = False
 
     def stop(self):
         self.running = False
 
 class DetectionThread(threading.Thread):
-    def __init__(self, camera_thread, detector, display_queue, print_delay, save, run_dir, save_data, data_dir, box_position):
+    def __init__(self, camera_thread, detector, display_queue, print_delay, save, run_dir, save_data, data_dir, box_position, latest_only=True, detection_pool=None, metrics=None,
+                 run_data_writer=None, record_every_frame=False, image_writer=None,
+                 video_recorder=None, undistort=False, pose_filter=None, detection_interval=0.0, motion_gate=None,
+                 buffer_pool=None, camera_id=0, fusion=None, extrinsics=None, camera_label=None):
         threading.Thread.__init__(self)
         self.camera_thread = camera_thread
         self.detector = detector
-        self.display_queue = display_queue
+        self.display_queue = display_queue  # None for cameras that are not displayed
         self.print_delay = print_delay
         self.save = save
         self.run_dir = run_dir
         self.save_data = save_data
         self.data_dir = data_dir
         self.box_position = box_position
+        self.latest_only = latest_only  # Skip to the newest frame, or process every buffered frame
+        self.detection_pool = detection_pool  # Detect in worker processes instead of on this thread
+        self.metrics = metrics
         self.running = True
         self.image_count = 0
-        self.run_data = []
-        self.last_save_time = time.time()
+        self.last_sequence = -1
+        # Annotated frames are leased from the pool and released by every
+        # consumer they are handed to (display, image writer, recorder), so
+        # those must share this pool
+        self.buffer_pool = buffer_pool if buffer_pool is not None else BufferPool()
+        self.skipped_frames = 0
+        # Records are appended by a background writer, one per print_delay or
+        # one per processed frame
+        if save_data and run_data_writer is None:
+            run_data_writer = RunDataWriter(data_dir, metrics=metrics)
+            run_data_writer.start()
+        self.run_data_writer = run_data_writer if save_data else None
+        self.record_every_frame = record_every_frame
+
+        # Images are encoded and written off the detection thread
+        if save and image_writer is None:
+            image_writer = ImageWriterPool(metrics=metrics, buffer_pool=self.buffer_pool)
+            image_writer.start()
+        self.image_writer = image_writer
+        self.video_recorder = video_recorder  # Records every processed frame when set
+        self.undistort = undistort  # Annotate undistorted frames for display, saving and recording
+        # With a pose filter, detection only runs every detection_interval
+        # seconds and the frames in between get the filter's prediction
+        self.pose_filter = pose_filter
+        self.detection_interval = detection_interval
+        self.last_detection_time = float('-inf')
+        self.predicted_frames = 0
+        # Skips detection while the zoomed view is static, holding the last pose
+        self.motion_gate = motion_gate
+        self.last_pose = (None, None, None)
+        self.report_allocations = 0
+        self.report_sequence = -1
+        self.last_print_time = time.time()
+        # With several cameras, each has its own detection thread and the
+        # pose is estimated from the fusion of all of them, in the reference
+        # camera's frame. box_position and pose_filter are then shared and
+        # only used under fusion.lock.
+        self.camera_id = camera_id
+        self.fusion = fusion
+        self.extrinsics = extrinsics if extrinsics is not None else CameraExtrinsics()
+        self.camera_label = camera_label
+        self.metric_prefix = f'{camera_label}_' if camera_label else ''
+        if metrics is not None:
+            metrics.add_collector(self.collect_metrics)
+
+    def collect_metrics(self):
+        gauges = {
+            'frames_processed': self.last_sequence + 1,
+            'frames_skipped': self.skipped_frames,
+            'detector_buffer_allocations': self.detector_allocations(),
+        }
+        if self.display_queue is not None:
+            gauges['display_queue_depth'] = self.display_queue.qsize()
+        if self.detector.tracking or self.detector.flow_tracking:
+            stats = self.scan_stats()
+            gauges['detection_roi_scans'] = stats['roi']
+            gauges['detection_full_scans'] = stats['full']
+            gauges['detection_flow_frames'] = stats['flow']
+            gauges['detection_flow_dropped'] = stats['flow_dropped']
+        if self.pose_filter is not None:
+            gauges['pose_filter_accepted'] = self.pose_filter.accepted_count
+            gauges['pose_filter_rejected'] = self.pose_filter.rejected_count
+            gauges['frames_predicted'] = self.predicted_frames
+        if self.motion_gate is not None:
+            stats = self.motion_gate.stats()
+            gauges['motion_score'] = stats['score']
+            gauges['motion_active_seconds'] = stats['active_seconds']
+            gauges['motion_idle_seconds'] = stats['idle_seconds']
+        if self.detection_pool is not None:
+            gauges['detection_pool_in_flight'] = self.detection_pool.in_flight(self.camera_id)
+            gauges['detection_pool_fps'] = self.detection_pool.camera_stats()[self.camera_id]['fps']
+            for worker_id, busy in self.detection_pool.utilization().items():
+                gauges[f'detection_worker_{worker_id}_utilization'] = busy
+        if self.fusion is not None:
+            gauges['fused_cameras'] = self.fusion.fused_cameras
+        return {f'{self.metric_prefix}{key}': value for key, value in gauges.items()}
+
+    def scan_stats(self):
+        # With a pool, this thread's detector never runs, the workers' do
+        if self.detection_pool is not None:
+            return self.detection_pool.scan_stats(self.camera_id)
+        return self.detector.scan_stats()
+
+    def detector_allocations(self):
+        if self.detection_pool is not None:
+            return self.detection_pool.buffer_allocations(self.camera_id)
+        return self.detector.buffers.allocations
 
     def run(self):
-        last_print_time = time.time()
+        if self.detection_pool is not None:
+            self.run_pool()
+        else:
+            self.run_local()
+        if self.motion_gate is not None:
+            stats = self.motion_gate.stats()
+            logging.info(f"Motion gate: {stats['active_seconds']:.1f} s active, {stats['idle_seconds']:.1f} s idle "
+                         f"({stats['idle_fraction']:.0%} idle)")
+
+    def run_local(self):
+        # Detect straight out of the pinned ring buffer slot, no copy
+        frame_buffer = self.camera_thread.buffer
+        last_sequence = -1
         while self.running:
-            if self.camera_thread.frame_ready.wait(1):
-                frame = self.camera_thread.frame
-                detections, zoomed_frame = self.detector.detect(frame)
-                positions_orientations = self.detector.get_position_and_orientation(detections)
-                current_position, current_orientation, relative_orientation = self.box_position.calculate_orientation(positions_orientations)
-
-                current_time = time.time()
-                if current_time - last_print_time >= self.print_delay:
-                    for tag_id, position, tvec, orientation in positions_orientations:
-                        pos_str = f"Position: {position}" if position is not None else "Position: N/A"
-                        if tvec is not None:
-                            distance = np.linalg.norm(tvec)
-                            dist_str = f"Distance: {distance:.2f} meters"
-                            logging.info(f"Tag ID: {tag_id}, Position: {position}, Distance: {distance:.2f} meters, Orientation: {orientation}")
-                        else:
-                            dist_str = "Distance: N/A"
-                            logging.info(f"Tag ID: {tag_id}, {pos_str}, {dist_str}")
-                    if current_position is not None:
-                        logging.info(f"Current box position: {current_position}, Old Orientation: {old_orientation} degrees, Relative Orientation: {relative_orientation} degrees")
-                    else:
-                        logging.info(f"Current box position: N/A, Old Orientation: N/A, Relative Orientation: N/A")
-                    logging.info(f"Rotation count: {self.box_position.rotation_count}")
-                    frame_with_detections = self.detector.draw_detections(zoomed_frame, detections)
-                    self.display_queue.put(frame_with_detections)
-
-                    if self.save:
-                        image_path = os.path.join(self.run_dir, f'apriltag_detection_{self.image_count}.png')
-                        cv2.imwrite(image_path, frame_with_detections)
-                        logging.info(f"Saved image: {image_path}")
-                        self.image_count += 1
-
-                    if self.save_data:
-                        self.run_data.append({
-                            'position': current_position.tolist() if current_position is not None else None,
-                            'orientation': current_orientation,
-                            'timestamp': time.strftime("%Y-%m-%d %H:%M:%S")
-                        })
-
-                        if current_time - self.last_save_time >= 60:  # Save data every minute
-                            self.save_run_data()
-                            self.last_save_time = current_time
-                            self.run_data = []  # Clear the data to start fresh
-                        last_print_time = current_time
+            result = frame_buffer.acquire(last_sequence, latest=self.latest_only, timeout=1)
+            if result is None:
+                continue
+            last_sequence, capture_time, slot = result
+            pass_start = time.perf_counter()
+            try:
+                self.detect_local(last_sequence, capture_time, frame_buffer.frames[slot])
+            finally:
+                frame_buffer.release(slot)
+            # A pass slower than a frame period can starve the capture thread
+            # and let the driver queue up frames, start again from a fresh one
+            frame_period = self.camera_thread.frame_period
+            if self.latest_only and frame_period is not None and time.perf_counter() - pass_start > frame_period:
+                self.camera_thread.request_flush()
+
+    def detect_local(self, sequence, capture_time, frame):
+        if not self.detection_due(frame, capture_time):
+            self.process_detections(sequence, capture_time, frame, None, None, None)
+            return
+        self.mark_detection(capture_time)
+        detections, zoomed_frame = self.detector.detect(frame)
+        positions_orientations = self.detector.get_position_and_orientation(detections)
+        if self.metrics is not None:
+            self.metrics.observe_all(self.detector.stage_times)
+        self.process_detections(sequence, capture_time, frame, zoomed_frame, detections, positions_orientations,
+                                self.detector.box_pose)
+
+    def run_pool(self):
+        frame_buffer = self.camera_thread.buffer
+        last_sequence = -1
+        while self.running:
+            # Keep the workers fed with pinned slots, only blocking for a new
+            # frame when nothing is in flight
+            while self.detection_pool.in_flight(self.camera_id) < self.detection_pool.max_in_flight:
+                timeout = 1 if self.detection_pool.in_flight(self.camera_id) == 0 else 0
+                result = frame_buffer.acquire(last_sequence, latest=self.latest_only, timeout=timeout)
+                if result is None:
+                    break
+                last_sequence, capture_time, slot = result
+                if self.detection_due(frame_buffer.frames[slot], capture_time):
+                    self.mark_detection(capture_time)
+                    self.detection_pool.submit(last_sequence, capture_time, slot, self.camera_id)
+                else:
+                    self.detection_pool.skip(last_sequence, capture_time, slot, self.camera_id)
+
+            # Results come back in capture order
+            for sequence, capture_time, slot, detections, positions_orientations, box_pose, stage_times in self.detection_pool.collect(timeout=0.01, camera_id=self.camera_id):
+                if self.metrics is not None:
+                    self.metrics.observe_all(stage_times)
+                self.process_detections(sequence, capture_time, frame_buffer.frames[slot], None, detections, positions_orientations, box_pose)
+                frame_buffer.release(slot)
+
+    def detection_due(self, frame, capture_time):
+        # Only the zoomed view matters for motion, the crop is a view
+        if self.motion_gate is not None and not self.motion_gate.wants_detection(self.detector.crop_to_zoom(frame), capture_time):
+            return False
+        if self.pose_filter is None or capture_time - self.last_detection_time >= self.detection_interval:
+            return True
+        return not self.pose_filter.initialized  # Nothing to predict from yet
+
+    def mark_detection(self, capture_time):
+        self.last_detection_time = capture_time
+        if self.motion_gate is not None:
+            self.motion_gate.detected(capture_time)
+
+    def process_detections(self, sequence, capture_time, frame, zoomed_frame, detections, positions_orientations, box_pose=None):
+        # detections is None for frames that were not detected on, which get
+        # the pose filter's prediction, or else the last pose
+        if self.last_sequence >= 0:
+            self.skipped_frames += sequence - self.last_sequence - 1
+        self.last_sequence = sequence
+        detected = detections is not None
+        frame_with_detections = None
+        if not detected:
+            detections, positions_orientations = [], []
+            self.predicted_frames += 1
+
+        box_start = time.perf_counter()
+        fused_cameras = None
+        box_errors = None
+        if self.fusion is not None:
+            with self.fusion.lock:
+                if detected:
+                    positions_orientations, box_pose = self.fusion.update(
+                        self.camera_id, capture_time, self.extrinsics.transform_tags(positions_orientations),
+                        self.extrinsics.transform_box_pose(box_pose))
+                fused_cameras = self.fusion.fused_cameras
+                box_errors = dict(self.fusion.box_errors)
+                current_position, current_orientation, relative_orientation, confidence, angular_rate = self.estimate_pose(
+                    sequence, capture_time, detected, positions_orientations, box_pose)
+        else:
+            current_position, current_orientation, relative_orientation, confidence, angular_rate = self.estimate_pose(
+                sequence, capture_time, detected, positions_orientations, box_pose)
+        if self.metrics is not None:
+            self.metrics.observe('box_position', time.perf_counter() - box_start)
+
+        current_time = time.time()
+        print_now = current_time - self.last_print_time >= self.print_delay
+        if print_now:
+            for tag_id, position, tvec, orientation in positions_orientations:
+                pos_str = f"Position: {position}" if position is not None else "Position: N/A"
+                if tvec is not None:
+                    distance = np.linalg.norm(tvec)
+                    dist_str = f"Distance: {distance:.2f} meters"
+                    logging.info(f"Tag ID: {tag_id}, Position: {position}, Distance: {distance:.2f} meters, Orientation: {orientation}")
+                else:
+                    dist_str = "Distance: N/A"
+                    logging.info(f"Tag ID: {tag_id}, {pos_str}, {dist_str}")
+            if box_pose is not None:
+                if box_errors:
+                    errors = ", ".join(f"camera {camera_id}: {error:.2f}" for camera_id, error in sorted(box_errors.items()))
+                    logging.info(f"Box pose from tags {box_pose[2]}, reprojection error {errors}")
+                else:
+                    logging.info(f"Box pose from tags {box_pose[2]}, reprojection error {box_pose[3]:.2f}")
+            if current_position is not None:
+                logging.info(f"Current box position: {current_position}, Orientation: {current_orientation} degrees, Relative Orientation: {relative_orientation} degrees")
+            else:
+                logging.info(f"Current box position: N/A, Orientation: N/A, Relative Orientation: N/A")
+            if self.motion_gate is not None:
+                stats = self.motion_gate.stats()
+                score = f"{stats['score']:.2f}" if stats['score'] is not None else "N/A"
+                logging.info(f"Motion gate: {stats['mode']} (score {score}), {stats['active_seconds']:.1f} s active, "
+                             f"{stats['idle_seconds']:.1f} s idle")
+            if self.pose_filter is not None:
+                confidence_str = f"{confidence:.2f}" if confidence is not None else "N/A"
+                rate_str = f"{angular_rate:.1f} deg/s" if angular_rate is not None else "N/A"
+                logging.info(f"Pose filter: confidence {confidence_str}, angular rate {rate_str}, {self.pose_filter.accepted_count} accepted, "
+                             f"{self.pose_filter.rejected_count} rejected, {self.predicted_frames} predicted frames")
+            logging.info(f"Rotation count: {self.box_position.rotation_count}")
+            camera_str = f"{self.camera_label} " if self.camera_label else ""
+            logging.info(f"{camera_str}Frame {sequence}, skipped frames: {self.skipped_frames}")
+            if fused_cameras is not None:
+                logging.info(f"Pose fused from {fused_cameras} cameras")
+            if self.detection_pool is not None:
+                utilization = ", ".join(f"worker {worker_id}: {busy:.0%}" for worker_id, busy in sorted(self.detection_pool.utilization().items()))
+                logging.info(f"Detection worker utilization: {utilization}")
+                camera_stats = self.detection_pool.camera_stats()
+                if len(camera_stats) > 1:
+                    throughput = ", ".join(f"camera {camera_id}: {stats['fps']:.1f} fps, {stats['busy_seconds']:.1f} s"
+                                           for camera_id, stats in sorted(camera_stats.items()))
+                    logging.info(f"Detection pool throughput: {throughput}")
+            if self.detector.tracking or self.detector.flow_tracking:
+                stats = self.scan_stats()
+                logging.info(f"Detection scans: {stats['roi']} ROI, {stats['full']} full, {stats['flow']} optical flow "
+                             f"({stats['roi_fraction'] + stats['flow_fraction']:.0%} fast path, {stats['flow_dropped']} flow tracks dropped)")
+            allocations = self.buffer_pool.allocations + self.detector_allocations()
+            logging.info(f"Buffer allocations: {allocations - self.report_allocations} in the last "
+                         f"{sequence - self.report_sequence} frames, {allocations} total")
+            self.report_allocations = allocations
+            self.report_sequence = sequence
+            frame_with_detections = self.annotate(frame, zoomed_frame, detections)
+            if self.display_queue is not None:
+                self.buffer_pool.retain(frame_with_detections)
+                self.display_queue.put(frame_with_detections)
+
+            if self.save:
+                self.buffer_pool.retain(frame_with_detections)
+                image_path = self.image_writer.save(os.path.join(self.run_dir, f'{self.metric_prefix}apriltag_detection_{self.image_count}'), frame_with_detections)
+                if image_path is not None:
+                    logging.info(f"Queued image: {image_path}")
+                else:
+                    logging.warning("Image writer queue full, dropped image")
+                self.image_count += 1
+
+            self.last_print_time = current_time
+
+        if self.video_recorder is not None:
+            if not print_now:
+                frame_with_detections = self.annotate(frame, zoomed_frame, detections)
+            self.buffer_pool.retain(frame_with_detections)
+            self.video_recorder.write(frame_with_detections, sequence, capture_time, detections)
+        # Drop our own hold, the consumers release theirs when done
+        self.buffer_pool.release(frame_with_detections)
+
+        if self.run_data_writer is not None and (self.record_every_frame or print_now):
+            record = {
+                'frame': sequence,
+                'timestamp': time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(capture_time)),
+                'capture_time': capture_time,
+                'position': current_position,
+                'orientation': current_orientation,
+                'relative_orientation': relative_orientation,
+                'detected': detected,
+                'confidence': confidence,
+                'angular_rate': angular_rate,
+                'box_tags': box_pose[2] if box_pose is not None else None,
+                'box_reprojection_error': box_pose[3] if box_pose is not None else None,
+                'tags': [
+                    {'tag_id': tag_id, 'position': position, 'orientation': orientation}
+                    for tag_id, position, _, orientation in positions_orientations
+                ],
+            }
+            if self.fusion is not None:
+                record['camera'] = self.camera_id
+                record['fused_cameras'] = fused_cameras
+                record['box_reprojection_errors'] = box_errors
+            self.run_data_writer.write(record)
+
+    def estimate_pose(self, sequence, capture_time, detected, positions_orientations, box_pose):
+        # Returns (position, orientation, relative_orientation, confidence, angular_rate)
+        confidence = None
+        angular_rate = None
+        if detected:
+            current_position, current_orientation, relative_orientation = self.box_position.calculate_orientation(positions_orientations, box_pose)
+        if self.pose_filter is not None:
+            if detected:
+                current_position, relative_orientation, confidence, accepted = self.pose_filter.update(capture_time, current_position, relative_orientation)
+                if not accepted and current_position is not None:
+                    logging.debug(f"Pose filter rejected the measurement of frame {sequence}")
+            else:
+                current_position, relative_orientation, confidence = self.pose_filter.predict(capture_time)
+            current_orientation = self.box_position.bearing_degrees(current_position)
+            if relative_orientation is not None:
+                angular_rate = self.pose_filter.angular_rate()
+        elif not detected:
+            current_position, current_orientation, relative_orientation = self.last_pose
+        self.last_pose = (current_position, current_orientation, relative_orientation)
+        return current_position, current_orientation, relative_orientation, confidence, angular_rate
+
+    def annotate(self, frame, zoomed_frame, detections):
+        # Draws into a frame leased from the buffer pool, never on a ring
+        # buffer slot or the detector's zoom buffer. The caller holds the lease.
+        draw_start = time.perf_counter()
+        if not is_bgr(frame):
+            frame = to_bgr(frame, self.buffer_pool.scratch(f'{self.metric_prefix}annotate_bgr', frame.shape[:2] + (3,)))
+        annotated = self.buffer_pool.acquire(frame.shape, frame.dtype)
+        if self.undistort:
+            # One remap from the raw frame, detections moved to match
+            self.detector.undistorted_zoom(frame, annotated)
+            detections = self.detector.undistort_detections(detections)
+        elif zoomed_frame is None:
+            # Native-crop, pooled and gray-capture detection skip the colour
+            # upscale, only do it for display
+            self.detector.apply_digital_zoom(frame, annotated)
+        else:
+            np.copyto(annotated, zoomed_frame)
+        self.detector.draw_detections(annotated, detections)
+        if self.metrics is not None:
+            self.metrics.observe('draw', time.perf_counter() - draw_start)
+        return annotated
 
     def stop(self):
         self.running = False
-        self.save_run_data()
-
-    def save_run_data(self):
-        data_path = os.path.join(self.data_dir, 'run_data.json')
-        with open(data_path, 'w') as file:
-            json.dump(self.run_data, file)
-        logging.info(f"Saved run data: {data_path}")
-        self.run_data = []  # Clear the data to start fresh
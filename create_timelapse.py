@@ -1,54 +1,133 @@
 import cv2
 import os
+import glob
 import argparse
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 
-def create_timelapse(input_dir, output_file, fps, zoom):
-    # Get list of files in the directory
-    files = [f for f in os.listdir(input_dir) if f.endswith('.png')]
-    
-    # Sort files by their numerical value in the filename
-    files.sort(key=lambda f: int(''.join(filter(str.isdigit, f))))
-    
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.npy')
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mkv', '.mov')
+
+def frame_number(filename):
+    digits = ''.join(filter(str.isdigit, os.path.basename(filename)))
+    return int(digits) if digits else -1
+
+def list_inputs(input_path):
+    # Returns ('images', paths) or ('videos', paths). A directory of
+    # recording_NNNN.mp4 segments is read as one continuous video.
+    if os.path.isfile(input_path):
+        return 'videos', [input_path]
+    files = [f for f in glob.glob(os.path.join(input_path, '*')) if f.lower().endswith(IMAGE_EXTENSIONS)]
+    if files:
+        # Sort files by their numerical value in the filename
+        files.sort(key=lambda f: (frame_number(f), f))
+        return 'images', files
+    videos = [f for f in glob.glob(os.path.join(input_path, '*')) if f.lower().endswith(VIDEO_EXTENSIONS)]
+    videos.sort(key=lambda f: (frame_number(f), f))
+    return 'videos', videos
+
+def load_image(path):
+    if path.endswith('.npy'):
+        return np.load(path)
+    return cv2.imread(path)
+
+def read_video_frames(paths, stride):
+    # Decoding a video is sequential, so it stays on the calling thread
+    index = 0
+    for path in paths:
+        cap = cv2.VideoCapture(path)
+        while True:
+            if index % stride:
+                ret = cap.grab()  # Skip without decoding
+            else:
+                ret, frame = cap.read()
+                if ret:
+                    yield frame
+            if not ret:
+                break
+            index += 1
+        cap.release()
+
+def zoom_region(width, height, zoom):
+    center_x, center_y = width // 2, height // 2
+    radius_x, radius_y = int(width // (2 * zoom)), int(height // (2 * zoom))
+    return center_x - radius_x, center_y - radius_y, center_x + radius_x, center_y + radius_y
+
+def apply_zoom(img, zoom, output_size=None):
+    height, width = img.shape[:2]
+    output_size = output_size or (width, height)
+    if zoom != 1.0:
+        min_x, min_y, max_x, max_y = zoom_region(width, height, zoom)
+        img = img[min_y:max_y, min_x:max_x]
+    if img.shape[1::-1] != tuple(output_size):
+        # One resize covers both the zoom and any output downscaling
+        img = cv2.resize(img, output_size, interpolation=cv2.INTER_AREA if zoom <= 1.0 else cv2.INTER_LINEAR)
+    return img
+
+def prepare_image(path, zoom, output_size):
+    img = load_image(path)
+    if img is None:
+        return None
+    return apply_zoom(img, zoom, output_size)
+
+def ordered_prefetch(executor, tasks, prefetch):
+    # Run tasks on the pool but yield their results in order, with at most
+    # `prefetch` frames decoded ahead of the writer
+    pending = collections.deque()
+    for task in tasks:
+        pending.append(executor.submit(*task))
+        if len(pending) >= prefetch:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+def create_timelapse(input_dir, output_file, fps, zoom, scale=1.0, stride=1, workers=None, prefetch=None):
+    input_type, files = list_inputs(input_dir)
     if not files:
-        print("No PNG files found in the directory.")
+        print("No images or videos found in the input.")
         return
 
-    # Read the first image to get the dimensions
-    first_image_path = os.path.join(input_dir, files[0])
-    first_image = cv2.imread(first_image_path)
-    height, width, layers = first_image.shape
+    # Read the first frame to get the dimensions
+    if input_type == 'images':
+        files = files[::stride]
+        first_image = load_image(files[0])
+    else:
+        first_image = next(read_video_frames(files[:1], 1), None)
+    if first_image is None:
+        print("Could not read the first frame.")
+        return
+    height, width = first_image.shape[:2]
+    output_size = (int(width * scale) // 2 * 2, int(height * scale) // 2 * 2)
 
     # Ensure output directory exists
-    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    os.makedirs(os.path.dirname(output_file) or '.', exist_ok=True)
 
     # Define the codec and create VideoWriter object
     fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-    out = cv2.VideoWriter(output_file, fourcc, fps, (width, height))
-
-    for filename in files:
-        img_path = os.path.join(input_dir, filename)
-        img = cv2.imread(img_path)
-        
-        # Apply digital zoom
-        if zoom != 1.0:
-            img = apply_zoom(img, zoom)
-        
-        out.write(img)
-
-    out.release()
-    print("Timelapse video saved as {}".format(output_file))
+    out = cv2.VideoWriter(output_file, fourcc, fps, output_size)
 
-def apply_zoom(img, zoom):
-    height, width = img.shape[:2]
-    center_x, center_y = width // 2, height // 2
-    radius_x, radius_y = int(width // (2 * zoom)), int(height // (2 * zoom))
+    # cv2 releases the GIL while decoding and resizing, so a thread pool
+    # keeps several cores busy while this thread encodes
+    workers = workers or os.cpu_count() or 1
+    prefetch = prefetch or 2 * workers
+    if input_type == 'images':
+        tasks = ((prepare_image, path, zoom, output_size) for path in files)
+    else:
+        tasks = ((apply_zoom, frame, zoom, output_size) for frame in read_video_frames(files, stride))
 
-    min_x, max_x = center_x - radius_x, center_x + radius_x
-    min_y, max_y = center_y - radius_y, center_y + radius_y
+    frame_count = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for img in ordered_prefetch(executor, tasks, prefetch):
+            if img is None:
+                continue
+            if img.ndim == 2:
+                img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+            out.write(img)
+            frame_count += 1
 
-    cropped = img[min_y:max_y, min_x:max_x]
-    resized = cv2.resize(cropped, (width, height))
-    return resized
+    out.release()
+    print("Timelapse video saved as {} ({} frames)".format(output_file, frame_count))
 
 def get_next_run_number(base_dir, prefix="timelapse"):
     files = [f for f in os.listdir(base_dir) if f.startswith(prefix) and f.endswith('.mp4')]
@@ -60,11 +139,15 @@ def get_next_run_number(base_dir, prefix="timelapse"):
     return max(run_numbers) + 1
 
 def parse_args():
-    parser = argparse.ArgumentParser(description="Create a timelapse video from PNG images.")
-    parser.add_argument('input_dir', type=str, help='Directory containing PNG images.')
+    parser = argparse.ArgumentParser(description="Create a timelapse video from saved images or recordings.")
+    parser.add_argument('input_dir', type=str, help='Directory of images (PNG, JPEG or .npy), directory of recording segments, or a video file.')
     parser.add_argument('output_dir', type=str, nargs='?', default=None, help='Output directory path (optional).')
     parser.add_argument('-f', '--fps', type=int, default=60, help='Frames per second for the output video (default: 60).')
     parser.add_argument('-z', '--zoom', type=float, default=1.0, help='Digital zoom factor for the images (default: 1.0).')
+    parser.add_argument('-s', '--scale', type=float, default=1.0, help='Output resolution relative to the input (default: 1.0).')
+    parser.add_argument('-n', '--stride', type=int, default=1, help='Use every Nth frame (default: 1).')
+    parser.add_argument('-w', '--workers', type=int, default=None, help='Decode/zoom worker threads (default: CPU count).')
+    parser.add_argument('-p', '--prefetch', type=int, default=None, help='Frames decoded ahead of the encoder (default: 2x workers).')
     return parser.parse_args()
 
 if __name__ == "__main__":
@@ -80,4 +163,4 @@ if __name__ == "__main__":
     run_number = get_next_run_number(output_dir)
     output_file = os.path.join(output_dir, f'timelapse_{run_number}.mp4')
 
-    create_timelapse(args.input_dir, output_file, args.fps, args.zoom)
+    create_timelapse(args.input_dir, output_file, args.fps, args.zoom, args.scale, args.stride, args.workers, args.prefetch)
@@ -0,0 +1,164 @@
+import time
+import queue
+import logging
+import threading
+import collections
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+from apriltag_detector import AprilTagDetector, summarize_scans
+
+def detection_worker(worker_id, task_queue, result_queue, detector_kwargs):
+    # One detector per camera, created on its first frame
+    detectors = {}
+    memories = {}
+    busy_time = 0.0
+    start_time = time.perf_counter()
+
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        camera_id, sequence, capture_time, slot, memory_name, shape, dtype = task
+
+        if memory_name not in memories:
+            # Spawned workers share the parent's resource tracker, so the
+            # segment is still unlinked only once, by FrameRingBuffer.close
+            frames_memory = shared_memory.SharedMemory(name=memory_name)
+            memories[memory_name] = (frames_memory, np.ndarray(shape, dtype=dtype, buffer=frames_memory.buf))
+        frames = memories[memory_name][1]
+        if camera_id not in detectors:
+            detectors[camera_id] = AprilTagDetector(**detector_kwargs[camera_id])
+        detector = detectors[camera_id]
+
+        task_start = time.perf_counter()
+        detections, _ = detector.detect(frames[slot])
+        positions_orientations = detector.get_position_and_orientation(detections)
+        task_time = time.perf_counter() - task_start
+        busy_time += task_time
+
+        # The detector's running counters go along, the parent's copy never detects
+        counters = (dict(detector.scan_counts), detector.flow_dropped, detector.buffers.allocations)
+        result_queue.put((camera_id, sequence, capture_time, slot, worker_id, detections, positions_orientations, detector.box_pose,
+                          dict(detector.stage_times), task_time, busy_time, time.perf_counter() - start_time, counters))
+
+    frames = None
+    for frames_memory, _ in memories.values():
+        frames_memory.close()
+
+class DetectionPool:
+    def __init__(self, num_workers, frame_buffers, detector_kwargs, max_in_flight=None):
+        # frame_buffers and detector_kwargs are dicts keyed by camera id when
+        # several cameras share the pool, or a single buffer and kwargs
+        if not isinstance(frame_buffers, dict):
+            frame_buffers, detector_kwargs = {0: frame_buffers}, {0: detector_kwargs}
+        # Spawn rather than fork, the parent is already running capture threads
+        context = multiprocessing.get_context('spawn')
+        self.frame_buffers = frame_buffers
+        self.task_queue = context.Queue()
+        self.result_queue = context.Queue()
+        self.workers = [
+            context.Process(target=detection_worker, args=(worker_id, self.task_queue, self.result_queue, detector_kwargs), daemon=True)
+            for worker_id in range(num_workers)
+        ]
+        self.max_in_flight = max_in_flight or 2 * num_workers  # Per camera
+        # Every camera's frames come back in its own capture order, whichever
+        # camera's thread happens to drain the result queue
+        self.lock = threading.Lock()
+        self.pending = {camera_id: collections.deque() for camera_id in frame_buffers}  # Submitted sequences in capture order
+        self.results = {camera_id: {} for camera_id in frame_buffers}
+        self.worker_times = {}
+        self.detector_counters = {}  # (worker_id, camera_id) -> latest (scan_counts, flow_dropped, allocations)
+        self.camera_frames = {camera_id: 0 for camera_id in frame_buffers}
+        self.camera_busy_time = {camera_id: 0.0 for camera_id in frame_buffers}
+        self.start_time = None
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+        self.start_time = time.perf_counter()
+        logging.info(f"Started {len(self.workers)} detection workers.")
+
+    def in_flight(self, camera_id=0):
+        return len(self.pending[camera_id])
+
+    def submit(self, sequence, capture_time, slot, camera_id=0):
+        # Workers read the pinned slot straight out of shared memory
+        frame_buffer = self.frame_buffers[camera_id]
+        frames = frame_buffer.frames
+        with self.lock:
+            self.pending[camera_id].append(sequence)
+        self.task_queue.put((camera_id, sequence, capture_time, slot, frame_buffer.shared_memory.name, frames.shape, frames.dtype.str))
+
+    def skip(self, sequence, capture_time, slot, camera_id=0):
+        # A frame the caller decided not to detect on still comes back from
+        # collect in capture order, with detections set to None
+        with self.lock:
+            self.pending[camera_id].append(sequence)
+            self.results[camera_id][sequence] = (sequence, capture_time, slot, None, None, None, {})
+
+    def collect(self, timeout=None, camera_id=0):
+        # Drain the result queue without the lock, so other cameras can
+        # submit while this one waits, then file the results under it
+        drained = []
+        try:
+            drained.append(self.result_queue.get(timeout=timeout))
+            while True:
+                drained.append(self.result_queue.get_nowait())
+        except queue.Empty:
+            pass
+
+        with self.lock:
+            for (result_camera, sequence, capture_time, slot, worker_id, detections, positions_orientations, box_pose,
+                 stage_times, task_time, busy_time, wall_time, counters) in drained:
+                self.results[result_camera][sequence] = (sequence, capture_time, slot, detections, positions_orientations, box_pose, stage_times)
+                self.worker_times[worker_id] = (busy_time, wall_time)
+                self.detector_counters[(worker_id, result_camera)] = counters
+                self.camera_frames[result_camera] += 1
+                self.camera_busy_time[result_camera] += task_time
+
+            pending = self.pending[camera_id]
+            results = self.results[camera_id]
+            ordered = []
+            while pending and pending[0] in results:
+                ordered.append(results.pop(pending.popleft()))
+            return ordered
+
+    def camera_stats(self):
+        # Detected frames per second and worker time spent on each camera
+        elapsed = time.perf_counter() - self.start_time if self.start_time is not None else 0.0
+        return {
+            camera_id: {
+                'frames': frames,
+                'fps': frames / elapsed if elapsed > 0 else 0.0,
+                'busy_seconds': self.camera_busy_time[camera_id],
+            }
+            for camera_id, frames in self.camera_frames.items()
+        }
+
+    def scan_stats(self, camera_id=0):
+        # Scan statistics summed over every worker's detector for the camera
+        scan_counts = {'roi': 0, 'full': 0, 'flow': 0}
+        flow_dropped = 0
+        for (_, counter_camera), (counts, dropped, _) in list(self.detector_counters.items()):
+            if counter_camera != camera_id:
+                continue
+            for scan, count in counts.items():
+                scan_counts[scan] += count
+            flow_dropped += dropped
+        return summarize_scans(scan_counts, flow_dropped)
+
+    def buffer_allocations(self, camera_id=0):
+        return sum(allocations for (_, counter_camera), (_, _, allocations) in list(self.detector_counters.items())
+                   if counter_camera == camera_id)
+
+    def utilization(self):
+        return {worker_id: busy_time / wall_time for worker_id, (busy_time, wall_time) in self.worker_times.items() if wall_time > 0}
+
+    def stop(self):
+        for _ in self.workers:
+            self.task_queue.put(None)
+        for worker in self.workers:
+            worker.join(timeout=5)
+            if worker.is_alive():
+                worker.terminate()
@@ -0,0 +1,291 @@
+import os
+import re
+import time
+import glob
+import logging
+import cv2
+import numpy as np
+
+PACING_MODES = ('unthrottled', 'realtime', 'fixed')
+CAPTURE_FORMATS = ('bgr', 'gray')
+
+# Frames are BGR (h, w, 3), grayscale (h, w) or raw YUYV (h, w, 2) from a
+# 'gray' capture, where channel 0 is the Y plane
+
+def is_bgr(frame):
+    return frame.ndim == 3 and frame.shape[2] == 3
+
+def luma(frame, dst=None):
+    # Grayscale image of any frame, a view for gray and YUYV frames. dst
+    # only receives the conversion of BGR frames.
+    if frame.ndim == 2:
+        return frame
+    if frame.shape[2] == 2:
+        return frame[:, :, 0]
+    return cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=dst)
+
+def to_bgr(frame, dst=None):
+    # Colour image for display, recording and saving; BGR frames pass through
+    if frame.ndim == 2:
+        return cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR, dst=dst)
+    if frame.shape[2] == 2:
+        return cv2.cvtColor(frame, cv2.COLOR_YUV2BGR_YUYV, dst=dst)
+    return frame
+
+class FramePacer:
+    def __init__(self, pacing='unthrottled', fps=None):
+        if pacing not in PACING_MODES:
+            raise ValueError(f"Unknown pacing mode {pacing!r}, expected one of {PACING_MODES}")
+        if pacing == 'fixed' and not fps:
+            raise ValueError("Fixed pacing needs an fps")
+        self.pacing = pacing
+        self.fps = fps
+        self.start_time = None
+        self.first_frame_time = None
+        self.frame_count = 0
+
+    def wait(self, frame_time):
+        # frame_time is the recording's own clock, in seconds
+        now = time.perf_counter()
+        if self.start_time is None:
+            self.start_time = now
+            self.first_frame_time = frame_time
+
+        if self.pacing == 'fixed':
+            target = self.start_time + self.frame_count / self.fps
+        elif self.pacing == 'realtime' and frame_time is not None:
+            target = self.start_time + (frame_time - self.first_frame_time)
+        else:
+            target = now
+        self.frame_count += 1
+
+        if target > now:
+            time.sleep(target - now)
+
+def fourcc_string(code):
+    code = int(code)
+    return ''.join(chr((code >> 8 * i) & 0xFF) for i in range(4))
+
+class CameraSource:
+    def __init__(self, camera_index=0, width=None, height=None, fps=None, fourcc=None, buffer_size=None, capture_format='bgr'):
+        if capture_format not in CAPTURE_FORMATS:
+            raise ValueError(f"Unknown capture format {capture_format!r}, expected one of {CAPTURE_FORMATS}")
+        self.cap = cv2.VideoCapture(camera_index)
+        self.finished = False  # A live camera never runs out of frames
+        # A 'gray' capture keeps the raw YUYV buffer instead of converting
+        # every frame to BGR, the detector only reads its Y plane
+        self.raw = capture_format == 'gray'
+        self.raw_shape = None
+        if self.raw:
+            if fourcc and fourcc != 'YUYV':
+                logging.warning(f"Gray capture needs YUYV, ignoring camera format {fourcc!r}")
+            fourcc = 'YUYV'
+        # FOURCC goes first, many UVC cameras only offer their full
+        # resolution and frame rate as MJPG
+        if fourcc:
+            self.cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*fourcc))
+        if width:
+            self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+        if height:
+            self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+        if fps:
+            self.cap.set(cv2.CAP_PROP_FPS, fps)
+        if buffer_size is not None:
+            self.cap.set(cv2.CAP_PROP_BUFFERSIZE, buffer_size)
+        if self.raw:
+            self.cap.set(cv2.CAP_PROP_CONVERT_RGB, 0)
+        self.width = int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        self.height = int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        # Drivers quietly fall back to what they support, report what we got
+        self.fps = self.cap.get(cv2.CAP_PROP_FPS) or fps or None
+        self.buffer_size = buffer_size
+        self.flushed_frames = 0
+        settings = (f"{self.width}x{self.height} "
+                    f"at {self.fps or 0:g} fps, format {fourcc_string(self.cap.get(cv2.CAP_PROP_FOURCC))!r}")
+        logging.info(f"Camera {camera_index}: {settings}")
+        if fourcc and fourcc_string(self.cap.get(cv2.CAP_PROP_FOURCC)) != fourcc:
+            logging.warning(f"Camera {camera_index} did not accept format {fourcc!r}")
+
+    def grab(self):
+        # Dequeues the next frame without decoding it
+        return self.cap.grab()
+
+    def retrieve(self, image=None):
+        # Decodes the last grabbed frame
+        if not self.raw:
+            return self.cap.retrieve(image)
+        # Backends hand raw YUYV back either as (h, w, 2) or as a single row
+        # of bytes; retrieve into the caller's buffer in whichever shape the
+        # backend uses and reshape the result, both without copying
+        if image is not None and self.raw_shape is not None and image.size == int(np.prod(self.raw_shape)):
+            image = image.reshape(self.raw_shape)
+        ret, frame = self.cap.retrieve(image)
+        if not ret:
+            return False, None
+        if frame.ndim == 3 and frame.shape[2] == 3:
+            return True, frame  # The backend converted anyway
+        self.raw_shape = frame.shape
+        return True, frame.reshape(self.height, self.width, 2)
+
+    def read(self, image=None):
+        if not self.grab():
+            return False, None
+        return self.retrieve(image)
+
+    def flush(self, max_frames=None):
+        # Drops the frames the driver queued up while nobody was reading.
+        # Queued frames come back immediately, so grab until one has to wait
+        # for the sensor; that fresh frame is left grabbed for retrieve.
+        period = 1.0 / self.fps if self.fps else 1.0 / 30
+        max_frames = max_frames or (self.buffer_size or 4) + 1
+        for _ in range(max_frames):
+            grab_start = time.perf_counter()
+            if not self.cap.grab():
+                return False
+            if time.perf_counter() - grab_start >= period / 2:
+                return True
+            self.flushed_frames += 1
+        return True
+
+    def release(self):
+        self.cap.release()
+
+class VideoFileSource:
+    def __init__(self, path, pacing='unthrottled', fps=None, loop=False):
+        self.path = path
+        self.cap = cv2.VideoCapture(path)
+        if not self.cap.isOpened():
+            raise IOError(f"Could not open video file {path}")
+        self.loop = loop
+        # Real-time pacing follows the file's own timestamps
+        self.pacer = FramePacer(pacing, fps or self.cap.get(cv2.CAP_PROP_FPS) or None)
+        self.finished = False
+        self.flushed_frames = 0
+        self.loop_offset = 0.0
+
+    def grab(self):
+        ret = self.cap.grab()
+        if not ret and self.loop:
+            self.loop_offset += self.cap.get(cv2.CAP_PROP_POS_MSEC) / 1000.0
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            ret = self.cap.grab()
+        if not ret:
+            self.finished = True
+            return False
+        self.pacer.wait(self.loop_offset + self.cap.get(cv2.CAP_PROP_POS_MSEC) / 1000.0)
+        return True
+
+    def retrieve(self, image=None):
+        ret, frame = self.cap.retrieve(image)
+        return (True, frame) if ret else (False, None)
+
+    def read(self, image=None):
+        if not self.grab():
+            return False, None
+        return self.retrieve(image)
+
+    def flush(self, max_frames=None):
+        return self.grab()  # Files don't queue up
+
+    def release(self):
+        self.cap.release()
+
+class ImageDirectorySource:
+    IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp')
+
+    def __init__(self, path, pacing='unthrottled', fps=None, loop=False, capture_format='bgr'):
+        self.path = path
+        self.read_flag = cv2.IMREAD_GRAYSCALE if capture_format == 'gray' else cv2.IMREAD_COLOR
+        self.files = self.list_images(path)
+        if not self.files:
+            raise IOError(f"No images found in {path}")
+        self.loop = loop
+        # Images carry no timestamps, real-time pacing uses their mtimes
+        self.pacer = FramePacer(pacing, fps)
+        self.index = 0
+        self.filename = None
+        self.finished = False
+        self.flushed_frames = 0
+        # The ring buffer is sized by the first image, later ones are resized to match
+        self.frame_size = None
+        self.resized_sizes = set()
+        logging.info(f"Replaying {len(self.files)} images from {path}")
+
+    @staticmethod
+    def frame_number(filename):
+        # apriltag_detection_12.png, chessboard_3.png, ...
+        numbers = re.findall(r'\d+', os.path.basename(filename))
+        return int(numbers[-1]) if numbers else -1
+
+    @classmethod
+    def list_images(cls, path):
+        # Either a directory of images (calibration_images/raw, a single
+        # saved_images/run* directory) or a directory of run* directories
+        # (saved_images), replayed run by run
+        files = [f for f in glob.glob(os.path.join(path, '*')) if f.lower().endswith(cls.IMAGE_EXTENSIONS)]
+        if files:
+            return sorted(files, key=lambda f: (cls.frame_number(f), f))
+
+        run_dirs = [d for d in glob.glob(os.path.join(path, 'run*')) if os.path.isdir(d)]
+        run_dirs.sort(key=lambda d: (cls.frame_number(os.path.basename(d).split('_')[0]), d))
+        files = []
+        for run_dir in run_dirs:
+            files.extend(cls.list_images(run_dir))
+        return files
+
+    def grab(self):
+        if self.index >= len(self.files):
+            if not self.loop:
+                self.finished = True
+                return False
+            self.index = 0
+        self.filename = self.files[self.index]
+        self.index += 1
+        self.pacer.wait(os.path.getmtime(self.filename))
+        return True
+
+    def retrieve(self, image=None):
+        frame = cv2.imread(self.filename, self.read_flag)
+        if frame is None:
+            logging.warning(f"Failed to load image {self.filename}")
+            return False, None
+        size = (frame.shape[1], frame.shape[0])
+        if self.frame_size is None:
+            self.frame_size = size
+        elif size != self.frame_size:
+            if size not in self.resized_sizes:
+                self.resized_sizes.add(size)
+                logging.warning(f"Image {self.filename} is {size[0]}x{size[1]}, resizing images of that size "
+                                f"to the first image's {self.frame_size[0]}x{self.frame_size[1]}")
+            if image is not None and image.shape == (self.frame_size[1], self.frame_size[0]) + frame.shape[2:]:
+                cv2.resize(frame, self.frame_size, dst=image, interpolation=cv2.INTER_AREA)
+                return True, image
+            frame = cv2.resize(frame, self.frame_size, interpolation=cv2.INTER_AREA)
+        if image is not None and image.shape == frame.shape:
+            np.copyto(image, frame)
+            return True, image
+        return True, frame
+
+    def read(self, image=None):
+        if not self.grab():
+            return False, None
+        return self.retrieve(image)
+
+    def flush(self, max_frames=None):
+        return self.grab()  # Nothing queues up on disk
+
+    def release(self):
+        pass
+
+def open_frame_source(source=0, pacing='unthrottled', fps=None, loop=False, camera_settings=None, capture_format='bgr'):
+    # A camera index, a video file or a directory of images. camera_settings
+    # are CameraSource keyword arguments, ignored for replay sources.
+    if capture_format not in CAPTURE_FORMATS:
+        raise ValueError(f"Unknown capture format {capture_format!r}, expected one of {CAPTURE_FORMATS}")
+    if isinstance(source, int) or str(source).isdigit():
+        return CameraSource(int(source), capture_format=capture_format, **(camera_settings or {}))
+    if os.path.isdir(source):
+        return ImageDirectorySource(source, pacing, fps, loop, capture_format)
+    if capture_format != 'bgr':
+        logging.info("Video files are always decoded to BGR")
+    return VideoFileSource(source, pacing, fps, loop)
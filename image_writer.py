@@ -0,0 +1,118 @@
+import time
+import queue
+import logging
+import threading
+import cv2
+import numpy as np
+
+IMAGE_FORMATS = ('png', 'jpg', 'npy')
+DROP_POLICIES = ('drop_newest', 'drop_oldest')
+
+class ImageWriterPool:
+    def __init__(self, num_threads=1, max_queue=16, image_format='png', png_compression=3, jpeg_quality=90,
+                 drop_policy='drop_newest', metrics=None, buffer_pool=None):
+        if image_format not in IMAGE_FORMATS:
+            raise ValueError(f"Unknown image format {image_format!r}, expected one of {IMAGE_FORMATS}")
+        if drop_policy not in DROP_POLICIES:
+            raise ValueError(f"Unknown drop policy {drop_policy!r}, expected one of {DROP_POLICIES}")
+        self.image_format = image_format
+        self.drop_policy = drop_policy
+        if image_format == 'png':
+            self.encode_params = [cv2.IMWRITE_PNG_COMPRESSION, png_compression]
+        elif image_format == 'jpg':
+            self.encode_params = [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality]
+        else:
+            self.encode_params = []
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.metrics = metrics
+        self.buffer_pool = buffer_pool  # Pooled images are released once written or dropped
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        # cv2.imwrite releases the GIL, so threads are enough to overlap encoding with detection
+        self.threads = [threading.Thread(target=self.worker, daemon=True) for _ in range(num_threads)]
+        if metrics is not None:
+            metrics.add_collector(self.collect_metrics)
+
+    def collect_metrics(self):
+        return {
+            'image_queue_depth': self.queue.qsize(),
+            'images_queued': self.queued,
+            'images_written': self.written,
+            'images_dropped': self.dropped,
+            'images_failed': self.failed,
+        }
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def path_for(self, path_without_extension):
+        return f'{path_without_extension}.{self.image_format}'
+
+    def save(self, path_without_extension, image):
+        # The caller hands over ownership of image and must not modify it
+        # afterwards. Returns the path the image will be written to, or None
+        # if it was dropped.
+        path = self.path_for(path_without_extension)
+        with self.lock:
+            try:
+                self.queue.put_nowait((path, image))
+            except queue.Full:
+                if self.drop_policy == 'drop_newest':
+                    self.dropped += 1
+                    self.release(image)
+                    return None
+                # Make room by discarding the oldest image still waiting
+                try:
+                    _, oldest = self.queue.get_nowait()
+                    self.queue.task_done()
+                    self.dropped += 1
+                    self.release(oldest)
+                except queue.Empty:
+                    pass
+                self.queue.put_nowait((path, image))
+            self.queued += 1
+        return path
+
+    def worker(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+            path, image = item
+            start_time = time.perf_counter()
+            try:
+                if self.image_format == 'npy':
+                    np.save(path, image)
+                    success = True
+                else:
+                    success = cv2.imwrite(path, image, self.encode_params)
+            except (cv2.error, OSError) as e:
+                logging.error(f"Failed to save image {path}: {e}")
+                success = False
+            with self.lock:
+                if success:
+                    self.written += 1
+                else:
+                    self.failed += 1
+            self.release(image)
+            if self.metrics is not None:
+                self.metrics.observe('save_image', time.perf_counter() - start_time)
+            self.queue.task_done()
+
+    def release(self, image):
+        if self.buffer_pool is not None:
+            self.buffer_pool.release(image)
+
+    def stop(self):
+        # Write out whatever is still queued, then shut the threads down
+        self.queue.join()
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        logging.info(f"Image writer: {self.written} written, {self.dropped} dropped, {self.failed} failed.")
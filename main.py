@@ -10,6 +10,18 @@ import queue
 from camera_thread import CameraThread, DisplayThread, DetectionThread
 from apriltag_detector import AprilTagDetector
 from box_position import BoxPosition
+from box_model import BoxModel
+from pose_filter import PoseFilter
+from motion_gate import MotionGate
+from detection_pool import DetectionPool
+from frame_sources import open_frame_source, PACING_MODES
+from buffer_pool import BufferPool
+from metrics import Metrics, MetricsServer, MetricsDumpThread
+from run_data_writer import RunDataWriter
+from image_writer import ImageWriterPool
+from video_recorder import VideoRecorder
+from preview_server import PreviewServer
+from multi_camera import PoseFusion, load_camera_configs
 
 # Base directory to save images
 BASE_SAVE_DIR = "saved_images"
@@ -31,7 +43,9 @@ def parse_args():
     parser.add_argument("-cal", "--calibration", type=str, default="camera_calibration_data.npz", help="Path to camera calibration data")
     parser.add_argument("-con", "--config", type=str, default="config.json", help="Path to configuration file")
     parser.add_argument("-ip", "--initial_position", type=str, default="initial_camera_position.json", help="Path to initial camera position data")
-    parser.add_argument("-z", "--zoom", action="store_true", type=float, default=1.0, help="digital zoom")
+    parser.add_argument("-z", "--zoom", type=float, default=None, help="digital zoom")
+    parser.add_argument("-s", "--source", type=str, default=None, help="Camera index, video file or image directory to read frames from")
+    parser.add_argument("-p", "--pacing", type=str, default=None, choices=PACING_MODES, help="Replay pacing for video and image sources")
     return parser.parse_args()
 
 def load_config(config_path):
@@ -44,41 +58,98 @@ def load_config(config_path):
         logging.warning(f"Configuration file {config_path} not found. Using default settings.")
     return config
 
+def load_calibration(calibration_path):
+    # Returns (camera_matrix, dist_coeffs), both None without calibration data
+    if os.path.exists(calibration_path):
+        calibration_data = np.load(calibration_path)
+        logging.info(f"Loaded camera calibration data from {calibration_path}.")
+        return calibration_data['camera_matrix'], calibration_data['dist_coeffs']
+    logging.warning(f"Camera calibration data {calibration_path} not found. Proceeding without calibration.")
+    return None, None
+
 def setup_logging():
     logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-def save_run_data(run_data, run_dir):
-    data_path = os.path.join(run_dir, 'run_data.json')
-    with open(data_path, 'w') as file:
-        json.dump(run_data, file)
-    logging.info(f"Saved run data: {data_path}")
-    return data_path
-
 def main():
     setup_logging()
     args = parse_args()
 
     config = load_config(args.config)
     live = args.live if args.live is not None else config.get("live", False)
-    save = False
+    save = config.get("save", False)
     save_data = True
     zoom = args.zoom if args.zoom is not None else config.get("zoom", 1.0)
     calibration_path = args.calibration or config.get("calibration", "camera_calibration_data.npz")
     initial_position_path = args.initial_position or config.get("initial_position", "initial_camera_position.json")
     tag_size = config.get("tag_size", 0.080)  # Default tag size to 0.1 meters if not in config
     print_delay = config.get("print_delay", 2)
-
-    # Load camera calibration data
-    if os.path.exists(calibration_path):
-        calibration_data = np.load(calibration_path)
-        camera_matrix = calibration_data['camera_matrix']
-        dist_coeffs = calibration_data['dist_coeffs']
-        logging.info("Loaded camera calibration data.")
-    else:
-        calibration_data = None
-        camera_matrix = None
-        dist_coeffs = None
-        logging.warning("Camera calibration data not found. Proceeding without calibration.")
+    frame_buffer_size = config.get("frame_buffer_size", 4)
+    detect_latest_only = config.get("detect_latest_only", True)
+    native_crop = config.get("native_crop", False)
+    tracking = config.get("tracking", False)
+    full_scan_interval = config.get("full_scan_interval", 30)
+    roi_padding = config.get("roi_padding", 0.5)
+    quad_decimate = config.get("quad_decimate", 1.0)
+    corner_refinement = config.get("corner_refinement", "edges")
+    pnp_method = config.get("pnp_method", "iterative")
+    flow_tracking = config.get("flow_tracking", False)
+    flow_interval = config.get("flow_interval", 5)
+    flow_max_error = config.get("flow_max_error", 1.0)
+    flow_max_reprojection = config.get("flow_max_reprojection", 2.0)
+    undistort_points = config.get("undistort_points", False)
+    undistort_display = config.get("undistort_display", False)
+    box_pose = config.get("box_pose", False)
+    box_pose_ransac = config.get("box_pose_ransac", False)
+    box_size = config.get("box_size", 0.3)
+    box_tag_offset = config.get("box_tag_offset", None)
+    box_face_tags = config.get("box_face_tags", None)
+    pose_filter_enabled = config.get("pose_filter", False)
+    detection_rate = config.get("detection_rate", None)
+    pose_filter_position_noise = config.get("pose_filter_position_noise", 0.005)
+    pose_filter_angle_noise = config.get("pose_filter_angle_noise", 1.0)
+    pose_filter_gate = config.get("pose_filter_gate", 4.0)
+    pose_filter_max_coast = config.get("pose_filter_max_coast", 5.0)
+    motion_gating = config.get("motion_gate", False)
+    motion_threshold = config.get("motion_threshold", 3.0)
+    motion_hold = config.get("motion_hold", 2.0)
+    motion_min_refresh = config.get("motion_min_refresh", 10.0)
+    detection_workers = config.get("detection_workers", 0)
+    source = args.source if args.source is not None else config.get("source", 0)
+    replay_pacing = args.pacing or config.get("replay_pacing", "unthrottled")
+    replay_fps = config.get("replay_fps", None)
+    replay_loop = config.get("replay_loop", False)
+    camera_width = config.get("camera_width", None)
+    camera_height = config.get("camera_height", None)
+    camera_fps = config.get("camera_fps", None)
+    camera_fourcc = config.get("camera_fourcc", None)
+    camera_buffer_size = config.get("camera_buffer_size", None)
+    capture_on_demand = config.get("capture_on_demand", False)
+    capture_format = config.get("capture_format", "bgr")
+    metrics_port = config.get("metrics_port", None)
+    metrics_dump_interval = config.get("metrics_dump_interval", 60)
+    preview_port = config.get("preview_port", None)
+    preview_host = config.get("preview_host", "127.0.0.1")
+    preview_fps = config.get("preview_fps", 5)
+    preview_width = config.get("preview_width", 640)
+    preview_quality = config.get("preview_quality", 70)
+    record_every_frame = config.get("record_every_frame", False)
+    run_data_segment_mb = config.get("run_data_segment_mb", 64)
+    run_data_segment_hours = config.get("run_data_segment_hours", 1)
+    image_format = config.get("image_format", "png")
+    png_compression = config.get("png_compression", 3)
+    jpeg_quality = config.get("jpeg_quality", 90)
+    image_writer_threads = config.get("image_writer_threads", 1)
+    image_queue_size = config.get("image_queue_size", 16)
+    image_drop_policy = config.get("image_drop_policy", "drop_newest")
+    recording = config.get("recording", False)
+    recording_fps = config.get("recording_fps", 15)
+    recording_segment_seconds = config.get("recording_segment_seconds", 600)
+    recording_codec = config.get("recording_codec", "mp4v")
+    # Several cameras share the detector pool and fuse their poses; without
+    # a 'cameras' list, the top-level source and calibration are the only camera
+    camera_configs = load_camera_configs(config, source, calibration_path)
+    fusion_window = config.get("fusion_window", 0.1)
+    multi_camera = len(camera_configs) > 1
 
     # Load initial camera position data
     if os.path.exists(initial_position_path):
@@ -89,16 +160,75 @@ def main():
         initial_positions = {}
         logging.warning("Initial camera position data not found.")
 
-    logging.info("Initializing camera...")
-    camera_thread = CameraThread()
-    camera_thread.start()
+    if detection_workers > 0:
+        # Workers take frames off a shared queue, so each one's detector only
+        # sees an arbitrary subset of frames and its "previous frame" state
+        # would be stale. Keep the detectors stateless.
+        stateful = [name for name, enabled in (('tracking', tracking), ('flow_tracking', flow_tracking),
+                                               ('pnp_method warm_start', pnp_method == 'warm_start')) if enabled]
+        if stateful:
+            logging.warning(f"Disabling {', '.join(stateful)} with detection_workers > 0, they need consecutive frames.")
+            tracking = False
+            flow_tracking = False
+            if pnp_method == 'warm_start':
+                pnp_method = 'iterative'
+        # Every in-flight frame pins a slot, leave room for the camera to keep writing
+        frame_buffer_size = max(frame_buffer_size, 2 * detection_workers + 2)
+
+    metrics = Metrics()
+
+    camera_settings = dict(width=camera_width, height=camera_height, fps=camera_fps, fourcc=camera_fourcc, buffer_size=camera_buffer_size)
+    camera_threads = []
+    for camera_id, camera_config in enumerate(camera_configs):
+        logging.info(f"Initializing frame source {camera_config['source']}...")
+        frame_source = open_frame_source(camera_config['source'], replay_pacing, replay_fps, replay_loop,
+                                         {**camera_settings, **camera_config['settings']}, capture_format)
+        camera_thread = CameraThread(buffer_size=frame_buffer_size, shared=detection_workers > 0, source=frame_source, metrics=metrics,
+                                     on_demand=capture_on_demand, camera_label=f'camera{camera_id}' if multi_camera else None)
+        camera_thread.start()
+        camera_threads.append(camera_thread)
 
     # Wait until the first frame is captured
-    camera_thread.frame_ready.wait()
+    for camera_thread in camera_threads:
+        camera_thread.frame_ready.wait()
+
+    # Tag layout of the box, compiled once into per-tag corner arrays
+    box_model = BoxModel(box_face_tags, box_size, tag_size, box_tag_offset)
 
     logging.info("Creating AprilTag detector...")
-    detector = AprilTagDetector(camera_matrix, dist_coeffs, tag_size, zoom)
-    box_position = BoxPosition(initial_positions)  # Assuming BoxPosition takes initial_positions as an argument
+    detector_kwargs = {}
+    detectors = []
+    for camera_id, camera_config in enumerate(camera_configs):
+        camera_matrix, dist_coeffs = load_calibration(camera_config['calibration'])
+        detector_kwargs[camera_id] = dict(camera_matrix=camera_matrix, dist_coeffs=dist_coeffs, tag_size=tag_size,
+                                          zoom=camera_config['zoom'] if camera_config['zoom'] is not None else zoom,
+                                          native_crop=native_crop, tracking=tracking, full_scan_interval=full_scan_interval,
+                                          roi_padding=roi_padding, quad_decimate=quad_decimate, corner_refinement=corner_refinement,
+                                          undistort_points=undistort_points, box_model=box_model if box_pose else None,
+                                          box_pose_ransac=box_pose_ransac, pnp_method=pnp_method, flow_tracking=flow_tracking,
+                                          flow_interval=flow_interval, flow_max_error=flow_max_error,
+                                          flow_max_reprojection=flow_max_reprojection)
+        detectors.append(AprilTagDetector(**detector_kwargs[camera_id]))
+
+    detection_pool = None
+    if detection_workers > 0:
+        detection_pool = DetectionPool(detection_workers, {camera_id: camera_thread.buffer for camera_id, camera_thread in enumerate(camera_threads)},
+                                       detector_kwargs)
+        detection_pool.start()
+    # Initial positions are in the first camera's frame, which the others are mapped into
+    box_position = BoxPosition(initial_positions, box_model)
+    fusion = PoseFusion(fusion_window) if multi_camera else None
+
+    pose_filter = None
+    detection_interval = 0.0
+    if pose_filter_enabled:
+        pose_filter = PoseFilter(pose_filter_position_noise, pose_filter_angle_noise, gate=pose_filter_gate,
+                                 max_coast=pose_filter_max_coast)
+        if detection_rate:
+            detection_interval = 1.0 / detection_rate
+
+    motion_gates = [MotionGate(motion_threshold, motion_hold, motion_min_refresh) if motion_gating else None
+                    for _ in camera_configs]
 
     # Create subdirectories for this run
     run_number = get_next_run_number(BASE_SAVE_DIR)
@@ -110,35 +240,96 @@ def main():
     os.makedirs(run_data_dir)
 
     display_queue = queue.Queue()
+    # Annotated frames are drawn into pooled buffers that every consumer releases
+    buffer_pool = BufferPool(metrics=metrics)
+
+    run_data_writer = None
+    if save_data:
+        run_data_writer = RunDataWriter(run_data_dir, segment_bytes=int(run_data_segment_mb * 1024 * 1024),
+                                        segment_seconds=run_data_segment_hours * 3600, metrics=metrics)
+        run_data_writer.start()
+
+    image_writer = None
+    if save:
+        image_writer = ImageWriterPool(image_writer_threads, image_queue_size, image_format, png_compression,
+                                       jpeg_quality, image_drop_policy, metrics, buffer_pool)
+        image_writer.start()
+
+    video_recorder = None
+    if recording:
+        video_recorder = VideoRecorder(run_image_dir, recording_fps, recording_segment_seconds, recording_codec, metrics=metrics,
+                                       buffer_pool=buffer_pool)
+        video_recorder.start()
+
+    preview_server = None
+    if preview_port:
+        preview_server = PreviewServer(preview_port, preview_host, preview_fps, preview_width, preview_quality, metrics)
+        preview_server.start()
 
     logging.info("Starting video capture...")
     
-    display_thread = DisplayThread(camera_thread, detector, live, display_queue)
+    # The display, preview and recording follow the first camera
+    display_thread = DisplayThread(camera_threads[0], detectors[0], live, display_queue, undistort_display, preview_server, buffer_pool)
     display_thread.start()
 
-    detection_thread = DetectionThread(camera_thread, detector, display_queue, print_delay, save, run_image_dir, save_data, run_data_dir, box_position)
-    detection_thread.start()
+    detection_threads = []
+    for camera_id, camera_thread in enumerate(camera_threads):
+        detection_thread = DetectionThread(camera_thread, detectors[camera_id], display_queue if camera_id == 0 else None, print_delay, save,
+                                           run_image_dir, save_data, run_data_dir, box_position, detect_latest_only, detection_pool, metrics,
+                                           run_data_writer, record_every_frame, image_writer, video_recorder if camera_id == 0 else None,
+                                           undistort_display, pose_filter, detection_interval, motion_gates[camera_id], buffer_pool,
+                                           camera_id, fusion, camera_configs[camera_id]['extrinsics'],
+                                           f'camera{camera_id}' if multi_camera else None)
+        detection_thread.start()
+        detection_threads.append(detection_thread)
 
-    run_data = []
+    metrics_server = None
+    if metrics_port:
+        metrics_server = MetricsServer(metrics, metrics_port)
+        metrics_server.start()
+    metrics_dump_thread = MetricsDumpThread(metrics, run_data_dir, metrics_dump_interval)
+    metrics_dump_thread.start()
 
     try:
-        while True:
+        # Replay sources end on their own, let detection catch up with the last frame
+        while any(camera_thread.is_alive() or (detection_thread.is_alive() and detection_thread.last_sequence < camera_thread.buffer.latest_sequence)
+                  for camera_thread, detection_thread in zip(camera_threads, detection_threads)):
             time.sleep(0.1)
+        logging.info("Frame source exhausted")
 
     except KeyboardInterrupt:
         logging.info("Interrupted by user")
     finally:
         logging.info("Releasing resources...")
         display_thread.stop()
-        detection_thread.stop()
-        camera_thread.stop()
+        for detection_thread in detection_threads:
+            detection_thread.stop()
+        for camera_thread in camera_threads:
+            camera_thread.stop()
         display_thread.join()
-        detection_thread.join()
-        camera_thread.join()
-        cv2.destroyAllWindows()
+        for detection_thread in detection_threads:
+            detection_thread.join()
+        if run_data_writer is not None:
+            run_data_writer.stop()
+        if image_writer is not None:
+            image_writer.stop()
+        if video_recorder is not None:
+            video_recorder.stop()
+        if detection_pool is not None:
+            detection_pool.stop()
+        for camera_thread in camera_threads:
+            camera_thread.join()
+            camera_thread.buffer.close()
+        if preview_server is not None:
+            preview_server.stop()
+        if live:
+            cv2.destroyAllWindows()  # Not available in headless OpenCV builds
+        metrics_dump_thread.stop()
+        if metrics_server is not None:
+            metrics_server.stop()
 
-        if save:
-            user_input_images = input("Do you want to keep the saved images? (y/n): ").strip().lower()
+        if save or recording:
+            user_input_images = input("Do you want to keep the saved images and recordings? (y/n): ").strip().lower()
             if user_input_images == 'n':
                 logging.info("Deleting saved images...")
                 shutil.rmtree(run_image_dir)
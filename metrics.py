@@ -0,0 +1,155 @@
+import os
+import json
+import time
+import logging
+import threading
+import collections
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, float('inf'))
+
+class StageStats:
+    def __init__(self, window=1000):
+        # Percentiles and the histogram cover the last `window` samples,
+        # count and total cover the whole run
+        self.samples = collections.deque(maxlen=window)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, seconds):
+        self.samples.append(seconds)
+        self.count += 1
+        self.total += seconds
+
+    def snapshot(self):
+        samples = np.array(self.samples)
+        snapshot = {'count': self.count, 'total_seconds': self.total}
+        if samples.size:
+            p50, p95, p99 = np.percentile(samples, [50, 95, 99])
+            snapshot.update({
+                'mean': float(samples.mean()),
+                'p50': float(p50),
+                'p95': float(p95),
+                'p99': float(p99),
+                'max': float(samples.max()),
+                'histogram': {str(bound): int(np.count_nonzero(samples <= bound)) for bound in LATENCY_BUCKETS},
+            })
+        return snapshot
+
+class Metrics:
+    def __init__(self, window=1000):
+        self.window = window
+        self.stages = {}
+        self.collectors = []
+        self.start_time = time.time()
+        self.lock = threading.Lock()
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            if stage not in self.stages:
+                self.stages[stage] = StageStats(self.window)
+            self.stages[stage].observe(seconds)
+
+    def observe_all(self, stage_times):
+        for stage, seconds in stage_times.items():
+            self.observe(stage, seconds)
+
+    def add_collector(self, collector):
+        # collector() returns a dict of gauges, read whenever a snapshot is taken
+        self.collectors.append(collector)
+
+    def snapshot(self):
+        gauges = {}
+        for collector in self.collectors:
+            try:
+                gauges.update(collector())
+            except Exception as e:
+                logging.warning(f"Metrics collector failed: {e}")
+        with self.lock:
+            return {
+                'timestamp': time.time(),
+                'uptime_seconds': time.time() - self.start_time,
+                'stages': {stage: stats.snapshot() for stage, stats in self.stages.items()},
+                'gauges': gauges,
+            }
+
+    def prometheus_text(self):
+        snapshot = self.snapshot()
+        lines = [
+            '# TYPE eigsep_uptime_seconds gauge',
+            f'eigsep_uptime_seconds {snapshot["uptime_seconds"]}',
+            '# TYPE eigsep_stage_latency_seconds summary',
+        ]
+        for stage, stats in sorted(snapshot['stages'].items()):
+            for key, quantile in (('p50', '0.5'), ('p95', '0.95'), ('p99', '0.99')):
+                if key in stats:
+                    lines.append(f'eigsep_stage_latency_seconds{{stage="{stage}",quantile="{quantile}"}} {stats[key]}')
+            lines.append(f'eigsep_stage_latency_seconds_sum{{stage="{stage}"}} {stats["total_seconds"]}')
+            lines.append(f'eigsep_stage_latency_seconds_count{{stage="{stage}"}} {stats["count"]}')
+        for name, value in sorted(snapshot['gauges'].items()):
+            if value is None:
+                continue
+            lines.append(f'# TYPE eigsep_{name} gauge')
+            lines.append(f'eigsep_{name} {float(value)}')
+        return '\n'.join(lines) + '\n'
+
+class MetricsServer(threading.Thread):
+    def __init__(self, metrics, port, host='127.0.0.1'):
+        threading.Thread.__init__(self, daemon=True)
+        handler = type('MetricsHandler', (MetricsRequestHandler,), {'metrics': metrics})
+        self.server = ThreadingHTTPServer((host, port), handler)
+
+    def run(self):
+        logging.info(f"Serving metrics on http://{self.server.server_address[0]}:{self.server.server_address[1]}/metrics")
+        self.server.serve_forever()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    metrics = None
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            body = self.metrics.prometheus_text().encode()
+            content_type = 'text/plain; version=0.0.4'
+        elif self.path == '/metrics.json':
+            body = json.dumps(self.metrics.snapshot()).encode()
+            content_type = 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Keep scrapes out of the run log
+
+class MetricsDumpThread(threading.Thread):
+    def __init__(self, metrics, data_dir, interval=60):
+        threading.Thread.__init__(self, daemon=True)
+        self.metrics = metrics
+        self.path = os.path.join(data_dir, 'metrics.json')
+        self.interval = interval
+        self.stop_event = threading.Event()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            self.dump()
+
+    def dump(self):
+        # Write then rename so a reader never sees a half-written file
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as file:
+            json.dump(self.metrics.snapshot(), file, indent=2)
+        os.replace(temp_path, self.path)
+
+    def stop(self):
+        self.stop_event.set()
+        self.dump()
@@ -0,0 +1,68 @@
+import cv2
+import numpy as np
+from frame_sources import luma
+
+MOTION_MODES = ('active', 'idle')
+
+class MotionGate:
+    # Decides whether a frame is worth a detection pass. Each frame is
+    # shrunk to a thumbnail and compared with the thumbnail of the last
+    # detected frame, so slow drift adds up until it triggers. While idle,
+    # detection still runs every min_refresh seconds.
+    def __init__(self, threshold=3.0, hold=2.0, min_refresh=10.0, thumbnail_width=80):
+        self.threshold = threshold  # Mean absolute difference in grey levels
+        self.hold = hold  # Seconds to stay active after the last motion
+        self.min_refresh = min_refresh
+        self.thumbnail_width = thumbnail_width
+        self.reference = None
+        self.thumbnail = None
+        self.score = 0.0
+        self.mode = 'active'
+        self.last_motion_time = None
+        self.last_detection_time = None
+        self.last_time = None
+        self.mode_seconds = {mode: 0.0 for mode in MOTION_MODES}
+
+    def make_thumbnail(self, frame):
+        height, width = frame.shape[:2]
+        size = (self.thumbnail_width, max(1, round(height * self.thumbnail_width / width)))
+        # Subsample with a strided view first so the area resize only reads
+        # a fraction of the pixels, and shrink before converting so cvtColor
+        # only sees the thumbnail
+        step = max(1, width // (4 * self.thumbnail_width))
+        thumbnail = cv2.resize(frame[::step, ::step], size, interpolation=cv2.INTER_AREA)
+        return np.ascontiguousarray(luma(thumbnail))
+
+    def wants_detection(self, frame, timestamp):
+        self.thumbnail = self.make_thumbnail(frame)
+        if self.reference is None or self.reference.shape != self.thumbnail.shape:
+            self.score = float('inf')
+        else:
+            self.score = float(cv2.absdiff(self.thumbnail, self.reference).mean())
+        if self.score > self.threshold and self.reference is not None:
+            self.last_motion_time = timestamp
+
+        # Time since the previous frame counts towards the mode it was in
+        if self.last_time is not None:
+            self.mode_seconds[self.mode] += max(0.0, timestamp - self.last_time)
+        self.last_time = timestamp
+        self.mode = 'active' if self.last_motion_time is not None and timestamp - self.last_motion_time <= self.hold else 'idle'
+
+        if self.mode == 'active' or self.reference is None:
+            return True
+        return self.last_detection_time is None or timestamp - self.last_detection_time >= self.min_refresh
+
+    def detected(self, timestamp):
+        # The frame last passed to wants_detection was detected on, it becomes the reference
+        self.reference = self.thumbnail
+        self.last_detection_time = timestamp
+
+    def stats(self):
+        total = sum(self.mode_seconds.values())
+        return {
+            'mode': self.mode,
+            'score': self.score if np.isfinite(self.score) else None,
+            'active_seconds': self.mode_seconds['active'],
+            'idle_seconds': self.mode_seconds['idle'],
+            'idle_fraction': self.mode_seconds['idle'] / total if total else 0.0,
+        }
@@ -0,0 +1,138 @@
+import json
+import threading
+import cv2
+import numpy as np
+
+def euler_to_matrix(angles):
+    # Inverse of cv2.RQDecomp3x3's Euler angles (degrees): R = Rz @ Ry @ Rx
+    x, y, z = np.radians(angles)
+    rx = np.array([[1, 0, 0], [0, np.cos(x), -np.sin(x)], [0, np.sin(x), np.cos(x)]])
+    ry = np.array([[np.cos(y), 0, np.sin(y)], [0, 1, 0], [-np.sin(y), 0, np.cos(y)]])
+    rz = np.array([[np.cos(z), -np.sin(z), 0], [np.sin(z), np.cos(z), 0], [0, 0, 1]])
+    return rz @ ry @ rx
+
+def load_extrinsics(value):
+    # A dict, or the path of a JSON file holding one, with 'rotation' (a
+    # Rodrigues vector in radians or a 3x3 matrix) and 'translation' (metres).
+    # Maps camera coordinates into the reference frame: p_ref = R p_cam + t.
+    # None is the reference camera itself.
+    if value is None:
+        return np.eye(3), np.zeros(3)
+    if isinstance(value, str):
+        with open(value, 'r') as file:
+            value = json.load(file)
+    rotation = np.asarray(value.get('rotation', [0, 0, 0]), dtype=np.float64)
+    if rotation.shape != (3, 3):
+        rotation, _ = cv2.Rodrigues(rotation.reshape(3, 1))
+    return rotation, np.asarray(value.get('translation', [0, 0, 0]), dtype=np.float64).reshape(3)
+
+class CameraExtrinsics:
+    def __init__(self, rotation=None, translation=None):
+        self.rotation = np.eye(3) if rotation is None else np.asarray(rotation, dtype=np.float64)
+        self.translation = np.zeros(3) if translation is None else np.asarray(translation, dtype=np.float64).reshape(3)
+        self.identity = np.allclose(self.rotation, np.eye(3)) and not self.translation.any()
+
+    @classmethod
+    def load(cls, value):
+        return cls(*load_extrinsics(value))
+
+    def transform_tags(self, positions_orientations):
+        # Per-tag (tag_id, position, tvec, orientation) into the reference frame
+        if self.identity:
+            return positions_orientations
+        transformed = []
+        for tag_id, position, tvec, orientation in positions_orientations:
+            if position is None:
+                transformed.append((tag_id, position, tvec, orientation))
+                continue
+            position = self.rotation @ np.asarray(position, dtype=np.float64) + self.translation
+            rotation = self.rotation @ euler_to_matrix(orientation)
+            transformed.append((tag_id, position, position.reshape(3, 1), cv2.RQDecomp3x3(rotation)[0]))
+        return transformed
+
+    def transform_box_pose(self, box_pose):
+        if box_pose is None or self.identity:
+            return box_pose
+        rvec, tvec, used_tag_ids, error = box_pose
+        rotation = self.rotation @ cv2.Rodrigues(rvec)[0]
+        tvec = self.rotation @ tvec.reshape(3) + self.translation
+        return cv2.Rodrigues(rotation)[0], tvec.reshape(3, 1), used_tag_ids, error
+
+class PoseFusion:
+    # Combines the observations of several cameras, already in the
+    # reference frame, into one. Each camera's latest observation counts
+    # while it is within `window` seconds of the frame being fused.
+    def __init__(self, window=0.1):
+        self.window = window
+        self.lock = threading.RLock()  # Also held by callers around the shared pose estimate
+        self.observations = {}  # camera_id -> (capture_time, positions_orientations, box_pose)
+        self.fused_cameras = 0
+        self.box_errors = {}  # camera_id -> box pose reprojection error in pixels, for the last fusion
+
+    def update(self, camera_id, capture_time, positions_orientations, box_pose=None):
+        # Returns the fused (positions_orientations, box_pose)
+        with self.lock:
+            self.observations[camera_id] = (capture_time, positions_orientations, box_pose)
+            current = {other_id: observation for other_id, observation in self.observations.items()
+                       if abs(observation[0] - capture_time) <= self.window}
+            self.fused_cameras = len(current)
+            # Each camera's error is in its own image's pixels, so they are
+            # reported side by side rather than averaged
+            self.box_errors = {other_id: observation[2][3] for other_id, observation in current.items() if observation[2] is not None}
+            return self.merge_tags([observation[1] for observation in current.values()]), \
+                self.merge_box_poses([observation[2] for observation in current.values() if observation[2] is not None])
+
+    @staticmethod
+    def merge_tags(tag_lists):
+        # A tag seen by several cameras becomes one observation at the mean position
+        merged = {}
+        for positions_orientations in tag_lists:
+            for tag_id, position, tvec, orientation in positions_orientations:
+                if position is None:
+                    merged.setdefault(tag_id, [])
+                    continue
+                merged.setdefault(tag_id, []).append((position, orientation))
+        fused = []
+        for tag_id, observations in merged.items():
+            if not observations:
+                fused.append((tag_id, None, None, None))
+                continue
+            position = np.mean([position for position, _ in observations], axis=0)
+            fused.append((tag_id, position, position.reshape(3, 1), observations[0][1]))
+        return fused
+
+    @staticmethod
+    def merge_box_poses(box_poses):
+        # Weighted by the number of tags behind each pose. Rotations are
+        # averaged as matrices and projected back onto a rotation. The error
+        # is the worst camera's, see PoseFusion.box_errors for each one.
+        if not box_poses:
+            return None
+        if len(box_poses) == 1:
+            return box_poses[0]
+        weights = np.array([len(used_tag_ids) for _, _, used_tag_ids, _ in box_poses], dtype=np.float64)
+        weights /= weights.sum()
+        rotations = np.array([cv2.Rodrigues(rvec)[0] for rvec, _, _, _ in box_poses])
+        u, _, vt = np.linalg.svd(np.tensordot(weights, rotations, axes=1))
+        rotation = u @ np.diag([1, 1, np.linalg.det(u @ vt)]) @ vt
+        tvec = np.tensordot(weights, np.array([tvec.reshape(3) for _, tvec, _, _ in box_poses]), axes=1)
+        used_tag_ids = sorted({tag_id for _, _, used, _ in box_poses for tag_id in used})
+        error = max(error for _, _, _, error in box_poses)
+        return cv2.Rodrigues(rotation)[0], tvec.reshape(3, 1), used_tag_ids, error
+
+def load_camera_configs(config, source=0, calibration_path='camera_calibration_data.npz'):
+    # The 'cameras' list of the config, or just the top-level camera. Each
+    # entry may set source, calibration, extrinsics, zoom and the capture
+    # settings width, height, fps, fourcc and buffer_size. Camera 0 defaults
+    # to the top-level source and calibration, the others to their index.
+    cameras = config.get('cameras') or [{}]
+    configs = []
+    for camera_id, camera in enumerate(cameras):
+        configs.append({
+            'source': camera.get('source', source if camera_id == 0 else camera_id),
+            'calibration': camera.get('calibration', calibration_path),
+            'extrinsics': CameraExtrinsics.load(camera.get('extrinsics')),
+            'zoom': camera.get('zoom'),
+            'settings': {key: camera[key] for key in ('width', 'height', 'fps', 'fourcc', 'buffer_size') if key in camera},
+        })
+    return configs
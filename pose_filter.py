@@ -0,0 +1,117 @@
+import numpy as np
+
+class ConstantVelocityChannel:
+    # Kalman filter for a constant-velocity model on one or more independent
+    # axes with the same noise, so a single 2x2 covariance serves all of them
+    def __init__(self, measurement_noise, acceleration_noise, dims=1, period=None):
+        self.measurement_variance = measurement_noise ** 2
+        self.acceleration_variance = acceleration_noise ** 2
+        self.period = period  # Wrap innovations for angles
+        self.state = np.zeros((2, dims))  # Value and rate per axis
+        self.covariance = None
+        self.time = None
+
+    def reset(self, timestamp, value):
+        self.state[0] = value
+        self.state[1] = 0.0
+        self.covariance = np.diag([self.measurement_variance, self.acceleration_variance])
+        self.time = timestamp
+
+    def predicted(self, timestamp):
+        dt = max(0.0, timestamp - self.time)
+        transition = np.array([[1.0, dt], [0.0, 1.0]])
+        process = self.acceleration_variance * np.array([[dt ** 4 / 4, dt ** 3 / 2], [dt ** 3 / 2, dt ** 2]])
+        state = transition @ self.state
+        covariance = transition @ self.covariance @ transition.T + process
+        if self.period is not None:
+            state[0] %= self.period
+        return state, covariance
+
+    def innovation(self, state, covariance, value):
+        residual = np.asarray(value, dtype=np.float64) - state[0]
+        if self.period is not None:
+            residual = (residual + self.period / 2) % self.period - self.period / 2
+        return residual, covariance[0, 0] + self.measurement_variance
+
+    def update(self, timestamp, state, covariance, residual, innovation_variance):
+        gain = covariance[:, 0] / innovation_variance
+        self.state = state + np.outer(gain, residual)
+        self.covariance = covariance - np.outer(gain, covariance[0, :])
+        if self.period is not None:
+            self.state[0] %= self.period
+        self.time = timestamp
+
+class PoseFilter:
+    # Tracks the box position and relative orientation between detections.
+    # Measurements further than `gate` standard deviations from the
+    # prediction are rejected; after `max_rejections` in a row the filter
+    # assumes the box really moved and restarts from the measurement.
+    def __init__(self, position_noise=0.005, angle_noise=1.0, position_acceleration=0.05, angle_acceleration=2.0,
+                 gate=4.0, max_rejections=3, max_coast=5.0):
+        self.position = ConstantVelocityChannel(position_noise, position_acceleration, dims=3)
+        self.angle = ConstantVelocityChannel(angle_noise, angle_acceleration, period=360.0)
+        self.angle_noise = angle_noise
+        self.gate = gate
+        self.max_rejections = max_rejections
+        self.max_coast = max_coast  # Seconds without a measurement before the estimate is dropped
+        self.initialized = False
+        self.rejections = 0
+        self.accepted_count = 0
+        self.rejected_count = 0
+
+    def confidence(self, angle_covariance):
+        # 1 right after a measurement, falling as the prediction uncertainty
+        # outgrows the measurement noise
+        return float(min(1.0, self.angle_noise / np.sqrt(angle_covariance[0, 0])))
+
+    def predict(self, timestamp):
+        # Returns (position, relative_orientation, confidence), all None when
+        # there is no recent enough estimate. Does not change the state.
+        if not self.initialized or timestamp - self.angle.time > self.max_coast:
+            return None, None, 0.0
+        position_state, _ = self.position.predicted(timestamp)
+        angle_state, angle_covariance = self.angle.predicted(timestamp)
+        return position_state[0].copy(), float(angle_state[0, 0]), self.confidence(angle_covariance)
+
+    def update(self, timestamp, position, relative_orientation):
+        # Returns (position, relative_orientation, confidence, accepted)
+        if position is None or relative_orientation is None:
+            return (*self.predict(timestamp), False)
+        position = np.asarray(position, dtype=np.float64)
+
+        if not self.initialized or timestamp - self.angle.time > self.max_coast:
+            self.restart(timestamp, position, relative_orientation)
+            return position, float(relative_orientation), 1.0, True
+
+        position_state, position_covariance = self.position.predicted(timestamp)
+        angle_state, angle_covariance = self.angle.predicted(timestamp)
+        position_residual, position_variance = self.position.innovation(position_state, position_covariance, position)
+        angle_residual, angle_variance = self.angle.innovation(angle_state, angle_covariance, relative_orientation)
+
+        distance = max(np.abs(position_residual).max() / np.sqrt(position_variance),
+                       np.abs(angle_residual).max() / np.sqrt(angle_variance))
+        if distance > self.gate:
+            self.rejections += 1
+            self.rejected_count += 1
+            if self.rejections < self.max_rejections:
+                return position_state[0].copy(), float(angle_state[0, 0]), self.confidence(angle_covariance), False
+            # Consistently off: the box really moved, start over
+            self.restart(timestamp, position, relative_orientation)
+            return position, float(relative_orientation), 1.0, True
+
+        self.rejections = 0
+        self.accepted_count += 1
+        self.position.update(timestamp, position_state, position_covariance, position_residual, position_variance)
+        self.angle.update(timestamp, angle_state, angle_covariance, angle_residual, angle_variance)
+        return self.position.state[0].copy(), float(self.angle.state[0, 0]), self.confidence(self.angle.covariance), True
+
+    def restart(self, timestamp, position, relative_orientation):
+        self.position.reset(timestamp, position)
+        self.angle.reset(timestamp, relative_orientation % 360.0)
+        self.initialized = True
+        self.rejections = 0
+        self.accepted_count += 1
+
+    def angular_rate(self):
+        # Degrees per second of the relative orientation, None before the first measurement
+        return float(self.angle.state[1, 0]) if self.initialized else None
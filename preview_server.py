@@ -0,0 +1,158 @@
+import time
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import cv2
+
+BOUNDARY = 'frame'
+
+class PreviewServer(threading.Thread):
+    # Local MJPEG preview for headless units. Frames are shrunk and JPEG
+    # encoded at most max_fps times per second, and only while someone is
+    # watching; every client is sent the same encoded bytes.
+    def __init__(self, port, host='127.0.0.1', max_fps=5, max_width=640, quality=70, metrics=None):
+        threading.Thread.__init__(self, daemon=True)
+        self.max_fps = max_fps
+        self.max_width = max_width
+        self.encode_params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+        self.condition = threading.Condition()
+        self.pending = None  # Latest shrunk frame waiting for the encoder
+        self.jpeg = None
+        self.frame_id = 0
+        self.clients = 0
+        self.last_publish = 0.0
+        self.frames_encoded = 0
+        self.running = True
+        self.encoder = threading.Thread(target=self.encode_loop, daemon=True)
+        handler = type('PreviewHandler', (PreviewRequestHandler,), {'preview': self})
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+        if metrics is not None:
+            metrics.add_collector(self.collect_metrics)
+
+    def collect_metrics(self):
+        return {
+            'preview_clients': self.clients,
+            'preview_frames_encoded': self.frames_encoded,
+        }
+
+    def wants_frame(self):
+        # Lets producers skip preparing a frame nobody will see
+        return self.clients > 0 and time.monotonic() - self.last_publish >= 1.0 / self.max_fps
+
+    def publish(self, frame):
+        if not self.wants_frame():
+            return False
+        self.last_publish = time.monotonic()
+        # Shrinking also copies, so the caller keeps ownership of frame
+        height, width = frame.shape[:2]
+        if width > self.max_width:
+            frame = cv2.resize(frame, (self.max_width, round(height * self.max_width / width)), interpolation=cv2.INTER_AREA)
+        else:
+            frame = frame.copy()
+        with self.condition:
+            self.pending = frame
+            self.condition.notify_all()
+        return True
+
+    def encode_loop(self):
+        while self.running:
+            with self.condition:
+                self.condition.wait_for(lambda: self.pending is not None or not self.running)
+                frame, self.pending = self.pending, None
+            if frame is None:
+                continue
+            success, jpeg = cv2.imencode('.jpg', frame, self.encode_params)
+            if not success:
+                continue
+            with self.condition:
+                self.jpeg = jpeg.tobytes()
+                self.frame_id += 1
+                self.frames_encoded += 1
+                self.condition.notify_all()
+
+    def next_frame(self, last_id, timeout=1.0):
+        # Blocks until a newer frame than last_id is encoded. Returns
+        # (frame_id, jpeg), or (last_id, None) on timeout or shutdown.
+        with self.condition:
+            self.condition.wait_for(lambda: self.frame_id != last_id or not self.running, timeout)
+            if self.frame_id == last_id or not self.running:
+                return last_id, None
+            return self.frame_id, self.jpeg
+
+    def run(self):
+        self.encoder.start()
+        logging.info(f"Serving preview on http://{self.server.server_address[0]}:{self.server.server_address[1]}/")
+        self.server.serve_forever()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.server.shutdown()
+        self.server.server_close()
+        self.encoder.join()
+
+class PreviewRequestHandler(BaseHTTPRequestHandler):
+    preview = None
+
+    def do_GET(self):
+        if self.path == '/':
+            body = b'<html><body style="margin:0;background:#000"><img src="/stream" style="max-width:100%"></body></html>'
+            self.send_body(body, 'text/html')
+        elif self.path == '/snapshot.jpg':
+            self.serve_snapshot()
+        elif self.path == '/stream':
+            self.serve_stream()
+        else:
+            self.send_error(404)
+
+    def send_body(self, body, content_type):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def serve_snapshot(self):
+        # Counts as a client until the next frame is encoded, so the
+        # snapshot is fresh; falls back to the last frame on timeout
+        with self.preview.condition:
+            self.preview.clients += 1
+            last_id = self.preview.frame_id
+        try:
+            _, jpeg = self.preview.next_frame(last_id, timeout=2.0)
+        finally:
+            with self.preview.condition:
+                self.preview.clients -= 1
+        jpeg = jpeg or self.preview.jpeg
+        if jpeg is None:
+            self.send_error(503, 'No frame available yet')
+            return
+        self.send_body(jpeg, 'image/jpeg')
+
+    def serve_stream(self):
+        self.send_response(200)
+        self.send_header('Content-Type', f'multipart/x-mixed-replace; boundary={BOUNDARY}')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        with self.preview.condition:
+            self.preview.clients += 1
+        try:
+            frame_id = 0
+            while self.preview.running:
+                frame_id, jpeg = self.preview.next_frame(frame_id)
+                if jpeg is None:
+                    continue
+                self.wfile.write(f'--{BOUNDARY}\r\nContent-Type: image/jpeg\r\nContent-Length: {len(jpeg)}\r\n\r\n'.encode())
+                self.wfile.write(jpeg)
+                self.wfile.write(b'\r\n')
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # Viewer went away
+        finally:
+            with self.preview.condition:
+                self.preview.clients -= 1
+
+    def log_message(self, format, *args):
+        pass  # Keep viewers out of the run log
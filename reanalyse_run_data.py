@@ -0,0 +1,50 @@
+import os
+import json
+import time
+import argparse
+import numpy as np
+from box_model import BoxModel
+from box_position import BoxPosition, observations_from_records
+from run_data_writer import read_run_data
+
+def main():
+    parser = argparse.ArgumentParser(description="Recompute box positions, orientations and rotation counts from logged run data.")
+    parser.add_argument('data_dir', type=str, help='Run data directory (saved_data/run*).')
+    parser.add_argument('-con', '--config', type=str, default='config.json', help='Path to configuration file')
+    parser.add_argument('-ip', '--initial_position', type=str, default='initial_camera_position.json', help='Path to initial camera position data')
+    parser.add_argument('-o', '--output', type=str, default=None, help='Output .npz file (default: box_poses.npz in the data directory).')
+    args = parser.parse_args()
+
+    config = {}
+    if os.path.exists(args.config):
+        with open(args.config, 'r') as file:
+            config = json.load(file)
+    if not os.path.exists(args.initial_position):
+        print(f"Initial camera position data {args.initial_position} not found.")
+        return
+    with open(args.initial_position, 'r') as file:
+        initial_positions = json.load(file)
+    box_model = BoxModel(config.get("box_face_tags"), config.get("box_size", 0.3), config.get("tag_size", 0.080),
+                         config.get("box_tag_offset"))
+
+    load_start = time.perf_counter()
+    observations, capture_times = observations_from_records(read_run_data(args.data_dir))
+    load_time = time.perf_counter() - load_start
+    if len(capture_times) == 0:
+        print("No run data records found.")
+        return
+
+    analysis_start = time.perf_counter()
+    poses = BoxPosition(initial_positions, box_model).calculate_orientations(observations, len(capture_times))
+    analysis_time = time.perf_counter() - analysis_start
+
+    output = args.output or os.path.join(args.data_dir, 'box_poses.npz')
+    np.savez(output, capture_time=capture_times, position=poses['position'], orientation=poses['orientation'],
+             relative_orientation=poses['relative_orientation'], rotation_count=poses['rotation_count'])
+    print(f"Loaded {len(capture_times)} records with {len(observations)} tag observations in {load_time:.2f} s.")
+    print(f"Analysed them in {analysis_time:.3f} s: {np.count_nonzero(~np.isnan(poses['orientation']))} frames with a position, "
+          f"{poses['rotation_count'][-1]} rotations.")
+    print(f"Saved box poses to {output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+import os
+import glob
+import json
+import time
+import queue
+import logging
+import threading
+import numpy as np
+
+class RunDataWriter(threading.Thread):
+    def __init__(self, data_dir, prefix='run_data', max_queue=10000, segment_bytes=64 * 1024 * 1024,
+                 segment_seconds=3600, fsync_interval=1.0, metrics=None):
+        threading.Thread.__init__(self, daemon=True)
+        self.data_dir = data_dir
+        self.prefix = prefix
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.segment_bytes = segment_bytes
+        self.segment_seconds = segment_seconds
+        self.fsync_interval = fsync_interval  # Records are batched between fsyncs
+        self.segment_index = -1
+        self.file = None
+        self.segment_start = 0.0
+        self.records_written = 0
+        self.records_dropped = 0
+        if metrics is not None:
+            metrics.add_collector(self.collect_metrics)
+
+    def collect_metrics(self):
+        return {
+            'run_data_queue_depth': self.queue.qsize(),
+            'run_data_records_written': self.records_written,
+            'run_data_records_dropped': self.records_dropped,
+        }
+
+    def write(self, record):
+        # Never block the caller; if the disk can't keep up the record is dropped
+        try:
+            self.queue.put_nowait(record)
+            return True
+        except queue.Full:
+            self.records_dropped += 1
+            return False
+
+    def run(self):
+        self.open_segment()
+        last_sync = time.monotonic()
+        while True:
+            try:
+                record = self.queue.get(timeout=self.fsync_interval)
+            except queue.Empty:
+                record = False
+            if record is None:
+                break
+            if record is not False:
+                self.file.write(json.dumps(record, default=self.json_default) + '\n')
+                self.records_written += 1
+
+            now = time.monotonic()
+            if now - last_sync >= self.fsync_interval:
+                self.sync()
+                last_sync = now
+                if self.file.tell() >= self.segment_bytes or time.time() - self.segment_start >= self.segment_seconds:
+                    self.open_segment()
+
+        self.sync()
+        self.file.close()
+        logging.info(f"Run data writer closed after {self.records_written} records ({self.records_dropped} dropped).")
+
+    def open_segment(self):
+        if self.file is not None:
+            self.sync()
+            self.file.close()
+        self.segment_index += 1
+        self.segment_start = time.time()
+        path = os.path.join(self.data_dir, f'{self.prefix}_{self.segment_index:04d}.jsonl')
+        self.file = open(path, 'a')
+        logging.info(f"Writing run data to {path}")
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    @staticmethod
+    def json_default(value):
+        if isinstance(value, (np.ndarray, np.generic)):
+            return value.tolist()
+        raise TypeError(f"Cannot serialize {type(value).__name__}")
+
+    def stop(self):
+        self.queue.put(None)
+        self.join()
+
+def read_run_data(data_dir, prefix='run_data'):
+    # Yield the records of every segment in order. A line cut short by a
+    # crash or power loss is skipped.
+    for path in sorted(glob.glob(os.path.join(data_dir, f'{prefix}_*.jsonl'))):
+        with open(path, 'r') as file:
+            for line in file:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    logging.warning(f"Skipping truncated record in {path}")
@@ -0,0 +1,259 @@
+import os
+import json
+import time
+import argparse
+import cv2
+import numpy as np
+from apriltag_detector import AprilTagDetector, PNP_METHODS
+from box_position import BoxPosition
+from box_model import BoxModel, FACE_ANGLES, rotation_y
+
+def make_marker(tag_id, side_pixels=160):
+    dictionary = cv2.aruco.getPredefinedDictionary(cv2.aruco.DICT_APRILTAG_36h11)
+    if hasattr(cv2.aruco, 'generateImageMarker'):
+        return cv2.aruco.generateImageMarker(dictionary, tag_id, side_pixels)
+    return cv2.aruco.drawMarker(dictionary, tag_id, side_pixels)
+
+def rotation_x(angle):
+    c, s = np.cos(angle), np.sin(angle)
+    return np.array([[1, 0, 0], [0, c, -s], [0, s, c]])
+
+def build_box(face_tags, box_size, tag_size):
+    # Corners (top-left, top-right, bottom-right, bottom-left of the printed
+    # tag) of every tag in the box frame. The box rotates about its y axis;
+    # a face at angle 0 points at the camera (-z) with its top towards -y.
+    tags = {}
+    faces = {}
+    half = box_size / 2
+    offset = box_size / 4
+    for face, angle in FACE_ANGLES.items():
+        rotation = rotation_y(np.radians(angle))
+        right = rotation @ np.array([1.0, 0, 0])
+        up = np.array([0, -1.0, 0])
+        normal = rotation @ np.array([0, 0, -1.0])
+        centre = normal * half
+        faces[face] = (normal, np.array([centre + sx * half * right + sy * half * up for sx, sy in ((-1, 1), (1, 1), (1, -1), (-1, -1))]))
+        for position, tag_id in face_tags[face].items():
+            sy = 1 if position.startswith('top') else -1
+            sx = -1 if position.endswith('left') else 1
+            tag_centre = centre + sx * offset * right + sy * offset * up
+            tags[tag_id] = (face, np.array([
+                tag_centre + (-right + up) * tag_size / 2,
+                tag_centre + (right + up) * tag_size / 2,
+                tag_centre + (right - up) * tag_size / 2,
+                tag_centre + (-right - up) * tag_size / 2,
+            ]))
+    return faces, tags
+
+def render_scene(faces, tags, markers, rotation, translation, camera_matrix, dist_coeffs, size, blur, noise, rng):
+    width, height = size
+    frame = np.full((height, width), 90, dtype=np.uint8)
+    rvec, _ = cv2.Rodrigues(rotation)
+    ground_truth = {}
+
+    # Painter's order, far faces first, back faces culled
+    visible_faces = []
+    for face, (normal, corners) in faces.items():
+        camera_normal = rotation @ normal
+        centre = rotation @ corners.mean(axis=0) + translation
+        if np.dot(camera_normal, centre) < -0.2 * np.linalg.norm(centre):
+            visible_faces.append((centre[2], face))
+    for _, face in sorted(visible_faces, reverse=True):
+        image_corners, _ = cv2.projectPoints(faces[face][1], rvec, translation, camera_matrix, dist_coeffs)
+        cv2.fillConvexPoly(frame, np.int32(np.round(image_corners.reshape(-1, 2))), 235, lineType=cv2.LINE_AA)
+
+        for tag_id, (tag_face, corners) in tags.items():
+            if tag_face != face:
+                continue
+            image_corners, _ = cv2.projectPoints(corners, rvec, translation, camera_matrix, dist_coeffs)
+            image_corners = image_corners.reshape(-1, 2)
+            marker = markers[tag_id]
+            side = marker.shape[0]
+            # warpPerspective samples pixel centres, the marker's outer edge is at -0.5
+            marker_corners = np.float32([[-0.5, -0.5], [side - 0.5, -0.5], [side - 0.5, side - 0.5], [-0.5, side - 0.5]])
+            homography = cv2.getPerspectiveTransform(marker_corners, np.float32(image_corners))
+            warped = cv2.warpPerspective(marker, homography, (width, height), flags=cv2.INTER_AREA, borderValue=0)
+            mask = cv2.warpPerspective(np.full_like(marker, 255), homography, (width, height), flags=cv2.INTER_AREA, borderValue=0)
+            alpha = mask.astype(np.float32) / 255
+            frame = (frame * (1 - alpha) + warped * alpha).astype(np.uint8)
+
+            # Detector tag frame: x towards the printed left, y towards the
+            # printed top, origin at the tag centre
+            camera_corners = (rotation @ corners.T).T + translation
+            x_axis = camera_corners[0] - camera_corners[1]
+            y_axis = camera_corners[0] - camera_corners[3]
+            x_axis /= np.linalg.norm(x_axis)
+            y_axis /= np.linalg.norm(y_axis)
+            tag_rotation = np.column_stack([x_axis, y_axis, np.cross(x_axis, y_axis)])
+            ground_truth[tag_id] = (camera_corners.mean(axis=0), tag_rotation, image_corners)
+
+    if blur > 0:
+        frame = cv2.GaussianBlur(frame, (0, 0), blur)
+    if noise > 0:
+        frame = np.clip(frame + rng.normal(0, noise, frame.shape), 0, 255).astype(np.uint8)
+    return cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR), ground_truth
+
+def rotation_error_degrees(rotation, reference):
+    cos_angle = (np.trace(rotation.T @ reference) - 1) / 2
+    return np.degrees(np.arccos(np.clip(cos_angle, -1, 1)))
+
+def summarize(values, scale=1.0):
+    if not values:
+        return None
+    values = np.asarray(values) * scale
+    return {
+        'mean': float(np.mean(values)),
+        'p50': float(np.percentile(values, 50)),
+        'p95': float(np.percentile(values, 95)),
+        'max': float(np.max(values)),
+    }
+
+def run_case(zoom, tag_size, distance, args, camera_matrix, dist_coeffs, box_position_tags, rng):
+    faces, tags = build_box(box_position_tags, args.box_size, tag_size)
+    markers = {tag_id: make_marker(tag_id) for tag_id in tags}
+    box_model = BoxModel(box_position_tags, args.box_size, tag_size)
+    detector = AprilTagDetector(camera_matrix, dist_coeffs, tag_size, zoom, args.native_crop,
+                                quad_decimate=args.quad_decimate, corner_refinement=args.corner_refinement,
+                                box_model=box_model if args.box_pose else None, box_pose_ransac=args.box_pose_ransac,
+                                pnp_method=args.pnp_method, flow_tracking=args.flow_tracking, flow_interval=args.flow_interval)
+    size = (args.width, args.height)
+    initial_positions = None
+    latencies = {'zoom': [], 'cvtColor': [], 'detect': [], 'pose': [], 'box': []}
+    translation_errors = []
+    rotation_errors = []
+    box_translation_errors = []
+    box_rotation_errors = []
+    visible = 0
+    detected = 0
+
+    for frame_index in range(args.frames):
+        if args.motion:
+            # A continuous turn, so trackers and warm starts see related frames
+            yaw = np.radians(-frame_index * args.motion)
+            tilt = np.radians(args.max_angle / 4)
+        else:
+            face = rng.choice(list(FACE_ANGLES))
+            yaw = np.radians(-FACE_ANGLES[face] + rng.uniform(-args.max_angle, args.max_angle))
+            tilt = np.radians(rng.uniform(-args.max_angle, args.max_angle) / 2)
+        rotation = rotation_x(tilt) @ rotation_y(yaw)
+        if args.motion:
+            translation = np.array([0.0, 0.0, distance + args.box_size / 2])
+        else:
+            translation = np.array([rng.uniform(-0.02, 0.02), rng.uniform(-0.02, 0.02), distance + args.box_size / 2])
+        frame, ground_truth = render_scene(faces, tags, markers, rotation, translation, camera_matrix, dist_coeffs,
+                                           size, args.blur, args.noise, rng)
+
+        if initial_positions is None:
+            initial_positions = {tag_id: {'position': position.tolist(), 'orientation': 0.0} for tag_id, (position, _, _) in ground_truth.items()}
+            box_position = BoxPosition(initial_positions, box_model)
+
+        detections, _ = detector.detect(frame)
+        positions_orientations = detector.get_position_and_orientation(detections)
+        box_start = time.perf_counter()
+        box_position.calculate_orientation(positions_orientations, detector.box_pose)
+        latencies['box'].append(time.perf_counter() - box_start)
+        for stage, seconds in detector.stage_times.items():
+            latencies[stage].append(seconds)
+
+        # Only count tags that are fully inside the zoomed field of view
+        x1, y1, x2, y2 = detector.crop_box
+        in_view = {tag_id for tag_id, (_, _, image_corners) in ground_truth.items()
+                   if (image_corners[:, 0] >= x1).all() and (image_corners[:, 0] < x2).all()
+                   and (image_corners[:, 1] >= y1).all() and (image_corners[:, 1] < y2).all()}
+        visible += len(in_view)
+
+        for tag_id, position, tvec, _ in positions_orientations:
+            if tag_id not in in_view or position is None:
+                continue
+            detected += 1
+            true_position, true_rotation, _ = ground_truth[tag_id]
+            translation_errors.append(np.linalg.norm(position - true_position))
+            # The rotation the detector solved with its own PnP method
+            rvec, _ = detector.tag_pose_cache[tag_id]
+            rotation_errors.append(rotation_error_degrees(cv2.Rodrigues(rvec)[0], true_rotation))
+
+        if detector.box_pose is not None:
+            rvec, tvec, _, _ = detector.box_pose
+            box_translation_errors.append(np.linalg.norm(tvec.flatten() - translation))
+            box_rotation_errors.append(rotation_error_degrees(cv2.Rodrigues(rvec)[0], rotation))
+
+    total_time = sum(sum(values) for values in latencies.values())
+    return {
+        'zoom': zoom,
+        'tag_size': tag_size,
+        'distance': distance,
+        'frames': args.frames,
+        'fps': args.frames / total_time if total_time > 0 else None,
+        'visible_tags': visible,
+        'detection_rate': detected / visible if visible else None,
+        'latency_ms': {stage: summarize(values, 1000) for stage, values in latencies.items()},
+        'translation_error_mm': summarize(translation_errors, 1000),
+        'rotation_error_deg': summarize(rotation_errors),
+        'box_translation_error_mm': summarize(box_translation_errors, 1000),
+        'box_rotation_error_deg': summarize(box_rotation_errors),
+        'scans': detector.scan_stats(),
+    }
+
+def parse_list(value, cast=float):
+    return [cast(v) for v in value.split(',')]
+
+def main():
+    parser = argparse.ArgumentParser(description="Synthetic AprilTag detection and pose benchmark.")
+    parser.add_argument('-cal', '--calibration', type=str, default='camera_calibration_data.npz', help='Path to camera calibration data.')
+    parser.add_argument('-o', '--output', type=str, default='benchmark_results.json', help='Path of the JSON results file.')
+    parser.add_argument('--width', type=int, default=640, help='Rendered image width (calibration resolution).')
+    parser.add_argument('--height', type=int, default=480, help='Rendered image height (calibration resolution).')
+    parser.add_argument('--zooms', type=str, default='1,2', help='Comma-separated digital zoom factors.')
+    parser.add_argument('--tag-sizes', type=str, default='0.05,0.08', help='Comma-separated tag sizes in meters.')
+    parser.add_argument('--distances', type=str, default='0.5,1.0,2.0', help='Comma-separated camera to box distances in meters.')
+    parser.add_argument('--box-size', type=float, default=0.3, help='Box edge length in meters.')
+    parser.add_argument('--frames', type=int, default=50, help='Frames rendered per case.')
+    parser.add_argument('--max-angle', type=float, default=30.0, help='Maximum yaw away from a face, in degrees.')
+    parser.add_argument('--blur', type=float, default=0.8, help='Gaussian blur sigma in pixels.')
+    parser.add_argument('--noise', type=float, default=3.0, help='Gaussian noise sigma in grey levels.')
+    parser.add_argument('--native-crop', action='store_true', help='Detect on the native zoom crop.')
+    parser.add_argument('--quad-decimate', type=float, default=1.0, help='Quad decimation for multi-scale detection.')
+    parser.add_argument('--corner-refinement', type=str, default='edges', choices=['none', 'edges', 'subpix'], help='Corner refinement mode.')
+    parser.add_argument('--box-pose', action='store_true', help='Solve one rigid box pose over all visible tags.')
+    parser.add_argument('--box-pose-ransac', action='store_true', help='Use RANSAC for the box pose.')
+    parser.add_argument('--pnp-method', type=str, default='iterative', choices=PNP_METHODS, help='Per-tag PnP solver.')
+    parser.add_argument('--flow-tracking', action='store_true', help='Track corners with optical flow between detections.')
+    parser.add_argument('--flow-interval', type=int, default=5, help='Frames tracked by optical flow between detections.')
+    parser.add_argument('--motion', type=float, default=0.0, help='Turn the box by this many degrees per frame instead of posing it at random.')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed.')
+    args = parser.parse_args()
+
+    calibration_data = np.load(args.calibration)
+    camera_matrix = calibration_data['camera_matrix']
+    dist_coeffs = calibration_data['dist_coeffs']
+    face_tags = BoxPosition().face_tags
+    rng = np.random.default_rng(args.seed)
+
+    results = []
+    for zoom in parse_list(args.zooms):
+        for tag_size in parse_list(args.tag_sizes):
+            for distance in parse_list(args.distances):
+                result = run_case(zoom, tag_size, distance, args, camera_matrix, dist_coeffs, face_tags, rng)
+                results.append(result)
+                rate = f"{result['detection_rate']:.0%}" if result['detection_rate'] is not None else "N/A"
+                translation = f"{result['translation_error_mm']['mean']:.1f} mm" if result['translation_error_mm'] else "N/A"
+                rotation = f"{result['rotation_error_deg']['mean']:.2f} deg" if result['rotation_error_deg'] else "N/A"
+                box = f", box rotation error {result['box_rotation_error_deg']['mean']:.2f} deg" if result['box_rotation_error_deg'] else ""
+                print(f"zoom {zoom}, tag {tag_size} m, distance {distance} m: {result['fps']:.1f} fps, "
+                      f"detected {rate}, translation error {translation}, rotation error {rotation}{box}")
+
+    output = {
+        'timestamp': time.strftime("%Y-%m-%d %H:%M:%S"),
+        'opencv_version': cv2.__version__,
+        'settings': {key: value for key, value in vars(args).items() if key != 'output'},
+        'results': results,
+    }
+    output_dir = os.path.dirname(args.output)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    with open(args.output, 'w') as file:
+        json.dump(output, file, indent=2)
+    print(f"Benchmark results saved to {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,38 @@
+import cv2
+import numpy as np
+
+class Undistorter:
+    def __init__(self, camera_matrix, dist_coeffs, max_cached=4):
+        self.camera_matrix = np.asarray(camera_matrix, dtype=np.float64)
+        self.dist_coeffs = np.asarray(dist_coeffs, dtype=np.float64)
+        # Remap tables keyed on the output camera matrix and frame size, so a
+        # zoom or resolution change builds a new table once instead of per frame
+        self.max_cached = max_cached
+        self.maps = {}
+
+    def maps_for(self, new_camera_matrix, size):
+        new_camera_matrix = np.asarray(new_camera_matrix, dtype=np.float64)
+        key = (new_camera_matrix.tobytes(), size)
+        if key not in self.maps:
+            if len(self.maps) >= self.max_cached:
+                self.maps.pop(next(iter(self.maps)))
+            # Fixed-point maps make remap noticeably cheaper than float ones
+            self.maps[key] = cv2.initUndistortRectifyMap(self.camera_matrix, self.dist_coeffs, None, new_camera_matrix,
+                                                         size, cv2.CV_16SC2)
+        return self.maps[key]
+
+    def remap(self, frame, new_camera_matrix, dst=None):
+        # new_camera_matrix describes the output image. Passing the zoomed
+        # camera matrix folds the digital zoom into the same remap, so the
+        # raw frame goes straight to an undistorted, zoomed one.
+        height, width = frame.shape[:2]
+        map1, map2 = self.maps_for(new_camera_matrix, (width, height))
+        return cv2.remap(frame, map1, map2, cv2.INTER_LINEAR, dst=dst)
+
+    def undistort_points(self, points, camera_matrix, new_camera_matrix=None):
+        # points: (N, 2) distorted pixel coordinates in the image described by
+        # camera_matrix. Returns normalized coordinates, or pixel coordinates
+        # in new_camera_matrix if given.
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 1, 2)
+        undistorted = cv2.undistortPoints(points, camera_matrix, self.dist_coeffs, P=new_camera_matrix)
+        return undistorted.reshape(-1, 2)
@@ -0,0 +1,116 @@
+import sys
+import time
+import argparse
+import numpy as np
+from box_position import BoxPosition, make_observations
+
+def reference_relative_orientation(box_position, positions_orientations):
+    # The per-tag loop BoxPosition used before the batch API, kept as the reference
+    if not positions_orientations:
+        return 0
+    estimates = []
+    for tag_id, current_position, _, _ in positions_orientations:
+        if current_position is None:
+            continue
+        for related_tag, angle in [(tag_id, 0)] + box_position.tag_relationships.get(tag_id, []):
+            if related_tag in box_position.initial_positions:
+                initial = np.array(box_position.initial_positions[related_tag]['position'])
+                current = np.array(current_position)
+                cosine = np.dot(initial, current) / (np.linalg.norm(initial) * np.linalg.norm(current))
+                estimates.append(np.radians(box_position.initial_positions[related_tag]['orientation'] + angle
+                                            + np.degrees(np.arccos(np.clip(cosine, -1, 1)))))
+                break
+    if not estimates:
+        return None
+    return float(np.degrees(np.arctan2(np.mean(np.sin(estimates)), np.mean(np.cos(estimates)))) % 360)
+
+def reference_orientation(box_position, positions_orientations):
+    positions = [position for _, position, _, _ in positions_orientations if position is not None]
+    if not positions:
+        return None, None, reference_relative_orientation(box_position, positions_orientations)
+    average = np.mean(positions, axis=0)
+    return average, float(np.degrees(np.arctan2(average[1], average[0])) % 360), \
+        reference_relative_orientation(box_position, positions_orientations)
+
+def random_frames(rng, count, tag_ids):
+    frames = []
+    for _ in range(count):
+        frame = []
+        for tag_id in rng.choice(tag_ids, rng.integers(0, 5), replace=False):
+            position = None if rng.random() < 0.1 else rng.normal(size=3) + [0, 0, 1]
+            frame.append((int(tag_id), position, None, None))
+        frames.append(frame)
+    return frames
+
+def same(value, expected, angle=False):
+    if value is None or expected is None:
+        return value is None and expected is None
+    if angle:
+        return abs((value - expected + 180) % 360 - 180) < 1e-9
+    return np.allclose(value, expected)
+
+def check_rotation_guess():
+    # A frame without tags must not count as a 0 degree measurement: 170,
+    # no tags, 190 is a 20 degree turn, not -340
+    box_position = BoxPosition({0: {'position': [0, 0, 1.0], 'orientation': 100.0}})
+    for degrees in (70, None, 90):
+        tags = [] if degrees is None else [(0, np.array([np.sin(np.radians(degrees)), 0, np.cos(np.radians(degrees))]), None, None)]
+        box_position.calculate_orientation(tags)
+    return abs(box_position.turned_degrees - 20.0) < 1e-9 and box_position.rotation_count == 0
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the vectorized BoxPosition against the per-tag reference loop.")
+    parser.add_argument('--frames', type=int, default=2000, help='Random frames to compare.')
+    parser.add_argument('--repeat', type=int, default=150, help='Copies of the frames in the batch timing run.')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed.')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    tag_ids = [0, 1, 2, 3, 4, 5, 6, 7, 22, 23, 24, 25, 99]  # 99 is not on the box
+    initial_positions = {str(tag_id): {'position': list(rng.normal(size=3) + [0, 0, 1]), 'orientation': float(rng.uniform(0, 360))}
+                         for tag_id in (0, 1, 5, 23)}
+    frames = random_frames(rng, args.frames, tag_ids)
+
+    live = BoxPosition(initial_positions)
+    mismatches = 0
+    for positions_orientations in frames:
+        position, orientation, relative = live.calculate_orientation(positions_orientations)
+        expected = reference_orientation(live, positions_orientations)
+        if not (same(position, expected[0]) and same(orientation, expected[1], True) and same(relative, expected[2], True)):
+            mismatches += 1
+    print(f"Live path: {mismatches} of {len(frames)} frames differ from the reference loop")
+
+    observations = np.concatenate([make_observations(positions_orientations, frame) for frame, positions_orientations in enumerate(frames)])
+    batch = BoxPosition(initial_positions)
+    poses = batch.calculate_orientations(observations, len(frames))
+    batch_mismatches = 0
+    for pose, positions_orientations in zip(poses, frames):
+        expected = reference_orientation(batch, positions_orientations)
+        relative = None if np.isnan(pose['relative_orientation']) else float(pose['relative_orientation'])
+        position = None if np.isnan(pose['orientation']) else pose['position']
+        if not (same(position, expected[0]) and same(relative, expected[2], True)):
+            batch_mismatches += 1
+    counts_match = batch.rotation_count == live.rotation_count
+    print(f"Batch path: {batch_mismatches} of {len(frames)} frames differ, rotation count {batch.rotation_count} "
+          f"({'same as' if counts_match else 'differs from'} the live path's {live.rotation_count})")
+    guess_ok = check_rotation_guess()
+    print(f"Frames without tags {'are' if guess_ok else 'are NOT'} kept out of the rotation count")
+
+    repeated = np.concatenate([observations] * args.repeat)
+    repeated['frame'] += np.repeat(np.arange(args.repeat) * len(frames), len(observations))
+    start = time.perf_counter()
+    BoxPosition(initial_positions).calculate_orientations(repeated, args.repeat * len(frames))
+    batch_time = time.perf_counter() - start
+    reference = BoxPosition(initial_positions)
+    start = time.perf_counter()
+    for positions_orientations in frames:
+        reference_orientation(reference, positions_orientations)
+    loop_time = (time.perf_counter() - start) * args.repeat
+    print(f"{args.repeat * len(frames)} frames, {len(repeated)} observations: batch {batch_time:.2f} s, "
+          f"reference loop {loop_time:.1f} s (extrapolated)")
+
+    if mismatches or batch_mismatches or not counts_match or not guess_ok:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+import os
+import json
+import time
+import queue
+import logging
+import threading
+import cv2
+
+class VideoRecorder(threading.Thread):
+    def __init__(self, output_dir, fps=15, segment_seconds=600, codec='mp4v', extension='mp4', max_queue=32, metrics=None, buffer_pool=None):
+        threading.Thread.__init__(self, daemon=True)
+        self.output_dir = output_dir
+        self.fps = fps
+        self.segment_frames = max(1, int(segment_seconds * fps))  # Segment length in video time
+        self.fourcc = cv2.VideoWriter_fourcc(*codec)
+        self.extension = extension
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.metrics = metrics
+        self.buffer_pool = buffer_pool  # Pooled frames are released once written or dropped
+        self.writer = None
+        self.index_file = None
+        self.segment_index = -1
+        self.segment_frame = 0
+        self.frames_written = 0
+        self.frames_dropped = 0
+        if metrics is not None:
+            metrics.add_collector(self.collect_metrics)
+
+    def collect_metrics(self):
+        return {
+            'recording_queue_depth': self.queue.qsize(),
+            'recording_frames_written': self.frames_written,
+            'recording_frames_dropped': self.frames_dropped,
+        }
+
+    def write(self, frame, sequence, capture_time, detections):
+        # The caller hands over ownership of frame and must not modify it afterwards
+        try:
+            self.queue.put_nowait((frame, sequence, capture_time, detections))
+            return True
+        except queue.Full:
+            self.frames_dropped += 1
+            if self.buffer_pool is not None:
+                self.buffer_pool.release(frame)
+            return False
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            frame, sequence, capture_time, detections = item
+            start_time = time.perf_counter()
+            if self.writer is None or self.segment_frame >= self.segment_frames:
+                self.open_segment(frame.shape[1], frame.shape[0])
+            self.writer.write(frame)
+            if self.buffer_pool is not None:
+                self.buffer_pool.release(frame)
+            # Sidecar index: one line per video frame
+            self.index_file.write(json.dumps({
+                'frame': self.segment_frame,
+                'sequence': sequence,
+                'capture_time': capture_time,
+                'detections': [
+                    {'tag_id': int(d.tag_id), 'center': d.center.tolist(), 'corners': d.corners.tolist()}
+                    for d in detections
+                ],
+            }) + '\n')
+            self.segment_frame += 1
+            self.frames_written += 1
+            if self.metrics is not None:
+                self.metrics.observe('record', time.perf_counter() - start_time)
+        self.close_segment()
+        logging.info(f"Video recorder: {self.frames_written} frames written, {self.frames_dropped} dropped.")
+
+    def open_segment(self, width, height):
+        self.close_segment()
+        self.segment_index += 1
+        self.segment_frame = 0
+        base_path = os.path.join(self.output_dir, f'recording_{self.segment_index:04d}')
+        self.writer = cv2.VideoWriter(f'{base_path}.{self.extension}', self.fourcc, self.fps, (width, height))
+        if not self.writer.isOpened():
+            logging.error(f"Could not open video writer for {base_path}.{self.extension}")
+        self.index_file = open(f'{base_path}.jsonl', 'w')
+        logging.info(f"Recording to {base_path}.{self.extension}")
+
+    def close_segment(self):
+        if self.writer is not None:
+            self.writer.release()
+            self.writer = None
+        if self.index_file is not None:
+            self.index_file.close()
+            self.index_file = None
+
+    def stop(self):
+        self.queue.put(None)
+        self.join()
+
+def load_recording_index(index_path):
+    # Frame number within the segment -> index record
+    with open(index_path, 'r') as file:
+        return [json.loads(line) for line in file if line.strip()]